@@ -0,0 +1,166 @@
+"""Runs the calculator pipeline for many scenarios without Streamlit.
+
+Every preset in scenarios.scenarios_dict is run, together with the cartesian
+product of any slider grids passed on the command line, across a pool of
+processes. Key outputs are written to one NetCDF file per run, plus Parquet
+summary tables for all runs.
+
+Runs can be grouped with --chunk-size, in which case each worker evaluates a
+whole group in a single pipeline pass along the Scenario dimension.
+
+Example
+-------
+    python batch_run.py --grid ruminant=0,50,100 --grid DACCS=0,10,20 -o results
+"""
+
+import os
+import re
+import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+def parse_grid(grids):
+    """Parses "key=v1,v2,..." slider grid arguments into a list of slider
+    dictionaries, one per point of their cartesian product"""
+
+    from food_system import slider_keys
+
+    axes = {}
+    for grid in grids:
+        key, values = grid.split("=")
+        if key not in slider_keys:
+            raise ValueError(f"Unknown slider '{key}'")
+        axes[key] = [float(value) for value in values.split(",")]
+
+    if len(axes) == 0:
+        return []
+
+    return [dict(zip(axes.keys(), point)) for point in itertools.product(*axes.values())]
+
+def key_outputs(datablock):
+    """Collects the key outputs of a pipeline run into a single Dataset"""
+
+    metrics = datablock["metrics"]
+
+    timeseries = datablock["timeseries"]
+
+    emissions = timeseries["impact"]["g_co2e/year"].to_array(dim="Element")
+    sequestration = timeseries["impact"]["co2e_sequestration"].rename({"Item": "Source"})
+
+    out = xr.Dataset({"emissions": emissions,
+                      "sequestration": sequestration,
+                      "SSR": metrics["SSR"]["g/cap/day"],
+                      "land": metrics["land_totals"]})
+
+    return out
+
+def run_scenario(name, sliders, advanced=None, scaling_nutrient="kCal/cap/day"):
+    """Runs the pipeline for a set of slider values in a worker process and
+    returns its key outputs"""
+
+    return run_scenarios([(name, sliders)], advanced=advanced,
+                         scaling_nutrient=scaling_nutrient)[0]
+
+def run_scenarios(runs, advanced=None, scaling_nutrient="kCal/cap/day"):
+    """Runs the pipeline once for a group of (name, sliders) runs stacked
+    along the Scenario dimension, and returns the key outputs of each run"""
+
+    from datablock_setup import datablock, proj_pop
+    from food_system import build_food_system, scenario_sliders
+
+    food_system = build_food_system(datablock, proj_pop,
+                                    sliders=scenario_sliders(dict(runs)),
+                                    advanced=advanced,
+                                    scaling_nutrient=scaling_nutrient)
+    food_system.run()
+
+    outputs = key_outputs(food_system.datablock)
+
+    results = []
+    for name, sliders in runs:
+        if "Scenario" in outputs.dims:
+            out = outputs.sel(Scenario=name).drop_vars("Scenario")
+        else:
+            out = outputs.copy()
+        out.attrs["name"] = name
+        out.attrs.update({key: float(value) for key, value in sliders.items()})
+        results.append((name, out))
+
+    return results
+
+def summary_tables(results):
+    """Builds the per year and land use summary tables of a set of runs"""
+
+    yearly = []
+    land = []
+    for name, out in results:
+        production = out["emissions"].sel(Element="production").sum(dim="Item") / 1e6
+        sequestration = out["sequestration"].sum(dim="Source")
+
+        yearly.append(pd.DataFrame({"run": name,
+                                    "Year": out.Year.values,
+                                    "SSR": out["SSR"].values,
+                                    "emissions": production.values,
+                                    "sequestration": sequestration.values,
+                                    "net_emissions": (production - sequestration).values}))
+
+        land.append(pd.DataFrame({"run": name,
+                                  "aggregate_class": out.aggregate_class.values,
+                                  "hectares": out["land"].values}))
+
+    return pd.concat(yearly, ignore_index=True), pd.concat(land, ignore_index=True)
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--grid", action="append", default=[],
+                        help="Slider grid as key=v1,v2,... Can be repeated")
+    parser.add_argument("--no-scenarios", action="store_true",
+                        help="Do not run the preset scenarios")
+    parser.add_argument("--nutrient", default="kCal/cap/day",
+                        help="Nutrient kept constant when scaling consumption")
+    parser.add_argument("--chunk-size", type=int, default=1,
+                        help="Number of runs evaluated together in a single pipeline pass")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of worker processes")
+    parser.add_argument("-o", "--output", default="batch_output",
+                        help="Output directory")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="Do not print the name of each finished run")
+    args = parser.parse_args(args)
+
+    runs = []
+    if not args.no_scenarios:
+        from scenarios import scenarios_dict
+        runs += [(name, dict(sliders)) for name, sliders in scenarios_dict.items()]
+
+    grid = parse_grid(args.grid)
+    runs += [(f"grid_{i:05d}", sliders) for i, sliders in enumerate(grid)]
+
+    os.makedirs(os.path.join(args.output, "runs"), exist_ok=True)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        chunks = [runs[i:i + args.chunk_size] for i in range(0, len(runs), args.chunk_size)]
+        futures = [executor.submit(run_scenarios, chunk,
+                                   scaling_nutrient=args.nutrient)
+                   for chunk in chunks]
+
+        for future in futures:
+            for name, out in future.result():
+                filename = re.sub(r"[^\w\-]+", "_", name).strip("_") + ".nc"
+                out.to_netcdf(os.path.join(args.output, "runs", filename))
+                results.append((name, out))
+                if not args.quiet:
+                    print(f"Finished {name}")
+
+    yearly, land = summary_tables(results)
+    yearly.to_parquet(os.path.join(args.output, "summary.parquet"))
+    land.to_parquet(os.path.join(args.output, "land.parquet"))
+
+if __name__ == "__main__":
+    main()
@@ -16,7 +16,7 @@ def bottom_panel(datablock, metric_yr):
     # -----------
 
     with botcol2:
-        SSR = datablock["food"]["g/cap/day"].fbs.SSR()
+        SSR = datablock["metrics"]["SSR"]["g/cap/day"]
 
         SSR_metric_yr = SSR.sel(Year=metric_yr).to_numpy()
         SSR_ref = SSR.sel(Year=2020).to_numpy()
@@ -64,11 +64,9 @@ def bottom_panel(datablock, metric_yr):
     
     with botcol1:
 
-        emissions = datablock["impact"]["g_co2e/year"]["production"].sel(Year=metric_yr)/1e6
-        emissions = emissions.fbs.group_sum(coordinate="Item_origin", new_name="Item")
-        seq_da = datablock["impact"]["co2e_sequestration"].sel(Year=metric_yr)
+        balance = datablock["metrics"]["net_emissions"].sel(Year=metric_yr)
 
-        c = plot_single_bar_altair(xr.concat([emissions, -seq_da], dim="Item"), show="Item",
+        c = plot_single_bar_altair(balance, show="Item",
                                             axis_title="Emissions - Sequestration balance",
                                             ax_min=-3e8, ax_max=3e8, unit="tCO2e", vertical=False,
                                             mark_total=True, show_zero=True)
@@ -88,8 +86,7 @@ def bottom_panel(datablock, metric_yr):
 
     with boltcol3:
 
-        pctg = datablock["land"]["percentage_land_use"]
-        totals = pctg.sum(dim=["x", "y"])
+        totals = datablock["metrics"]["land_totals"]
         bar_land_use = plot_single_bar_altair(totals, show="aggregate_class",
                                               axis_title="Land use", unit="Hectares",
                                               vertical=False)
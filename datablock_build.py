@@ -0,0 +1,221 @@
+"""Builds the baseline datablock from the agrifoodpy_data datasets.
+
+This is run by datablock_setup when there is no up to date baseline
+snapshot, and by utils.snapshot to build one.
+"""
+
+import operator
+
+import numpy as np
+import xarray as xr
+
+
+from agrifoodpy_data.food import FAOSTAT, Nutrients_FAOSTAT
+from agrifoodpy_data.impact import PN18_FAOSTAT
+from agrifoodpy_data.population import UN
+from agrifoodpy_data.land import NaturalEngland_ALC_1000 as ALC
+from agrifoodpy_data.land import UKCEH_LC_1000
+
+from agrifoodpy.impact.model import fair_co2_only
+from utils.pipeline import Pipeline, Derived
+from utils.land import to_cells, land_use_table, apply_transitions
+from utils.metrics import metrics_section
+from utils.history import timeseries_section
+from model import agroecology_seq_init
+from food_system import agroecology_classes
+
+datablock = {}
+datablock["food"] = {}
+datablock["land"] = {}
+datablock["impact"] = {}
+datablock["population"] = {}
+
+# Data of the years before the projection, which the pipeline does not change
+datablock["history"] = {}
+datablock["history"]["food"] = {}
+datablock["history"]["impact"] = {}
+
+# ----------------------
+# Regional configuration
+# ----------------------
+
+area_pop = 826 #UK
+# area_pop = 900 # WORLD
+area_pop_world = 900 #WORLD
+
+area_fao = 229 #UK
+# area_fao = 5000 # WORLD
+years = np.arange(1961, 2101)
+
+# ------------------------------
+# Select population data from UN
+# ------------------------------
+
+pop = UN.Medium.sel(Region=[area_pop, area_pop_world], Year=years, Datatype="Total")*1000
+# pop_world = UN.Medium.sel(Region=area_pop_world, Year=years, Datatype="Total")*1000
+
+# pop_past = pop_uk[pop_uk["Year"] < 2021]
+# pop_future = pop_uk[pop_uk["Year"] >= 2021]
+
+proj_pop = pop.sel(Region=area_pop, Year=np.arange(2021, 2101)) / \
+           pop.sel(Region=area_pop, Year=2020)
+
+datablock["population"]["population"] = pop
+
+# -----------------------------------------
+# Select food consumption data from FAOSTAT
+# -----------------------------------------
+
+FAOSTAT *= 1
+# 1000 T / year
+food_uk = FAOSTAT.sel(Region=229)
+datablock["history"]["food"]["1000 T/year"] = food_uk
+
+# ----------------
+# Emission factors
+# ----------------
+scale_ones = xr.DataArray(data = np.ones_like(food_uk.Year.values),
+                          coords = {"Year":food_uk.Year.values})
+extended_impact = PN18_FAOSTAT["GHG Emissions (IPCC 2013)"].drop_vars(["Item_name", "Item_group", "Item_origin"]) * scale_ones
+
+datablock["history"]["impact"]["gco2e/gfood"] = extended_impact
+
+# --------------------------
+# UK Per capita daily values
+# --------------------------
+
+# g_food / cap / day
+pop_past_uk = pop.sel(Year=np.arange(1961,2021), Region=area_pop)
+food_cap_day_baseline = food_uk*1e9/pop_past_uk/365.25
+
+datablock["history"]["food"]["g/cap/day"] = food_cap_day_baseline
+
+# kCal, g_prot, g_fat / g_food
+qty_g = Nutrients_FAOSTAT[["kcal", "protein", "fat"]].sel(Region=area_fao, Year=2020)
+qty_g = qty_g.where(np.isfinite(qty_g), other=0)
+
+datablock["food"]["kCal/g_food"] = qty_g["kcal"]
+datablock["food"]["g_prot/g_food"] = qty_g["protein"]
+datablock["food"]["g_fat/g_food"] = qty_g["fat"]
+
+# kCal, g_prot, g_fat, g_co2e / cap / day
+kcal_cap_day_baseline = food_cap_day_baseline * datablock["food"]["kCal/g_food"]
+prot_cap_day_baseline = food_cap_day_baseline * datablock["food"]["g_prot/g_food"]
+fats_cap_day_baseline = food_cap_day_baseline * datablock["food"]["g_fat/g_food"]
+co2e_cap_day_baseline = food_cap_day_baseline * extended_impact
+
+datablock["history"]["food"]["kCal/cap/day"] = kcal_cap_day_baseline
+datablock["history"]["food"]["g_prot/cap/day"] = prot_cap_day_baseline
+datablock["history"]["food"]["g_fat/cap/day"] = fats_cap_day_baseline
+datablock["history"]["food"]["g_co2e/cap/day"] = co2e_cap_day_baseline
+
+# Only the projected g/cap/day is stored, the nutrient and emission
+# quantities are derived from it when read, so pipeline steps only need to
+# update g/cap/day
+datablock["food"]["kCal/cap/day"] = Derived(operator.mul, ("food", "g/cap/day"), ("food", "kCal/g_food"))
+datablock["food"]["g_prot/cap/day"] = Derived(operator.mul, ("food", "g/cap/day"), ("food", "g_prot/g_food"))
+datablock["food"]["g_fat/cap/day"] = Derived(operator.mul, ("food", "g/cap/day"), ("food", "g_fat/g_food"))
+datablock["food"]["g_co2e/cap/day"] = Derived(operator.mul, ("food", "g/cap/day"), ("impact", "gco2e/gfood"))
+
+# g_co2e / year
+
+# These are UK values for the entire population and year, computed as in
+# model.compute_emissions
+datablock["history"]["impact"]["g_co2e/year"] = co2e_cap_day_baseline * pop.sel(Region=area_pop) * 365.25
+
+# Sequestration sources are zero before the projection, except for the
+# agroecology classes of the food system, whose sequestration curves start at
+# model.agroecology_seq_init. Both are read from the modules defining the
+# steps, so the history follows any change to them
+seq_classes = np.array(list(agroecology_classes.values()), dtype=object)
+datablock["history"]["impact"]["co2e_sequestration"] = xr.DataArray(
+    np.full((len(seq_classes), len(food_uk.Year)), float(agroecology_seq_init)),
+    dims=("Item", "Year"), coords={"Item": seq_classes, "Year": food_uk.Year.values},
+    name="sequestration")
+
+per_cap_day = {"Weight":food_cap_day_baseline,
+            "Energy":kcal_cap_day_baseline,
+            "Proteins":prot_cap_day_baseline,
+            "Fat":fats_cap_day_baseline,
+            "Emissions":co2e_cap_day_baseline}
+
+# ------------------
+# UK Per year values
+# ------------------
+
+# g_food, kCal, g_prot, g_fat, g_co2e / Year
+food_year_baseline = food_cap_day_baseline * pop_past_uk * 365.25
+kcal_year_baseline = kcal_cap_day_baseline * pop_past_uk * 365.25
+prot_year_baseline = prot_cap_day_baseline * pop_past_uk * 365.25
+fats_year_baseline = fats_cap_day_baseline * pop_past_uk * 365.25
+co2e_year_baseline = co2e_cap_day_baseline * pop_past_uk * 365.25
+
+datablock["history"]["food"]["g/year"] = food_year_baseline
+datablock["history"]["food"]["kCal/year"] = kcal_year_baseline
+datablock["history"]["food"]["g_prot/year"] = prot_year_baseline
+datablock["history"]["food"]["g_fat/year"] = fats_year_baseline
+datablock["history"]["food"]["g_co2e/year"] = co2e_year_baseline
+
+per_year = {"Weight":food_year_baseline,
+            "Energy":kcal_year_baseline,
+            "Fat":fats_year_baseline,
+            "Proteins":prot_year_baseline,
+            "Emissions":co2e_year_baseline}
+
+# -------------------------------
+# Atmosferic model - Baseline run
+# -------------------------------
+
+pop_world_past = pop.sel(Year=np.arange(1961,2021), Region=area_pop_world)
+
+# # Convert from grams to Gt: /1e15
+# total_emissions_gtco2e_baseline = (co2e_year_baseline["food"] * pop_world_past / pop_past_uk).sum(dim="Item")/1e15
+
+# T_base, C_base, F_base = fair_co2_only(total_emissions_gtco2e_baseline)
+
+# datablock["impact"]["T"] = T_base
+# datablock["impact"]["C"] = C_base
+# datablock["impact"]["F"] = F_base
+
+# -------------------------------
+# Land use data
+# -------------------------------
+
+# Make sure the land use data and ALC data have the same coordinate base
+LC = UKCEH_LC_1000["percentage_aggregate"]
+
+ALC, LC = xr.align(ALC, LC, join="outer")
+
+# Most of the grid is sea or outside the UK, so only the cells with land use
+# data are stored. Rasters are rebuilt from the valid cells mask for maps
+valid_cells = np.isfinite(LC).any(dim="aggregate_class")
+
+# datablock["land"]["percentage_land_use"] = LC.where(np.isfinite(ALC.grade))
+datablock["land"]["valid_cells"] = valid_cells
+datablock["land"]["baseline_land_use"] = to_cells(LC, valid_cells)
+datablock["land"]["dominant_classification"] = to_cells(ALC.grade, valid_cells)
+
+# Land interventions update the land use table by ALC grade and record their
+# transitions, which are only applied to the cells when these are read
+datablock["land"]["land_use_table"] = land_use_table(datablock["land"]["baseline_land_use"],
+                                                     datablock["land"]["dominant_classification"])
+datablock["land"]["transitions"] = ()
+datablock["land"]["percentage_land_use"] = Derived(apply_transitions,
+                                                   ("land", "baseline_land_use"),
+                                                   ("land", "dominant_classification"),
+                                                   ("land", "transitions"))
+
+# -------
+# Metrics
+
+# Key metrics of the pipeline results, computed when views first read them
+datablock["metrics"] = metrics_section()
+
+# Historical and projected values joined for plotting, computed when read
+datablock["timeseries"] = timeseries_section([("food", "g/cap/day"),
+                                              ("food", "kCal/cap/day"),
+                                              ("food", "g_prot/cap/day"),
+                                              ("food", "g_fat/cap/day"),
+                                              ("food", "g_co2e/cap/day"),
+                                              ("impact", "g_co2e/year"),
+                                              ("impact", "co2e_sequestration")])
@@ -0,0 +1,215 @@
+import xarray as xr
+
+from utils.pipeline import Pipeline
+from utils.helper_functions import default_widget_values
+from advanced_settings import advanced_settings
+from model import *
+
+slider_keys = ["ruminant", "dairy", "pig_poultry_eggs", "fruit_veg", "cereals",
+               "waste", "labmeat", "pasture_sparing", "arable_sparing",
+               "land_beccs", "foresting_spared", "silvopasture",
+               "methane_inhibitor", "manure_management", "animal_breeding",
+               "fossil_livestock", "agroforestry", "fossil_arable",
+               "waste_BECCS", "overseas_BECCS", "DACCS"]
+
+# Sliders read by build_food_system. The fossil fuel use of livestock farming
+# is shown in the app but not modelled yet
+pipeline_slider_keys = [key for key in slider_keys if key != "fossil_livestock"]
+
+# Agroecology class land is converted to by each agroecology slider. The
+# historical sequestration of these classes is set from it in datablock_build
+agroecology_classes = {"silvopasture": "Silvopasture",
+                       "agroforestry": "Agroforestry"}
+
+# Copied on import, as the app writes slider values back to advanced_settings
+_advanced_defaults = {key: params["value"] for key, params in advanced_settings.items()}
+
+def default_sliders():
+    """Returns the default value of every intervention slider"""
+    return {key: default_widget_values[key] for key in slider_keys}
+
+def default_advanced():
+    """Returns the default value of every advanced setting"""
+    return dict(_advanced_defaults)
+
+def scenario_sliders(scenarios):
+    """Stacks the slider values of several scenarios along a Scenario
+    dimension, so that build_food_system evaluates all of them in a single
+    pipeline run.
+
+    Parameters
+    ----------
+    scenarios : dict
+        Slider values of each scenario, keyed on the scenario name. Missing
+        sliders take their default value.
+
+    Returns
+    -------
+    sliders : dict
+        Slider DataArrays along the Scenario dimension. Sliders with the same
+        value in every scenario are kept as scalars, so that the steps they
+        control are not expanded along the Scenario dimension.
+    """
+
+    defaults = default_sliders()
+    names = list(scenarios.keys())
+
+    sliders = {}
+    for key in slider_keys:
+        values = [float(scenarios[name].get(key, defaults[key])) for name in names]
+        if len(set(values)) == 1:
+            sliders[key] = values[0]
+        else:
+            sliders[key] = xr.DataArray(values, dims="Scenario", coords={"Scenario": names})
+
+    return sliders
+
+def build_food_system(datablock, population_scale, sliders=None, advanced=None,
+                      scaling_nutrient="kCal/cap/day"):
+    """Builds the food system pipeline run by the calculator.
+
+    Parameters
+    ----------
+    datablock : dict
+        Baseline datablock, as built by datablock_setup.
+    population_scale : xarray.DataArray
+        Projected population relative to the last year of data.
+    sliders : dict, optional
+        Intervention slider values, keyed on the slider session state keys.
+        Missing sliders take their default value. Values can be DataArrays
+        along a Scenario dimension, as returned by scenario_sliders.
+    advanced : dict, optional
+        Advanced setting values, keyed as in advanced_settings. Missing
+        settings take their default value.
+    scaling_nutrient : str, optional
+        Per capita quantity kept constant when scaling food consumption.
+
+    Returns
+    -------
+    food_system : Pipeline
+        Pipeline with all the intervention steps added, ready to run.
+    """
+
+    sliders = {**default_sliders(), **(sliders or {})}
+    advanced = {**default_advanced(), **(advanced or {})}
+
+    food_system = Pipeline(datablock)
+
+    # Global parameters
+    food_system.datablock_write(["global_parameters", "timescale"], advanced["n_scale"])
+
+    # Consumer demand
+    food_system.add_step(project_future,
+                         {"scale":population_scale})
+    
+    # The five consumption changes are applied in order as a single step
+    food_system.add_step(consumer_demand_model,
+                         {"targets":[{"scale":1-sliders["ruminant"]/100,
+                                      "items":[2731, 2732]},
+                                     {"scale":1-sliders["pig_poultry_eggs"]/100,
+                                      "items":[2733, 2734, 2949]},
+                                     {"scale":1-sliders["dairy"]/100,
+                                      "items":[2740, 2743, 2948]},
+                                     {"scale":1+sliders["fruit_veg"]/100,
+                                      "item_group":["Vegetables", "Fruits - Excluding Wine"]},
+                                     {"scale":1+sliders["cereals"]/100,
+                                      "item_group":["Cereals - Excluding Beer"]}],
+                          "source":["production", "imports"],
+                          "elasticity":[advanced["elasticity"], 1-advanced["elasticity"]],
+                          "scaling_nutrient":scaling_nutrient})
+    
+    food_system.add_step(food_waste_model,
+                         {"waste_scale":sliders["waste"],
+                          "kcal_rda":advanced["rda_kcal"],
+                          "source":"imports"})
+
+    food_system.add_step(cultured_meat_model,
+                         {"cultured_scale":sliders["labmeat"]/100,
+                          "labmeat_co2e":advanced["labmeat_co2e"],
+                          "source":"production"})
+    
+    # Land management
+    food_system.add_step(spare_alc_model,
+                         {"spare_fraction":sliders["pasture_sparing"]/100,
+                          "land_type":["Improved grassland", "Semi-natural grassland"],
+                          "items":"Animal Products"})
+    
+    food_system.add_step(spare_alc_model,
+                         {"spare_fraction":sliders["arable_sparing"]/100,
+                          "land_type":["Arable"],
+                          "items":"Vegetal Products"})
+    
+    food_system.add_step(foresting_spared_model,
+                         {"forest_fraction":sliders["foresting_spared"]/100,
+                          "bdleaf_conif_ratio":advanced["bdleaf_conif_ratio"]/100})
+    
+    food_system.add_step(BECCS_farm_land,
+                         {"farm_percentage":sliders["land_beccs"]/100})
+    
+    # Livestock farming practices        
+    food_system.add_step(agroecology_model,
+                         {"land_percentage":sliders["silvopasture"]/100.,
+                          "agroecology_class":agroecology_classes["silvopasture"],
+                          "land_type":["Improved grassland", "Semi-natural grassland"],
+                          "tree_coverage":advanced["agroecology_tree_coverage"],
+                          "replaced_items":[2731, 2732],
+                          "new_items":2617,
+                          "item_yield":1e2})
+    
+    food_system.add_step(scale_impact,
+                         {"items":[2731, 2732],
+                          "scale_factor":1 - advanced["methane_ghg_factor"]*sliders["methane_inhibitor"]/100})
+    
+    food_system.add_step(scale_production,
+                         {"scale_factor":1-advanced["methane_prod_factor"]*sliders["methane_inhibitor"]/100,
+                          "items":[2731, 2732]})
+    
+    food_system.add_step(scale_impact,
+                         {"items":[2731, 2732],
+                          "scale_factor":1 - advanced["manure_ghg_factor"]*sliders["manure_management"]/100})
+    
+    food_system.add_step(scale_production,
+                         {"scale_factor":1-advanced["manure_prod_factor"]*sliders["manure_management"]/100,
+                          "items":[2731, 2732]})
+    
+    food_system.add_step(scale_impact,
+                         {"items":[2731, 2732],
+                          "scale_factor":1 - advanced["breeding_ghg_factor"]*sliders["animal_breeding"]/100})
+    
+    food_system.add_step(scale_production,
+                         {"scale_factor":1-advanced["breeding_prod_factor"]*sliders["animal_breeding"]/100,
+                          "items":[2731, 2732]})
+
+    # Arable farming practices
+    food_system.add_step(agroecology_model,
+                         {"land_percentage":sliders["agroforestry"]/100.,
+                          "agroecology_class":agroecology_classes["agroforestry"],
+                          "land_type":["Arable"],
+                          "tree_coverage":advanced["agroecology_tree_coverage"],
+                          "replaced_items":2511,
+                          "new_items":2617,
+                          "item_yield":1e2})
+    
+    food_system.add_step(scale_impact,
+                         {"item_origin":"Vegetal Products",
+                          "scale_factor":1 - advanced["fossil_arable_ghg_factor"]*sliders["fossil_arable"]/100})
+    
+    food_system.add_step(scale_production,
+                         {"scale_factor":1 - advanced["fossil_arable_prod_factor"]*sliders["fossil_arable"]/100,
+                          "item_origin":"Vegetal Products"})
+    
+    # Technology & Innovation    
+    food_system.add_step(ccs_model,
+                         {"waste_BECCS":sliders["waste_BECCS"]*1e6,
+                          "overseas_BECCS":sliders["overseas_BECCS"]*1e6,
+                          "DACCS":sliders["DACCS"]*1e6})
+
+    
+    # Compute emissions and sequestration
+    food_system.add_step(forest_sequestration_model,
+                         {"seq_broadleaf_ha_yr":advanced["bdleaf_seq_ha_yr"],
+                          "seq_coniferous_ha_yr":advanced["conif_seq_ha_yr"]})
+
+    food_system.add_step(compute_emissions)
+
+    return food_system
@@ -3,12 +3,18 @@ import numpy as np
 from agrifoodpy.food.food import FoodBalanceSheet
 from agrifoodpy.utils.scaling import logistic_scale, linear_scale
 import warnings
-import copy
+import functools
+
+from utils.pipeline import datablock_paths
+from utils.land import apply_transitions
+from utils.fbs import PackedFBS, item_index
 
 # from agrifoodpy.food.food_supply import scale_food, SSR
 # from afp_config import *
 # from helper_functions import *
 
+@datablock_paths(reads=[("history", "food", "g/cap/day"), ("history", "impact", "gco2e/gfood")],
+                 writes=[("food", "g/cap/day"), ("impact", "gco2e/gfood")])
 def project_future(datablock, scale):
     """Project future food consumption based on scale
     
@@ -23,53 +29,39 @@ def project_future(datablock, scale):
     Returns
     -------
     datablock : Dict
-        New dictionary containinng projected food consumption data
+        New dictionary containinng projected food consumption data, for the
+        projected years only. Historical data is kept in the history section
     """
     years = np.arange(2021,2101)
 
-    # Per capita per day values remain constant
-    g_cap_day = datablock["food"]["g/cap/day"]
-    g_prot_cap_day = datablock["food"]["g_prot/cap/day"]
-    g_fat_cap_day = datablock["food"]["g_fat/cap/day"]
-    kcal_cap_day = datablock["food"]["kCal/cap/day"]
-
-    years_past = g_cap_day.Year.values
-
-    g_cap_day = g_cap_day.fbs.add_years(years, "constant")
-    g_prot_cap_day = g_prot_cap_day.fbs.add_years(years, "constant")
-    g_fat_cap_day = g_fat_cap_day.fbs.add_years(years, "constant")
-    kcal_cap_day = kcal_cap_day.fbs.add_years(years, "constant")
+    # Per capita per day values remain constant. Nutrient quantities are
+    # derived from g/cap/day, so it is the only one that needs projecting
+    g_cap_day = PackedFBS.from_xarray(datablock["history"]["food"]["g/cap/day"]).project(years)
 
     # Scale food production
-    scale_past = xr.DataArray(np.ones(len(years_past)), dims=["Year"], coords={"Year": years_past})
-    scale_tot = xr.concat([scale_past, scale], dim="Year")
-
-    g_cap_day = g_cap_day.fbs.scale_add(element_in="production", element_out="imports", scale=1/scale_tot, add=False)
-    g_prot_cap_day = g_prot_cap_day.fbs.scale_add(element_in="production", element_out="imports", scale=1/scale_tot, add=False)
-    g_fat_cap_day = g_fat_cap_day.fbs.scale_add(element_in="production", element_out="imports", scale=1/scale_tot, add=False)
-    kcal_cap_day = kcal_cap_day.fbs.scale_add(element_in="production", element_out="imports", scale=1/scale_tot, add=False)
+    scale = scale.reset_coords(drop=True)
 
-    g_cap_day = g_cap_day.fbs.scale_add(element_in="exports", element_out="imports", scale=1/scale_tot)
-    g_prot_cap_day = g_prot_cap_day.fbs.scale_add(element_in="exports", element_out="imports", scale=1/scale_tot)
-    g_fat_cap_day = g_fat_cap_day.fbs.scale_add(element_in="exports", element_out="imports", scale=1/scale_tot)
-    kcal_cap_day = kcal_cap_day.fbs.scale_add(element_in="exports", element_out="imports", scale=1/scale_tot)
+    g_cap_day = g_cap_day.scale_add(element_in="production", element_out="imports", scale=1/scale, add=False)
+    g_cap_day = g_cap_day.scale_add(element_in="exports", element_out="imports", scale=1/scale)
 
     # Emissions per gram of food also remain constant
-    g_co2e_g = datablock["impact"]["gco2e/gfood"]
-    g_co2e_g = g_co2e_g.fbs.add_years(years, "constant")
+    g_co2e_g = datablock["history"]["impact"]["gco2e/gfood"].isel(Year=[-1])
+    g_co2e_g = g_co2e_g.fbs.add_years(years, "constant").sel(Year=years)
 
-    datablock["food"]["g/cap/day"] = g_cap_day
-    datablock["food"]["g_prot/cap/day"] = g_prot_cap_day
-    datablock["food"]["g_fat/cap/day"] = g_fat_cap_day
-    datablock["food"]["kCal/cap/day"] = kcal_cap_day
+    datablock["food"]["g/cap/day"] = g_cap_day.to_xarray()
     datablock["impact"]["gco2e/gfood"] = g_co2e_g
 
     return datablock
 
+@datablock_paths(reads=[("global_parameters",), ("food",)],
+                 writes=[("food",)])
 def item_scaling(datablock, scale, source, scaling_nutrient,
                  elasticity=None, items=None, item_group=None):
     """Reduces per capita daily ruminant meat intake and replaces its
     consumption by all other items keeping the overall food consumption constant
+
+    scale can be a DataArray with a Scenario dimension, in which case every
+    scenario is evaluated in the same pass.
     """
 
     timescale = datablock["global_parameters"]["timescale"]
@@ -90,10 +82,8 @@ def item_scaling(datablock, scale, source, scaling_nutrient,
             pass
         # if item_origin is specified, select the items to scale
         elif item_group is not None:
-            if np.isscalar(item_group):
-                item_group = [item_group]
-            items = food_orig.sel(Item = food_orig.Item_group.isin(item_group)).Item.values
-            # items = food_orig.sel(Item = food_orig.Item_group==item_group).Item.values
+            table = item_index(food_orig)
+            items = table.items[table.select("Item_group", item_group).positions]
 
     # Balanced scaling. Reduce food, reduce imports, keep kCal constant
     out = balanced_scaling(fbs=food_orig,
@@ -112,15 +102,153 @@ def item_scaling(datablock, scale, source, scaling_nutrient,
 
     # Scale feed, seed and processing
     out = feed_scale(out, food_orig)
-    
-    ratio = out / food_orig
-    ratio = ratio.where(~np.isnan(ratio), 1)
 
-    # Update per cap/day values and per year values using the same ratio, which
-    # is independent of population growth
-    qty_key = ["g/cap/day", "g_prot/cap/day", "g_fat/cap/day", "kCal/cap/day"]
-    for key in qty_key:
-        datablock["food"][key] *= ratio
+    # Update the per cap/day values using the ratio, which is independent of
+    # population growth. Nutrient quantities are derived from g/cap/day
+    g_cap_day = PackedFBS.from_xarray(datablock["food"]["g/cap/day"])
+    g_cap_day = g_cap_day.rescale(PackedFBS.from_xarray(out), PackedFBS.from_xarray(food_orig))
+    datablock["food"]["g/cap/day"] = g_cap_day.to_xarray()
+
+    return datablock
+
+@datablock_paths(reads=[("global_parameters",), ("food",)],
+                 writes=[("food",)])
+def consumer_demand_model(datablock, targets, source, scaling_nutrient,
+                          elasticity=None):
+    """Scales the consumption of several item groups in a single step, with
+    the same result as a chain of item_scaling steps, one per target.
+
+    The chain only changes the food, source, exports, feed, seed and
+    processing elements, so only these are updated for each target, as
+    arrays of the packed food balance sheet. Between targets, these elements
+    and g/cap/day are scaled by the same out / orig ratio as the chain, so
+    that values set to zero by a target and changed by a later one follow
+    the chain too.
+
+    Parameters
+    ----------
+    datablock : dict
+        The datablock dictionary.
+    targets : list of dict
+        Consumption targets, applied in order. Each has a "scale" after full
+        adoption, which can have a Scenario dimension, and either the
+        "items" or the "item_group" values to scale.
+    source : list
+        Elements supplying the change in consumption.
+    scaling_nutrient : str
+        Per capita quantity kept constant.
+    elasticity : list, optional
+        Fraction of the change supplied by each element in source.
+
+    Returns
+    -------
+    datablock : dict
+        The updated datablock dictionary.
+    """
+
+    timescale = datablock["global_parameters"]["timescale"]
+    food_orig = datablock["food"][scaling_nutrient]
+
+    if np.isscalar(source):
+        source = [source]
+    if elasticity is None:
+        elasticity = [1/len(source)]*len(source)
+
+    y0 = food_orig.Year.values[0]
+    y3 = food_orig.Year.values[-1]
+    y2 = np.min([2021 + timescale, y3])
+
+    food = PackedFBS.from_xarray(food_orig)
+
+    selections = []
+    scales = []
+    for target in targets:
+        if target.get("items") is not None:
+            selected = food.table.select("Item", target["items"])
+        elif target.get("item_group") is not None:
+            selected = food.table.select("Item_group", target["item_group"])
+        else:
+            continue
+
+        selections.append(selected.mask[:, None])
+        scales.append(adoption_curve("logistic", y0, 2021, y2, y3, c_init=1,
+                                     c_end=target["scale"]))
+
+    # The chain is computed on the packed food balance sheet, broadcast along
+    # any Scenario dimension of the scales
+    fbs = food.expand(*scales)
+
+    elements = list(dict.fromkeys(["food", *source, "exports", "production",
+                                   "feed", "seed", "processing"]))
+    state = {element: fbs[element] for element in elements}
+    g_cap_day = PackedFBS.from_xarray(datablock["food"]["g/cap/day"]).expand(fbs)
+    g_state = {element: g_cap_day[element] for element in elements}
+
+    vegetal = fbs.table.select("Item_origin", "Vegetal Products").positions
+
+    for selected, scale in zip(selections, scales):
+        scale = fbs.align(scale)
+        food = state["food"]
+        production_ref = state["production"]
+
+        # Balanced scaling. Scale the selected items and compensate with the
+        # non selected ones to keep the total consumption constant
+        sel_total = np.nansum(np.where(selected, food, 0), axis=-2, keepdims=True)
+        non_sel_total = np.nansum(np.where(selected, 0, food), axis=-2, keepdims=True)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            non_sel_scale = (non_sel_total - (scale - 1) * sel_total) / non_sel_total
+        non_sel_scale = np.where(np.isfinite(non_sel_scale), non_sel_scale, 1.0)
+
+        if np.any(non_sel_scale < 0):
+            warnings.warn("Additional consumption cannot be compensated by \
+                        reduction of non-selected items")
+
+        orig = dict(state)
+        state["food"] = food * np.where(selected, scale, non_sel_scale)
+        delta = np.where(np.isnan(state["food"]), 0, state["food"]) \
+              - np.where(np.isnan(food), 0, food)
+
+        for org, ela in zip(source, elasticity):
+            state[org] = state[org] + delta * ela
+
+        # Prevent negative values in the source elements, supplying the
+        # excess from exports
+        df = sum(np.where(state[org] < 0, state[org], 0) for org in source)
+        state["exports"] = state["exports"] - df
+        for org in source:
+            state[org] = np.where(state[org] > 0, state[org], 0)
+
+        # Scale feed, seed and processing with the same factors as
+        # feed_scale, where feed follows the change in vegetal production,
+        # supplying the difference from production
+        production = state["production"]
+        ref_seed_arr = np.nansum(production_ref[..., vegetal, :], axis=-2, keepdims=True)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            seed_scale = np.nansum(production[..., vegetal, :], axis=-2, keepdims=True) / ref_seed_arr
+            processing_scale = np.nansum(production, axis=-2, keepdims=True) \
+                             / np.nansum(production_ref, axis=-2, keepdims=True)
+        feed_scale = np.where(np.isclose(ref_seed_arr, 0), 1, seed_scale)
+
+        for element, element_scale in zip(["feed", "seed", "processing"],
+                                          [feed_scale, seed_scale, processing_scale]):
+            scaled = state[element] * element_scale
+            state["production"] = state["production"] + (scaled - state[element])
+            state[element] = scaled
+
+        # Update the per cap/day values using the ratio, which is independent
+        # of population growth, as item_scaling does after each target. The
+        # next target starts from the quantities derived from them, where
+        # x / 0 ratios turn zero values into NaN
+        for element in elements:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                ratio = state[element] / orig[element]
+                ratio = np.where(np.isnan(ratio), 1, ratio)
+                state[element] = orig[element] * ratio
+                g_state[element] = g_state[element] * ratio
+
+    # Nutrient quantities are derived from g/cap/day
+    datablock["food"]["g/cap/day"] = g_cap_day.assign(g_state).to_xarray()
 
     return datablock
 
@@ -146,8 +274,9 @@ def balanced_scaling(fbs, items, scale, element, year=None, adoption=None,
         List of items to scale in the food balance sheet.
     element : string
         Name of the DataArray to scale.
-    scale : float
-        Scaling parameter after full adoption.
+    scale : float or xarray.DataArray
+        Scaling parameter after full adoption. A DataArray with a Scenario
+        dimension scales the food balance sheet for every scenario at once.
     adoption : string, optional
         Shape of the scaling adoption curve. "logistic" uses a logistic model
         for a slow-fast-slow adoption. "linear" uses a constant slope adoption
@@ -231,19 +360,15 @@ def balanced_scaling(fbs, items, scale, element, year=None, adoption=None,
 
     # Define scale array based on year range
     if adoption is not None:
-        if adoption == "linear":
-            from agrifoodpy.utils.scaling import linear_scale as scale_func
-        elif adoption == "logistic":
-            from agrifoodpy.utils.scaling import logistic_scale as scale_func
-        else:
-            raise ValueError("Adoption must be one of 'linear' or 'logistic'")
+        if adoption not in adoption_shapes:
+            raise ValueError("Adoption must be one of {}".format(list(adoption_shapes)))
         
         y0 = fbs.Year.values[0]
         y1 = year
         y2 = np.min([year + timescale, fbs.Year.values[-1]])
         y3 = fbs.Year.values[-1]
         
-        scale_arr = scale_func(y0, y1, y2, y3, c_init=1, c_end = scale)
+        scale_arr = adoption_curve(adoption, y0, y1, y2, y3, c_init=1, c_end=scale)
         
         # # Extend the dataset to include all the years of the array
         # fbs_toscale = fbs_toscale * xr.ones_like(scale_arr)
@@ -252,42 +377,47 @@ def balanced_scaling(fbs, items, scale, element, year=None, adoption=None,
         scale_arr = scale    
 
     # Modify and return
-    out = fbs.fbs.scale_add(element, origin, scale_arr, items, add=add,
-                            elasticity=elasticity)    
+    packed = PackedFBS.from_xarray(fbs).expand(scale_arr)
+    out = packed.scale_add(element, origin, scale_arr, items, add=add,
+                           elasticity=elasticity)
 
     if constant:
 
-        delta = out[element] - fbs[element]
+        delta = out[element] - packed[element]
 
         # Scale non selected items
-        non_sel_items = np.setdiff1d(fbs.Item.values, items)
-        non_sel_scale = (fbs.sel(Item=non_sel_items)[element].sum(dim="Item") - delta.sum(dim="Item")) / fbs.sel(Item=non_sel_items)[element].sum(dim="Item")
-        
+        non_sel_items = packed.table.select("Item", items).inverse()
+        non_sel_total = np.nansum(packed[element][..., non_sel_items.positions, :],
+                                  axis=-2, keepdims=True)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            non_sel_scale = (non_sel_total - np.nansum(delta, axis=-2, keepdims=True)) / non_sel_total
+
         # Make sure inf and nan values are not scaled
-        non_sel_scale = non_sel_scale.where(np.isfinite(non_sel_scale)).fillna(1.0)
+        non_sel_scale = np.where(np.isfinite(non_sel_scale), non_sel_scale, 1.0)
 
         if np.any(non_sel_scale < 0):
             warnings.warn("Additional consumption cannot be compensated by \
                         reduction of non-selected items")
-        
-        out = out.fbs.scale_add(element, origin, non_sel_scale, non_sel_items, add=add,
+
+        out = out.scale_add(element, origin, non_sel_scale, non_sel_items, add=add,
                             elasticity=elasticity)
 
         # If fallback is defined, adjust to prevent negative values
         if fallback is not None:
-            df = sum(out[org].where(out[org] < 0).fillna(0) for org in origin)
-            out[fallback] -= np.where(add_fallback, -1, 1)*df
-            for org in origin:
-                out[org] = out[org].where(out[org] > 0, 0)
+            df = sum(np.where(out[org] < 0, out[org], 0) for org in origin)
+            out = out.assign({fallback: out[fallback] - np.where(add_fallback, -1, 1)*df})
+            out = out.assign({org: np.where(out[org] > 0, out[org], 0) for org in origin})
 
-    return out
+    return out.to_xarray()
 
+@datablock_paths(reads=[("global_parameters",), ("food",)],
+                 writes=[("food",)])
 def food_waste_model(datablock, waste_scale, kcal_rda, source):
     """Reduces daily per capita per day intake energy above a set threshold.
     """
 
     timescale = datablock["global_parameters"]["timescale"]
-    food_orig = copy.deepcopy(datablock["food"]["kCal/cap/day"])
+    food_orig = datablock["food"]["kCal/cap/day"]
     datablock["food"]["rda_kcal"] = kcal_rda
 
     # This is the maximum factor we can multiply food by to achieve consumption
@@ -295,17 +425,16 @@ def food_waste_model(datablock, waste_scale, kcal_rda, source):
     waste_factor = (food_orig["food"].isel(Year=-1).sum(dim="Item") - kcal_rda) \
                  / food_orig["food"].isel(Year=-1).sum(dim="Item") \
                  * (waste_scale / 100)
-    
-    waste_factor = waste_factor.to_numpy()
 
     # Create a logistic curve starting at 1, ending at 1-waste_factor
     scale_waste = logistic_food_supply(food_orig, timescale, 1, 1-waste_factor)
+    food_orig = PackedFBS.from_xarray(food_orig)
 
     # Set to "imports" or "production" to choose which element of the food system supplies the change in consumption
     # Scale food and subtract difference from production
-    out = food_orig.fbs.scale_add(element_in="food",
-                                  element_out=source,
-                                  scale=scale_waste)
+    out = food_orig.scale_add(element_in="food",
+                              element_out=source,
+                              scale=scale_waste)
     
     # Scale feed, seed and processing
     # out = feed_scale(out, food_orig)
@@ -313,16 +442,15 @@ def food_waste_model(datablock, waste_scale, kcal_rda, source):
     # If supply element is negative, set to zero and add the negative delta to imports
     out = check_negative_source(out, source)
 
-    # Scale all per capita qantities proportionally
-    ratio = out / food_orig
-    ratio = ratio.where(~np.isnan(ratio), 1)
-
-    qty_key = ["g/cap/day", "g_prot/cap/day", "g_fat/cap/day", "kCal/cap/day"]
-    for key in qty_key:
-        datablock["food"][key] *= ratio
+    # Scale all per capita qantities proportionally. Nutrient quantities are
+    # derived from g/cap/day
+    g_cap_day = PackedFBS.from_xarray(datablock["food"]["g/cap/day"])
+    datablock["food"]["g/cap/day"] = g_cap_day.rescale(out, food_orig).to_xarray()
 
     return datablock
 
+@datablock_paths(reads=[("global_parameters",), ("food",), ("impact", "gco2e/gfood")],
+                 writes=[("food",), ("impact", "gco2e/gfood")])
 def cultured_meat_model(datablock, cultured_scale, labmeat_co2e, source, extra_items = []):
     """Replaces selected meat items by cultured products on a weight by weight
     basis. 
@@ -334,37 +462,34 @@ def cultured_meat_model(datablock, cultured_scale, labmeat_co2e, source, extra_i
     if len(extra_items) > 0:
         items_to_replace = np.concatenate([items_to_replace, extra_items])
 
-    # Add cultured meat to the dataset
-    qty_key = ["g/cap/day", "g_prot/cap/day", "g_fat/cap/day", "kCal/cap/day"]
-    
-    for key in qty_key:
-        datablock["food"][key] = datablock["food"][key].fbs.add_items(5000)
-        datablock["food"][key]["Item_name"].loc[{"Item":5000}] = "Cultured meat"
-        datablock["food"][key]["Item_origin"].loc[{"Item":5000}] = "Cultured Products"
-        datablock["food"][key]["Item_group"].loc[{"Item":5000}] = "Cultured Products"
-        # Set values to zero to avoid issues
-        datablock["food"][key].loc[{"Item":5000}] = 0
-
-    # Scale products by cultured_scale
-    food_orig = copy.deepcopy(datablock["food"]["g/cap/day"])
+    scale_labmeat = logistic_food_supply(datablock["food"]["g/cap/day"], timescale,
+                                         1, 1-cultured_scale)
 
-    scale_labmeat = logistic_food_supply(food_orig, timescale, 1, 1-cultured_scale)
+    # Add cultured meat to the dataset, with zero values. Nutrient quantities
+    # are derived from g/cap/day and the nutrition values added below
+    food_orig = PackedFBS.from_xarray(datablock["food"]["g/cap/day"])
+    food_orig = food_orig.add_item(5000,
+                                   Item_name="Cultured meat",
+                                   Item_origin="Cultured Products",
+                                   Item_group="Cultured Products").expand(scale_labmeat)
 
     # Scale and remove from suplying element
-    out = food_orig.fbs.scale_add(element_in="food",
-                                  element_out=source,
-                                  scale=scale_labmeat,
-                                  items=items_to_replace,
-                                  add=True)
+    out = food_orig.scale_add(element_in="food",
+                              element_out=source,
+                              scale=scale_labmeat,
+                              items=items_to_replace,
+                              add=True)
     
     # If production is negative, set to zero and add the negative delta to
     # imports
     out = check_negative_source(out, source)
     
     # Add delta to cultured meat
-    delta = (datablock["food"]["g/cap/day"]-out).sel(Item=items_to_replace).sum(dim="Item")
-    out.loc[{"Item":5000}] += delta
-    datablock["food"]["g/cap/day"] = out
+    replaced = out.table.positions(items_to_replace)
+    delta = np.nansum((food_orig.values - out.values)[..., replaced, :], axis=-2)
+    values = np.array(out.values)
+    values[..., out.table.positions(5000)[0], :] += delta
+    datablock["food"]["g/cap/day"] = out.replace(values=values).to_xarray()
 
     # Add nutrition values for cultured meat
     nutrition_keys = ["g_prot/g_food", "g_fat/g_food", "kCal/g_food"]
@@ -378,29 +503,30 @@ def cultured_meat_model(datablock, cultured_scale, labmeat_co2e, source, extra_i
     datablock["impact"]["gco2e/gfood"] = datablock["impact"]["gco2e/gfood"].fbs.add_items(5000)
     datablock["impact"]["gco2e/gfood"].loc[{"Item":5000}] = labmeat_co2e
 
-    # Recompute per capita values
-    for key_pc, key_n in zip(qty_key[1:], nutrition_keys):
-        datablock["food"][key_pc] = datablock["food"]["g/cap/day"] * datablock["food"][key_n]
-
     return datablock
 
+@datablock_paths(reads=[("population",), ("food", "g/cap/day"), ("food", "g_co2e/cap/day"),
+                        ("impact", "gco2e/gfood")],
+                 writes=[("impact", "g_co2e/year")])
 def compute_emissions(datablock):
     """
-    Computes the emissions per capita per day and per year for each food item,
-    using the per capita daily weights and PN18 emissions factors.
+    Computes the emissions per year for each food item, using the per capita
+    daily emissions derived from the daily weights and PN18 emissions factors.
     """
     pop = datablock["population"]["population"]
     pop_world = pop.sel(Region = 826)
 
-    # Compute emissions per capita per day
-    co2e_cap_day = datablock["food"]["g/cap/day"] * datablock["impact"]["gco2e/gfood"]
+    # Emissions per capita per day are derived from g/cap/day
+    co2e_cap_day = datablock["food"]["g_co2e/cap/day"]
 
     # Compute emissions per year
-    datablock["food"]["g_co2e/cap/day"] = co2e_cap_day
     datablock["impact"]["g_co2e/year"] = co2e_cap_day * pop_world * 365.25
 
     return datablock
 
+@datablock_paths(reads=[("history", "impact", "g_co2e/year"), ("impact", "g_co2e/year"),
+                        ("timeseries", "impact", "g_co2e/year")],
+                 writes=[("impact", "T"), ("impact", "C"), ("impact", "F")])
 def compute_t_anomaly(datablock):
     """Computes the temperature anomaly, concentration and radiation forcing from
     the per year emissions using the FAIR model.
@@ -408,8 +534,8 @@ def compute_t_anomaly(datablock):
 
     from agrifoodpy.impact.model import fair_co2_only
 
-    # g co2e / year
-    g_co2e_year = datablock["impact"]["g_co2e/year"]["production"].sum(
+    # g co2e / year, including the historical emissions
+    g_co2e_year = datablock["timeseries"]["impact"]["g_co2e/year"]["production"].sum(
         dim="Item")
 
     # Gt co2e / year
@@ -426,6 +552,8 @@ def compute_t_anomaly(datablock):
 
     return datablock
 
+@datablock_paths(reads=[("global_parameters",), ("land",), ("food",)],
+                 writes=[("land", "land_use_table"), ("land", "transitions"), ("food",)])
 def spare_alc_model(datablock, spare_fraction, land_type, items, alc_grades=None):
     """Replaces a specified land type fraction and sets it to a new type called
     'spared'. Scales food production and imports to reflect the change in land
@@ -433,80 +561,51 @@ def spare_alc_model(datablock, spare_fraction, land_type, items, alc_grades=None
     """
     
     timescale = datablock["global_parameters"]["timescale"]
-    alc = datablock["land"]["dominant_classification"]
-    pctg = datablock["land"]["percentage_land_use"].copy(deep=True)
-    old_use = datablock["land"]["percentage_land_use"].sel({"aggregate_class":land_type}).sum()
-
-    # if no alc grade is provided, then use the whole map
-    if alc_grades is not None:
-        alc_mask = np.isin(alc, alc_grades)
-    else:
-        alc_mask = np.ones_like(pctg, dtype=bool)
-
-    to_spare = pctg.where(alc_mask, other=0).sel({"aggregate_class":land_type})
+    old_use = scenario_total(datablock["land"]["land_use_table"].sel({"aggregate_class":land_type}))
 
-    # Spare the specified land type
-    delta_spared =  to_spare * spare_fraction
-    pctg.loc[{"aggregate_class":land_type}] -= delta_spared
-
-    if "Spared" not in pctg.aggregate_class.values:
-        spared_new_class = xr.zeros_like(pctg.isel(aggregate_class=0)).where(np.isfinite(pctg.isel(aggregate_class=0)))
-        spared_new_class["aggregate_class"] = "Spared"
-        pctg = xr.concat([pctg, spared_new_class], dim="aggregate_class")
-
-    pctg.loc[{"aggregate_class":"Spared"}] += delta_spared.sum(dim="aggregate_class")
-
-    # Add spared class to the land use map
-    datablock["land"]["percentage_land_use"] = pctg
+    # Spare the specified land type on the given alc grades, or on the whole
+    # map if no alc grade is provided
+    table = transfer_land(datablock, land_type, {"Spared": 1}, spare_fraction, alc_grades)
 
     # Scale food production and imports
-    new_use = pctg.sel({"aggregate_class":land_type}).sum()
-    scale_use = (new_use/old_use).to_numpy()
+    new_use = scenario_total(table.sel({"aggregate_class":land_type}))
+    scale_use = new_use/old_use
 
     food_orig = datablock["food"]["g/cap/day"]
     scale_spare = logistic_food_supply(food_orig, timescale, 1, scale_use)
 
-    scaled_items = food_orig.sel(Item=food_orig.Item_origin==items).Item.values
-
-    out = food_orig.fbs.scale_add(element_in="production",
-                                  element_out="imports",
-                                  scale=scale_spare,
-                                  items=scaled_items,
-                                  add=False)
+    food_orig = PackedFBS.from_xarray(food_orig)
+    out = food_orig.scale_add(element_in="production",
+                              element_out="imports",
+                              scale=scale_spare,
+                              items=food_orig.table.select("Item_origin", items),
+                              add=False)
     
-    ratio = out / food_orig
-    ratio = ratio.where(~np.isnan(ratio), 1)
-
-    # Update per cap/day values and per year values using the same ratio, which
-    # is independent of population growth
-    qty_key = ["g/cap/day", "g_prot/cap/day", "g_fat/cap/day", "kCal/cap/day"]
-    for key in qty_key:
-        datablock["food"][key] *= ratio
+    # Update the per cap/day values using the ratio, which is independent of
+    # population growth. Nutrient quantities are derived from g/cap/day
+    datablock["food"]["g/cap/day"] = food_orig.rescale(out, food_orig).to_xarray()
 
     # datablock["food"]["g/cap/day"] = out
 
     return datablock
 
+@datablock_paths(reads=[("land", "land_use_table"), ("land", "transitions")],
+                 writes=[("land", "land_use_table"), ("land", "transitions")])
 def foresting_spared_model(datablock, forest_fraction, bdleaf_conif_ratio):
     """Replaces a the "spared" land type fraction and sets it to "forested".
     """
 
-    # Load land use data from datablock
-    pctg = datablock["land"]["percentage_land_use"].copy(deep=True)
-
-    # Compute spared fraction to be re forested and remove from the spared class
-    delta_spared = pctg.loc[{"aggregate_class":"Spared"}] * forest_fraction
-    pctg.loc[{"aggregate_class":"Spared"}] -= delta_spared
-
-    # Add forested percentage to the land use map
-    pctg.loc[{"aggregate_class":"Broadleaf woodland"}] += delta_spared * bdleaf_conif_ratio
-    pctg.loc[{"aggregate_class":"Coniferous woodland"}] += delta_spared * (1-bdleaf_conif_ratio)
-
-    # Rewrite land use data to datablock
-    datablock["land"]["percentage_land_use"] = pctg
+    # Move the spared fraction to be re forested to the woodland classes
+    transfer_land(datablock, "Spared",
+                  {"Broadleaf woodland": bdleaf_conif_ratio,
+                   "Coniferous woodland": 1-bdleaf_conif_ratio},
+                  forest_fraction)
 
     return datablock
 
+@datablock_paths(reads=[("global_parameters",), ("food", "g/cap/day"), ("land", "land_use_table"),
+                        ("impact", "co2e_sequestration")],
+                 writes=[("impact", "co2e_sequestration"), ("impact", "cost")])
 def ccs_model(datablock, waste_BECCS, overseas_BECCS, DACCS):
     """Computes the CCS sequestration from the different sources
     
@@ -523,12 +622,12 @@ def ccs_model(datablock, waste_BECCS, overseas_BECCS, DACCS):
     
     timescale = datablock["global_parameters"]["timescale"]
     food_orig = datablock["food"]["g/cap/day"]
-    pctg = datablock["land"]["percentage_land_use"]
+    table = datablock["land"]["land_use_table"]
 
     # Compute the total area of BECCS land used in hectares, and the total
     # sequestration in Mt CO2e / year
 
-    land_BECCS_area = pctg.sel({"aggregate_class":"BECCS"}).sum().to_numpy()
+    land_BECCS_area = scenario_total(table.sel({"aggregate_class":"BECCS"}))
     land_BECCS = land_BECCS_area * 23.5
 
     logistic_0_val = logistic_food_supply(food_orig, timescale, 0, 1)
@@ -555,19 +654,21 @@ def ccs_model(datablock, waste_BECCS, overseas_BECCS, DACCS):
         datablock["impact"]["co2e_sequestration"] = seq_da
 
     # Compute the total cost of sequestration in pounds per year
-    cost_BECCS_tCO2e = linear_scale(food_orig.Year.values[0],
-                              2030,
-                              2050,
-                              food_orig.Year.values[-1],
-                              c_init=123,
-                              c_end=93)
+    cost_BECCS_tCO2e = adoption_curve("linear",
+                                      food_orig.Year.values[0],
+                                      2030,
+                                      2050,
+                                      food_orig.Year.values[-1],
+                                      c_init=123,
+                                      c_end=93)
     
-    cost_DACCS_tCO2e = linear_scale(food_orig.Year.values[0],
-                                    2030,
-                                    2050,
-                                    food_orig.Year.values[-1],
-                                    c_init=245,
-                                    c_end=180)
+    cost_DACCS_tCO2e = adoption_curve("linear",
+                                      food_orig.Year.values[0],
+                                      2030,
+                                      2050,
+                                      food_orig.Year.values[-1],
+                                      c_init=245,
+                                      c_end=180)
 
     cost_waste_BECCS = waste_BECCS_seq_array * cost_BECCS_tCO2e
     cost_overseas_BECCS = overseas_BECCS_seq_array * cost_BECCS_tCO2e
@@ -584,6 +685,9 @@ def ccs_model(datablock, waste_BECCS, overseas_BECCS, DACCS):
 
     return datablock    
 
+@datablock_paths(reads=[("global_parameters",), ("food", "g/cap/day"), ("land", "land_use_table"),
+                        ("impact", "co2e_sequestration")],
+                 writes=[("impact", "co2e_sequestration")])
 def forest_sequestration_model(datablock, seq_broadleaf_ha_yr, seq_coniferous_ha_yr):
     """Computes total annual sequestration from the different sources"""
     
@@ -591,11 +695,11 @@ def forest_sequestration_model(datablock, seq_broadleaf_ha_yr, seq_coniferous_ha
     food_orig = datablock["food"]["g/cap/day"]
 
     # Load the land use data from the datablock
-    pctg = datablock["land"]["percentage_land_use"].copy(deep=True)
+    table = datablock["land"]["land_use_table"]
 
     # Compute forest area in ha, maximum anual sequestration, and growth curve
-    area_broadleaf = pctg.loc[{"aggregate_class":"Broadleaf woodland"}].sum().to_numpy()
-    area_coniferous = pctg.loc[{"aggregate_class":"Coniferous woodland"}].sum().to_numpy()
+    area_broadleaf = scenario_total(table.loc[{"aggregate_class":"Broadleaf woodland"}])
+    area_coniferous = scenario_total(table.loc[{"aggregate_class":"Coniferous woodland"}])
 
     max_seq_broadleaf = area_broadleaf * seq_broadleaf_ha_yr
     max_seq_coniferous = area_coniferous * seq_coniferous_ha_yr
@@ -623,6 +727,8 @@ def forest_sequestration_model(datablock, seq_broadleaf_ha_yr, seq_coniferous_ha
 
     return datablock
 
+@datablock_paths(reads=[("global_parameters",), ("food", "g/cap/day"), ("impact", "gco2e/gfood")],
+                 writes=[("impact", "gco2e/gfood")])
 def scale_impact(datablock, scale_factor, item_origin=None, items=None):
     """ Scales the impact values for the selected items by multiplying them by
     a multiplicative factor.
@@ -631,7 +737,7 @@ def scale_impact(datablock, scale_factor, item_origin=None, items=None):
     timescale = datablock["global_parameters"]["timescale"]
     # load quantities and impacts
     food_orig = datablock["food"]["g/cap/day"]
-    impacts = datablock["impact"]["gco2e/gfood"].copy(deep=True)
+    impacts = datablock["impact"]["gco2e/gfood"]
 
     # if no items are specified, do nothing
     if items is None and item_origin is None:
@@ -643,17 +749,21 @@ def scale_impact(datablock, scale_factor, item_origin=None, items=None):
             pass
         # if item_origin is specified, select the items to scale
         elif item_origin is not None:
-            items = food_orig.sel(Item = food_orig.Item_origin==item_origin).Item.values
-            items = items[np.isin(items, impacts.Item.values)]
+            table = item_index(food_orig)
+            items = table.items[table.select("Item_origin", item_origin).positions]
     
     scale = logistic_food_supply(food_orig, timescale, 1, scale_factor)
 
-    # scale the impacts
-    impacts.loc[{"Item": items}] *= scale
+    # scale the impacts, writing a new array rather than modifying the input
+    selected = xr.DataArray(item_index(impacts).select("Item", items).mask,
+                            dims="Item", coords={"Item": impacts.Item})
+    impacts = impacts * xr.where(selected, scale, 1)
     datablock["impact"]["gco2e/gfood"] = impacts
 
     return datablock
 
+@datablock_paths(reads=[("global_parameters",), ("food",)],
+                 writes=[("food",)])
 def scale_production(datablock, scale_factor, item_origin=None, items=None):
     """ Scales the production values for the selected items by multiplying them by
     a multiplicative factor.
@@ -662,7 +772,7 @@ def scale_production(datablock, scale_factor, item_origin=None, items=None):
     timescale = datablock["global_parameters"]["timescale"]
 
     # load quantities and impacts
-    food_orig = datablock["food"]["g/cap/day"].copy(deep=True)
+    food_orig = datablock["food"]["g/cap/day"]
 
     # if no items are specified, do nothing
     if items is None and item_origin is None:
@@ -674,77 +784,66 @@ def scale_production(datablock, scale_factor, item_origin=None, items=None):
             pass
         # if item_origin is specified, select the items to scale
         elif item_origin is not None:
-            items = food_orig.sel(Item = food_orig.Item_origin==item_origin).Item.values
+            items = item_index(food_orig).select("Item_origin", item_origin)
 
     scale_prod = logistic_food_supply(food_orig, timescale, 1, scale_factor)
+    food_orig = PackedFBS.from_xarray(food_orig)
 
-    out = food_orig.fbs.scale_add(element_in="production",
-                                element_out="imports",
-                                scale=scale_prod,
-                                items=items,
-                                add=False)
+    out = food_orig.scale_add(element_in="production",
+                              element_out="imports",
+                              scale=scale_prod,
+                              items=items,
+                              add=False)
     
-    ratio = out / food_orig
-    ratio = ratio.where(~np.isnan(ratio), 1)
-
-    # Update per cap/day values and per year values using the same ratio, which
-    # is independent of population growth
-    qty_key = ["g/cap/day", "g_prot/cap/day", "g_fat/cap/day", "kCal/cap/day"]
-    for key in qty_key:
-        datablock["food"][key] *= ratio
+    # Update the per cap/day values using the ratio, which is independent of
+    # population growth. Nutrient quantities are derived from g/cap/day
+    datablock["food"]["g/cap/day"] = food_orig.rescale(out, food_orig).to_xarray()
 
     return datablock
 
+@datablock_paths(reads=[("global_parameters",), ("land", "land_use_table"), ("land", "transitions"),
+                        ("food",)],
+                 writes=[("land", "land_use_table"), ("land", "transitions"), ("food",)])
 def BECCS_farm_land(datablock, farm_percentage):
     """Repurposes farm land for BECCS, reducing the amount of food production,
     and increasing the amount of CO2e sequestered.
     """
 
     timescale = datablock["global_parameters"]["timescale"]
-    pctg = datablock["land"]["percentage_land_use"].copy(deep=True)
-    old_use = datablock["land"]["percentage_land_use"].sel({"aggregate_class":"Arable"}).sum()
+    old_use = scenario_total(datablock["land"]["land_use_table"].sel({"aggregate_class":"Arable"}))
     
-    to_spare = pctg.sel({"aggregate_class":"Arable"})
-    # Spare the specified land type
-    delta_spared =  to_spare * farm_percentage
-    pctg.loc[{"aggregate_class":"Arable"}] -= delta_spared
-
-    if "BECCS" not in pctg.aggregate_class.values:
-        spared_new_class = xr.zeros_like(pctg.isel(aggregate_class=0)).where(np.isfinite(pctg.isel(aggregate_class=0)))
-        spared_new_class["aggregate_class"] = "BECCS"
-        pctg = xr.concat([pctg, spared_new_class], dim="aggregate_class")
-
-    pctg.loc[{"aggregate_class":"BECCS"}] += delta_spared
-
-    # Add spared class to the land use map
-    datablock["land"]["percentage_land_use"] = pctg
+    # Spare the specified land type for BECCS
+    table = transfer_land(datablock, "Arable", {"BECCS": 1}, farm_percentage)
 
     # Scale food production and imports
-    new_use = pctg.sel({"aggregate_class":"Arable"}).sum()
-    scale_use = (new_use/old_use).fillna(1).to_numpy()
+    new_use = scenario_total(table.sel({"aggregate_class":"Arable"}))
+    scale_use = (new_use/old_use).fillna(1)
 
     food_orig = datablock["food"]["g/cap/day"]
     scale_spare = logistic_food_supply(food_orig, timescale, 1, scale_use)
 
-    scaled_items = food_orig.sel(Item=food_orig.Item_origin=="Vegetal Products").Item.values
-
-    out = food_orig.fbs.scale_add(element_in="production",
-                                  element_out="imports",
-                                  scale=scale_spare,
-                                  items=scaled_items,
-                                  add=False)
+    food_orig = PackedFBS.from_xarray(food_orig)
+    out = food_orig.scale_add(element_in="production",
+                              element_out="imports",
+                              scale=scale_spare,
+                              items=food_orig.table.select("Item_origin", "Vegetal Products"),
+                              add=False)
     
-    ratio = out / food_orig
-    ratio = ratio.where(~np.isnan(ratio), 1)
-
-    # Update per cap/day values and per year values using the same ratio, which
-    # is independent of population growth
-    qty_key = ["g/cap/day", "g_prot/cap/day", "g_fat/cap/day", "kCal/cap/day"]
-    for key in qty_key:
-        datablock["food"][key] *= ratio
+    # Update the per cap/day values using the ratio, which is independent of
+    # population growth. Nutrient quantities are derived from g/cap/day
+    datablock["food"]["g/cap/day"] = food_orig.rescale(out, food_orig).to_xarray()
 
     return datablock
 
+# Sequestration of agroecological land before the conversion starts, in
+# t CO2e / year. It is the initial value of the agroecology sequestration
+# curves, and the historical sequestration of the agroecology classes
+agroecology_seq_init = 1
+
+@datablock_paths(reads=[("global_parameters",), ("land",), ("food",), ("population",),
+                        ("impact", "co2e_sequestration")],
+                 writes=[("land", "land_use_table"), ("land", "transitions"), ("food",),
+                         ("impact", "co2e_sequestration")])
 def agroecology_model(datablock, land_percentage, land_type, 
                       agroecology_class="Agroecology", tree_coverage=0.1,
                       replaced_items=None, new_items=None, item_yield=None,
@@ -782,41 +881,29 @@ def agroecology_model(datablock, land_percentage, land_type,
     """
 
     # Load land use and food data from datablock
-    pctg = datablock["land"]["percentage_land_use"].copy(deep=True)
-    food_orig = datablock["food"]["g/cap/day"].copy(deep=True)
-    old_use = pctg.sel({"aggregate_class":land_type}).sum()
-    alc = datablock["land"]["dominant_classification"]
+    food_orig = datablock["food"]["g/cap/day"]
+    old_use = scenario_total(datablock["land"]["land_use_table"].sel({"aggregate_class":land_type}))
     timescale = datablock["global_parameters"]["timescale"]
 
-    # Compute land percentages to be converted to agroecology and remove them
-    # from the land_type classes
-    delta_agroecology = pctg.loc[{"aggregate_class":land_type}] * land_percentage
-    pctg.loc[{"aggregate_class":land_type}] -= delta_agroecology
-
-    # Add the agroecology percentage to the new agroecology class
-    if agroecology_class not in pctg.aggregate_class.values:
-        new_class = xr.zeros_like(pctg.isel(aggregate_class=0)).where(np.isfinite(pctg.isel(aggregate_class=0)))
-        new_class["aggregate_class"] = agroecology_class
-        pctg = xr.concat([pctg, new_class], dim="aggregate_class")
-
-    delta_total = delta_agroecology.sum(dim="aggregate_class")
-    pctg.loc[{"aggregate_class":agroecology_class}] += delta_total
+    # Move the land to be converted to agroecology from the land_type classes
+    # to the agroecology class
+    table = transfer_land(datablock, land_type, {agroecology_class: 1}, land_percentage)
+    area_converted = old_use * land_percentage
 
-    out = food_orig.copy(deep=True)
+    out = PackedFBS.from_xarray(food_orig)
 
     # Reduce production of replaced items if they are provided
     if replaced_items is not None:
-        new_use = pctg.sel({"aggregate_class":land_type}).sum()
+        new_use = scenario_total(table.sel({"aggregate_class":land_type}))
         scale_use = (new_use/old_use) + (1-tree_coverage) * (1-new_use/old_use)
-        scale_use = scale_use.to_numpy()
 
-        scale_arr = logistic_food_supply(out, timescale, 1, scale_use)
+        scale_arr = logistic_food_supply(food_orig, timescale, 1, scale_use)
 
-        out = out.fbs.scale_add(element_in="production",
-                                element_out="imports",
-                                scale=scale_arr,
-                                items=replaced_items,
-                                add=False)
+        out = out.scale_add(element_in="production",
+                            element_out="imports",
+                            scale=scale_arr,
+                            items=replaced_items,
+                            add=False)
 
     # Add new items by scaling production from current values to future values
     if new_items is not None:
@@ -829,21 +916,22 @@ def agroecology_model(datablock, land_percentage, land_type,
 
         for item, yld in zip(new_items, item_yield):
             old_production = food_orig["production"].sel({"Item":item}).isel(Year=-1)
-            new_production = old_production + yld * delta_agroecology.sum()/pop
-            production_scale = (new_production / old_production).to_numpy()
+            new_production = old_production + yld * area_converted/pop
+            production_scale = new_production / old_production
             production_scale_array = logistic_food_supply(food_orig, timescale, 1, production_scale)
 
-            out = out.fbs.scale_add(element_in="production",
+            out = out.scale_add(element_in="production",
                                 element_out="imports",
                                 scale=production_scale_array,
                                 items=item,
                                 add=False)
         
     # Compute forest area in ha, maximum anual sequestration, and growth curve
-    area_agroecology = pctg.loc[{"aggregate_class":agroecology_class}].sum().to_numpy()
+    area_agroecology = scenario_total(table.loc[{"aggregate_class":agroecology_class}])
     max_seq_agroecology = area_agroecology * seq_ha_yr
 
-    agroecology_seq = logistic_food_supply(food_orig, timescale, 1, c_end=max_seq_agroecology)
+    agroecology_seq = logistic_food_supply(food_orig, timescale, agroecology_seq_init,
+                                           c_end=max_seq_agroecology)
     
     # Create a dataset with the different sequestration sources
     seq_ds = xr.Dataset({agroecology_class: agroecology_seq})
@@ -858,55 +946,76 @@ def agroecology_model(datablock, land_percentage, land_type,
         seq_da = xr.concat([seq_da_in, seq_da], dim="Item")
         datablock["impact"]["co2e_sequestration"] = seq_da
 
-    # Rewrite land use data to datablock
-    datablock["land"]["percentage_land_use"] = pctg
+    # Update the per cap/day values using the ratio, which is independent of
+    # population growth. Nutrient quantities are derived from g/cap/day
+    food_orig = PackedFBS.from_xarray(food_orig)
+    datablock["food"]["g/cap/day"] = food_orig.rescale(out, food_orig).to_xarray()
+
+    return datablock
 
-    ratio = out / food_orig
-    ratio = ratio.where(~np.isnan(ratio), 1)
+def transfer_land(datablock, sources, targets, fraction, grades=None):
+    """Moves a fraction of the land of the sources classes to the targets
+    classes, on the given ALC grades or on all of them if grades is None.
 
-    # Update per cap/day values and per year values using the same ratio, which
-    # is independent of population growth
-    qty_key = ["g/cap/day", "g_prot/cap/day", "g_fat/cap/day", "kCal/cap/day"]
-    for key in qty_key:
-        datablock["food"][key] *= ratio
+    targets maps each target class to the share of the moved land it
+    receives. The land use table is updated and the transition is recorded,
+    so it is applied to the land use cells when these are read. Returns the
+    updated land use table.
+    """
 
-    return datablock
+    transition = {"sources": sources,
+                  "targets": targets,
+                  "fraction": fraction,
+                  "grades": grades}
+
+    table = datablock["land"]["land_use_table"]
+    table = apply_transitions(table, table.alc_grade, [transition])
+
+    datablock["land"]["land_use_table"] = table
+    datablock["land"]["transitions"] = datablock["land"]["transitions"] + (transition,)
+
+    return table
 
 def feed_scale(fbs, ref):
     """Scales the feed, seed and processing quantities according to the change
     in production of animal and vegetal products"""
 
+    fbs = PackedFBS.from_xarray(fbs)
+    ref = PackedFBS.from_xarray(ref).broadcast_like(fbs)["production"]
+
+    animal = fbs.table.select("Item_origin", "Animal Products").positions
+    vegetal = fbs.table.select("Item_origin", "Vegetal Products").positions
+
     # Obtain reference production values
-    ref_feed_arr = ref["production"].sel(Item=ref.Item_origin=="Animal Products").sum(dim="Item")
-    ref_seed_arr = ref["production"].sel(Item=ref.Item_origin=="Vegetal Products").sum(dim="Item")
-    
+    ref_feed_arr = np.nansum(ref[..., animal, :], axis=-2, keepdims=True)
+    ref_seed_arr = np.nansum(ref[..., vegetal, :], axis=-2, keepdims=True)
+
     # Compute scaling factors for feed and seed based on proportional production
-    feed_scale = fbs["production"].sel(Item=fbs.Item_origin=="Animal Products").sum(dim="Item") \
-                / ref_feed_arr
-    seed_scale = fbs["production"].sel(Item=fbs.Item_origin=="Vegetal Products").sum(dim="Item") \
-                / ref_seed_arr
+    production = fbs["production"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        feed_scale = np.nansum(production[..., animal, :], axis=-2, keepdims=True) / ref_feed_arr
+        seed_scale = np.nansum(production[..., vegetal, :], axis=-2, keepdims=True) / ref_seed_arr
+        processing_scale = np.nansum(production, axis=-2, keepdims=True) \
+                         / np.nansum(ref, axis=-2, keepdims=True)
 
     # Set feed_scale and seed_scale to 1 where ref arrays are close or equal to zero
-    feed_scale = xr.where(np.isclose(ref_feed_arr, 0), 1, feed_scale)
-    feed_scale = xr.where(np.isclose(ref_seed_arr, 0), 1, seed_scale)
+    feed_scale = np.where(np.isclose(ref_feed_arr, 0), 1, feed_scale)
+    feed_scale = np.where(np.isclose(ref_seed_arr, 0), 1, seed_scale)
 
-    processing_scale = fbs["production"].sum(dim="Item") \
-                / ref["production"].sum(dim="Item")
-
-    out = fbs.fbs.scale_add(element_in="feed", element_out="production",
-                            scale=feed_scale)
+    out = fbs.scale_add(element_in="feed", element_out="production",
+                        scale=feed_scale)
     
-    out = out.fbs.scale_add(element_in="seed",element_out="production",
-                            scale=seed_scale)
+    out = out.scale_add(element_in="seed",element_out="production",
+                        scale=seed_scale)
     
-    out = out.fbs.scale_add(element_in="processing",element_out="production",
-                            scale=processing_scale)
+    out = out.scale_add(element_in="processing",element_out="production",
+                        scale=processing_scale)
     
-    return out
+    return out.to_xarray()
 
 def check_negative_source(fbs, source):
-    """Checks for negative values in the source element and adds the difference
-    to the fallback element"""
+    """Checks for negative values in the source element of a packed food
+    balance sheet and adds the difference to the fallback element"""
 
     if source == "production":
         fallback = "imports"
@@ -915,11 +1024,9 @@ def check_negative_source(fbs, source):
     elif source == "exports":
         fallback = "production"
 
-    delta_neg = fbs[source].where(fbs[source] < 0, other=0)
-    fbs[source] -= delta_neg
-    fbs[fallback] += delta_neg
-
-    return fbs
+    delta_neg = np.where(fbs[source] < 0, fbs[source], 0)
+    return fbs.assign({source: fbs[source] - delta_neg,
+                       fallback: fbs[fallback] + delta_neg})
 
 def logistic_food_supply(fbs, timescale, c_init, c_end):
     """Creates a logistic curve using the year range of the input food balance
@@ -930,6 +1037,60 @@ def logistic_food_supply(fbs, timescale, c_init, c_end):
     y2 = 2021 + timescale
     y3 = fbs.Year.values[-1]
 
-    scale = logistic_scale(y0, y1, y2, y3, c_init=c_init, c_end=c_end)
+    scale = adoption_curve("logistic", y0, y1, y2, y3, c_init=c_init, c_end=c_end)
+
+    return scale
+
+# Adoption curve shapes from agrifoodpy.utils.scaling, by name. Other shapes
+# can be added with the same signature, as long as they are linear in c_init
+# and c_end
+adoption_shapes = {"logistic": logistic_scale,
+                   "linear": linear_scale}
+
+@functools.lru_cache(maxsize=128)
+def adoption_basis(shape, y0, y1, y2, y3):
+    """Returns the normalised adoption curve of the given shape, going from 0
+    to 1 between y1 and y2, over the years from y0 to y3.
+
+    The curve is computed once for each shape and year range and returned as
+    a read only DataArray.
+    """
+
+    basis = adoption_shapes[shape](y0, y1, y2, y3, c_init=0, c_end=1)
+    basis.data.setflags(write=False)
+
+    return basis
+
+def adoption_curve(shape, y0, y1, y2, y3, c_init, c_end):
+    """Evaluates an adoption curve going from c_init to c_end between y1 and
+    y2, over the years from y0 to y3.
+
+    Adoption curves are linear in their start and end values, so the curve is
+    obtained by scaling the memoised basis of its shape. A curve from 0 to 1
+    is the read only basis itself.
+
+    c_init and c_end can be DataArrays with a Scenario dimension, in which
+    case the curve of every scenario is returned along that dimension.
+    """
+
+    basis = adoption_basis(shape, y0, y1, y2, y3)
+
+    # Scalar DataArrays can carry coordinates of the selections they come from
+    c_init, c_end = [c.to_numpy() if isinstance(c, xr.DataArray) and c.ndim == 0 else c
+                     for c in (c_init, c_end)]
+
+    if np.ndim(c_init) == 0 and np.ndim(c_end) == 0 and c_init == 0 and c_end == 1:
+        return basis
+
+    return c_init + (c_end - c_init) * basis
+
+def scenario_total(data):
+    """Sums data over all its dimensions except Scenario, dropping any scalar
+    coordinates left by selections"""
+
+    if "Scenario" not in data.dims:
+        total = data.sum()
+    else:
+        total = data.sum(dim=[dim for dim in data.dims if dim != "Scenario"])
 
-    return scale
\ No newline at end of file
+    return total.reset_coords(drop=True)
\ No newline at end of file
@@ -1,16 +1,24 @@
 import streamlit as st
 from streamlit_extras.bottom_container import bottom
-import matplotlib
-import matplotlib.pyplot as plt
-from matplotlib import colors
-import matplotlib.patches as mpatches
 from utils.altair_plots import *
 from agrifoodpy.food.food import FoodBalanceSheet
 from glossary import *
 from utils.helper_functions import *
+from utils.land_map import land_map_png, land_legend_html
+from utils.fbs import item_index
+from utils.result_cube import summary_map
+from datablock_setup import datablock as baseline
 
 
-def plots(datablock):
+def plots(run_food_system, summary=None):
+    """Displays the selected figure for the results of a pipeline run.
+
+    run_food_system is called without arguments to run the pipeline and
+    return its datablock, and is only called if the selected figure needs it.
+    summary can hold the precomputed Summary view metrics for the current
+    slider values, as returned by ResultCube.lookup, in which case the
+    Summary view is drawn from them without running the pipeline.
+    """
 
     # ----------------------------------------    
     #                  Plots
@@ -30,6 +38,9 @@ def plots(datablock):
         metric_year_toggle = st.toggle("Switch to 2100 mode")
         metric_yr = np.where(metric_year_toggle, 2100, 2050)
 
+    if plot_key != "Summary" or summary is None:
+        datablock = run_food_system()
+
     # Summary
     # -------
     if plot_key == "Summary":
@@ -79,11 +90,13 @@ def plots(datablock):
                            sequestration from agriculture and land use combined
                            </div>''', unsafe_allow_html=True)
                 
-                emissions = datablock["impact"]["g_co2e/year"]["production"].sel(Year=metric_yr)/1e6
-                emissions = emissions.fbs.group_sum(coordinate="Item_origin", new_name="Item")
-                seq_da = datablock["impact"]["co2e_sequestration"].sel(Year=metric_yr)
+                if summary is not None:
+                    balance = xr.concat([summary["emissions"], -summary["sequestration"]], dim="Item")
+                else:
+                    balance = datablock["metrics"]["net_emissions"]
+                balance = balance.sel(Year=metric_yr)
 
-                c = plot_single_bar_altair(xr.concat([emissions/1e6, -seq_da/1e6], dim="Item"), show="Item",
+                c = plot_single_bar_altair(balance/1e6, show="Item",
                                                 axis_title="Sequestration / Production emissions [M tCO2e]",
                                                 ax_min=-3e2, ax_max=3e2, unit="M tCO2e", vertical=True,
                                                 mark_total=True, show_zero=True, ax_ticks=True)
@@ -105,17 +118,15 @@ def plots(datablock):
                            produces more food than it needs
                            </div>''', unsafe_allow_html=True)
                 
-                SSR = datablock["food"]["g/cap/day"].fbs.SSR()
+                if summary is not None:
+                    SSR = summary["SSR"]
+                else:
+                    SSR = datablock["metrics"]["SSR"]["g/cap/day"]
                 SSR_metric_yr = SSR.sel(Year=metric_yr).to_numpy()
                 SSR_ref = SSR.sel(Year=2020).to_numpy()
 
                 st.metric(label="SSR", value="{:.2f} %".format(100*SSR_metric_yr),
                     delta="{:.2f} %".format(100*(SSR_metric_yr-SSR_ref)))
-                
-                SSR = datablock["food"]["g/cap/day"].fbs.SSR()
-
-                SSR_metric_yr = SSR.sel(Year=metric_yr).to_numpy()
-                SSR_ref = SSR.sel(Year=2020).to_numpy()
 
                 df = pd.DataFrame({"Item":["Low", "Mid", "High"],
                                 "variable":["SSR", "SSR", "SSR"],
@@ -200,32 +211,16 @@ def plots(datablock):
                            productive systems such as agroforestry and silvopasture.
                            </div>''', unsafe_allow_html=True)
 
-                f, plot1 = plt.subplots(1, figsize=(7, 7))
-                pctg = datablock["land"]["percentage_land_use"]
-                LC_toplot = map_max(pctg, dim="aggregate_class")
-
-                color_list = [land_color_dict[key] for key in pctg.aggregate_class.values]
-                label_list = [land_label_dict[key] for key in pctg.aggregate_class.values]
-
-                unique_index = np.unique(label_list, return_index=True)[1]
-
-                cmap_tar = colors.ListedColormap(color_list)
-                bounds_tar = np.linspace(-0.5, len(color_list)-0.5, len(color_list)+1)
-                norm_tar = colors.BoundaryNorm(bounds_tar, cmap_tar.N)
+                if summary is not None and "land_map" in summary:
+                    land_map = summary["land_map"]
+                else:
+                    land_map = land_map_png(run_food_system(), land_color_dict, **summary_map)
+                st.image(land_map, use_container_width=True)
 
-                plot1.imshow(LC_toplot, interpolation="none", origin="lower",
-                                cmap=cmap_tar, norm=norm_tar)
-                patches = [mpatches.Patch(color=color_list[i],
-                                            label=label_list[i]) for i in unique_index]
-
-                plot1.axis("off")
-                plot1.set_xlim(left=-100)
-                plot1.set_ylim(top=1000)
-
-                st.pyplot(f, use_container_width=True)
-
-                pctg = datablock["land"]["percentage_land_use"]
-                totals = pctg.sum(dim=["x", "y"])
+                if summary is not None:
+                    totals = summary["land"]
+                else:
+                    totals = datablock["metrics"]["land_totals"]
                 bar_land_use = plot_single_bar_altair(totals, show="aggregate_class",
                     axis_title="Land use [ha]", unit="Hectares", vertical=False,
                     color=land_color_dict, ax_ticks=True, bar_width=100)
@@ -244,8 +239,8 @@ def plots(datablock):
             y_key = st.selectbox("Food Supply Element", ["Emissions", "kCal/cap/day", "g/cap/day"])
 
         if y_key == "Emissions":
-            emissions = datablock["impact"]["g_co2e/year"].sel(Year=slice(None, metric_yr))
-            seq_da = datablock["impact"]["co2e_sequestration"].sel(Year=slice(None, metric_yr))
+            emissions = datablock["timeseries"]["impact"]["g_co2e/year"].sel(Year=slice(None, metric_yr))
+            seq_da = datablock["timeseries"]["impact"]["co2e_sequestration"].sel(Year=slice(None, metric_yr))
 
             if option_key == "Food origin":
                 f = plot_years_altair(emissions[element_key]/1e6, show="Item_origin", ylabel="t CO2e / Year")
@@ -262,7 +257,7 @@ def plots(datablock):
                                 ylabel="t CO2e / Year",
                                 color="black")
         else:
-            emissions = datablock["food"][y_key].sel(Year=slice(None, metric_yr))
+            emissions = datablock["timeseries"]["food"][y_key].sel(Year=slice(None, metric_yr))
 
             if option_key == "Food origin":
                 f = plot_years_altair(emissions[element_key]/1e6, show="Item_origin", ylabel=y_key)
@@ -279,11 +274,12 @@ def plots(datablock):
     # Emissions per food item from each group
     # ---------------------------------------
     elif plot_key == "CO2e emission per food item":
-        emissions = datablock["impact"]["g_co2e/year"].sel(Year=slice(None, metric_yr))
-        emissions_baseline = st.session_state["datablock_baseline"]["impact"]["g_co2e/year"]
+        emissions = datablock["timeseries"]["impact"]["g_co2e/year"].sel(Year=slice(None, metric_yr))
+        emissions_baseline = baseline["history"]["impact"]["g_co2e/year"]
+        items = item_index(emissions)
         col_opt, col_element = st.columns([1,1])
         with col_opt:
-            option_key = st.selectbox("Plot options", np.unique(emissions.Item_group.values))
+            option_key = st.selectbox("Plot options", items.labels("Item_group"))
         with col_element:
             element_key = st.selectbox("Food Supply Element", ["production", "food", "imports", "exports", "feed"])
 
@@ -291,7 +287,7 @@ def plots(datablock):
         #            emissions_baseline["food"].sel(
         #                Item=emissions_baseline["Item_group"] == option_key).sum(dim="Item"))
         
-        to_plot = emissions[element_key].sel(Item=emissions["Item_group"] == option_key)/1e6
+        to_plot = emissions[element_key].isel(Item=items.select("Item_group", option_key).positions)/1e6
 
         f = plot_years_altair(to_plot, show="Item_name", ylabel="t CO2e / Year")
         f = f.configure_axis(
@@ -336,7 +332,7 @@ def plots(datablock):
 
         option_key = st.selectbox("Plot options", ["g/cap/day", "kCal/cap/day", "g_prot/cap/day", "g_fat/cap/day"])
 
-        SSR = datablock["food"][option_key].fbs.SSR().sel(Year=slice(None, metric_yr)) * 100
+        SSR = datablock["metrics"]["SSR"][option_key].sel(Year=slice(None, metric_yr)) * 100
 
         f = plot_years_total(SSR, ylabel="Self-sufficiency ratio [%]").configure_axis(
                 labelFontSize=20,
@@ -348,33 +344,16 @@ def plots(datablock):
     # ----------------------------------------------
     elif plot_key == "Land":
 
-        f, plot1 = plt.subplots(1, figsize=(8,8))
-        pctg = datablock["land"]["percentage_land_use"]
-        LC_toplot = map_max(pctg, dim="aggregate_class")
-
-        color_list = [land_color_dict[key] for key in pctg.aggregate_class.values]
-        label_list = [land_label_dict[key] for key in pctg.aggregate_class.values]
-
-        unique_index = np.unique(label_list, return_index=True)[1]
-
-        cmap_tar = colors.ListedColormap(color_list)
-        bounds_tar = np.linspace(-0.5, len(color_list)-0.5, len(color_list)+1)
-        norm_tar = colors.BoundaryNorm(bounds_tar, cmap_tar.N)
-
-        plot1.imshow(LC_toplot, interpolation="none", origin="lower",
-                        cmap=cmap_tar, norm=norm_tar)
-        patches = [mpatches.Patch(color=color_list[i],
-                                    label=label_list[i]) for i in unique_index]
-        plot1.legend(handles=patches, loc="upper left")
-
-        plot1.axis("off")
-        plot1.set_xlim(left=-500)
+        land_map = land_map_png(datablock, land_color_dict, pad_left=500)
+        classes = datablock["land"]["land_use_table"].aggregate_class.values
 
         col2_1, col2_2, col2_3 = st.columns((3,2,2))
         with col2_1:
-            st.pyplot(fig=f)
+            st.markdown(land_legend_html(classes, land_color_dict, land_label_dict),
+                        unsafe_allow_html=True)
+            st.image(land_map)
         with col2_2:
-            land_pctg = pctg.sum(dim=["x", "y"])
+            land_pctg = datablock["metrics"]["land_totals"]
             pie = pie_chart_altair(land_pctg, show="aggregate_class")
             st.altair_chart(pie)
     
@@ -1,10 +1,11 @@
 import streamlit as st
 from streamlit_extras.bottom_container import bottom
 
+import os
+import functools
 import pandas as pd
-import copy
 
-from utils.pipeline import Pipeline
+from utils.profiling import profile_to_json, profile_to_chrome_trace
 import utils.custom_widgets as cw
 from utils.altair_plots import *
 from utils.helper_functions import *
@@ -13,7 +14,11 @@ from glossary import *
 from scenarios import call_scenarios, scenarios_dict
 
 from datablock_setup import *
+from datablock_setup import datablock as baseline
 from model import *
+from food_system import build_food_system, default_advanced
+from utils.result_cube import ResultCube, cube_version
+from utils.tooltips import tooltip_provider
 
 from agrifoodpy.land import land
 
@@ -23,8 +28,16 @@ def first_run_dialog(width="large"):
     if st.button("OK", type="primary"):
         st.rerun()
 
-if "datablock_baseline" not in st.session_state:
-    st.session_state["datablock_baseline"] = datablock
+@st.cache_resource
+def load_result_cube(path="result_cube"):
+    """Opens the precomputed Summary metrics, if they have been built for the
+    current code and data"""
+    if not os.path.exists(os.path.join(path, "manifest.json")):
+        return None
+    result_cube = ResultCube(path)
+    if result_cube.version != cube_version():
+        return None
+    return result_cube
 
 if "first_run" not in st.session_state:
     st.session_state["first_run"] = True
@@ -32,7 +45,7 @@ if "first_run" not in st.session_state:
 # ------------------------
 # Help and tooltip strings
 # ------------------------
-help = pd.read_csv(st.secrets["tooltips_url"], dtype='string')
+help = tooltip_provider(st.secrets["tooltips_url"]).get()
 
 # GUI
 st.set_page_config(layout='wide',
@@ -74,27 +87,27 @@ with st.sidebar:
         
         dairy = st.slider('Reduce dairy consumption',
                         min_value=0, max_value=100, step=25,
-                        key="dairy", help=help["sidebar_consumer"][2])
+                        key="dairy", help=help_str(help, "sidebar_consumer", 2))
         
         pig_poultry_eggs = st.slider('Reduce pig, poultry and eggs consumption',
                         min_value=0, max_value=100, step=25,
-                        key="pig_poultry_eggs", help=help["sidebar_consumer"][3])
+                        key="pig_poultry_eggs", help=help_str(help, "sidebar_consumer", 3))
         
         fruit_veg = st.slider('Increase fruit and vegetable consumption',
                         min_value=0, max_value=100, step=25,
-                        key="fruit_veg", help=help["sidebar_consumer"][4])
+                        key="fruit_veg", help=help_str(help, "sidebar_consumer", 4))
         
         cereals = st.slider('Increase cereal consumption',
                         min_value=0, max_value=100, step=25,
-                        key="cereals", help=help["sidebar_consumer"][5])
+                        key="cereals", help=help_str(help, "sidebar_consumer", 5))
 
         waste = st.slider('Food waste and over-eating reduction',
                         min_value=0, max_value=100, step=25,
-                        key="waste", help=help["sidebar_consumer"][6])
+                        key="waste", help=help_str(help, "sidebar_consumer", 6))
 
         labmeat = st.slider('Increase cultured meat uptake',
                         min_value=0, max_value=100, step=25,
-                        key="labmeat", help=help["sidebar_consumer"][7])       
+                        key="labmeat", help=help_str(help, "sidebar_consumer", 7))       
 
         st.button("Reset", on_click=reset_sliders, key='reset_consumer',
                   kwargs={"keys": [consumer_slider_keys, "consumer_bar"]})
@@ -107,19 +120,19 @@ with st.sidebar:
 
         pasture_sparing = st.slider('Spared pasture land fraction',
                         min_value=0, max_value=100, step=25,
-                        key="pasture_sparing", help=help["sidebar_land"][0])        
+                        key="pasture_sparing", help=help_str(help, "sidebar_land", 0))        
 
         arable_sparing = st.slider('Spared arable land fraction',
                         min_value=0, max_value=100, step=25,
-                        key="arable_sparing", help=help["sidebar_land"][1])
+                        key="arable_sparing", help=help_str(help, "sidebar_land", 1))
 
         land_BECCS = st.slider('Percentage of farmland used for BECCS crops',
                         min_value=0, max_value=20, step=5,
-                        key="land_beccs", help=help["sidebar_innovation"][2])
+                        key="land_beccs", help=help_str(help, "sidebar_innovation", 2))
 
         foresting_spared = st.slider('Forested spared land fraction',
                         min_value=0, max_value=100, step=25,
-                        key="foresting_spared", help=help["sidebar_land"][2])
+                        key="foresting_spared", help=help_str(help, "sidebar_land", 2))
         
         st.button("Reset", on_click=reset_sliders, key='reset_land',
                   kwargs={"keys":[land_slider_keys, "land_bar"]})
@@ -136,23 +149,23 @@ with st.sidebar:
         
         silvopasture = st.slider('Pasture land % converted to silvopasture',
                         min_value=0, max_value=100, step=25,
-                        key='silvopasture', help=help["sidebar_land"][3])        
+                        key='silvopasture', help=help_str(help, "sidebar_land", 3))        
         
         methane_inhibitor = st.slider('Methane inhibitor use in livestock feed',
                         min_value=0, max_value=100, step=25,
-                        key='methane_inhibitor', help=help["sidebar_livestock"][0])
+                        key='methane_inhibitor', help=help_str(help, "sidebar_livestock", 0))
         
         manure_management = st.slider('Manure management in livestock farming',
                         min_value=0, max_value=100, step=25,
-                        key='manure_management', help=help["sidebar_livestock"][1])
+                        key='manure_management', help=help_str(help, "sidebar_livestock", 1))
         
         animal_breeding = st.slider('Livestock breeding',
                         min_value=0, max_value=100, step=25,
-                        key='animal_breeding', help=help["sidebar_livestock"][2])
+                        key='animal_breeding', help=help_str(help, "sidebar_livestock", 2))
         
         fossil_livestock = st.slider('Fossil fuel use for heating, machinery',
                         min_value=0, max_value=100, step=25,
-                        key='fossil_livestock', help=help["sidebar_livestock"][4])
+                        key='fossil_livestock', help=help_str(help, "sidebar_livestock", 4))
         
 
         st.button("Reset", on_click=reset_sliders, key='reset_livestock',
@@ -166,11 +179,11 @@ with st.sidebar:
         
         agroforestry = st.slider('Arable land % converted to agroforestry',
                         min_value=0, max_value=100, step=25,
-                        key='agroforestry', help=help["sidebar_land"][4])
+                        key='agroforestry', help=help_str(help, "sidebar_land", 4))
 
         fossil_arable = st.slider('Fossil fuel use for machinery',
                         min_value=0, max_value=100, step=25,
-                        key='fossil_arable', help=help["sidebar_arable"][1])
+                        key='fossil_arable', help=help_str(help, "sidebar_arable", 1))
                         
         st.button("Reset", on_click=reset_sliders, key='reset_arable',
             kwargs={"keys": [arable_slider_keys, "arable_bar"]})        
@@ -183,15 +196,15 @@ with st.sidebar:
 
         waste_BECCS = st.slider('BECCS sequestration from waste \n [Mt CO2e / yr]',
                         min_value=0, max_value=100, step=25,
-                        key='waste_BECCS', help=help["sidebar_innovation"][0])
+                        key='waste_BECCS', help=help_str(help, "sidebar_innovation", 0))
 
         overseas_BECCS = st.slider('BECCS sequestration from overseas biomass \n [Mt CO2e / yr]',
                         min_value=0, max_value=100, step=25,
-                        key='overseas_BECCS', help=help["sidebar_innovation"][1])
+                        key='overseas_BECCS', help=help_str(help, "sidebar_innovation", 1))
 
         DACCS = st.slider('DACCS sequestration \n [Mt CO2e / yr]',
                         min_value=0, max_value=20, step=5,
-                        key='DACCS', help=help["sidebar_innovation"][3])
+                        key='DACCS', help=help_str(help, "sidebar_innovation", 3))
 
         st.button("Reset", on_click=reset_sliders, key='reset_technology',
                   kwargs={"keys": [technology_slider_keys, "innovation_bar"]})
@@ -216,7 +229,7 @@ with st.sidebar:
                                         ('g/cap/day', 'g_prot/cap/day', 'g_fat/cap/day', 'kCal/cap/day'),
                                         horizontal=True,
                                         index=3,
-                                        help=help["advanced_options"][9],
+                                        help=help_str(help, "advanced_options", 9),
                                         key='nutrient_constant')
             
             st.button("Reset", on_click=update_slider,
@@ -252,151 +265,74 @@ with col1:
     #                  Main
     # ----------------------------------------
 
-    datablock = copy.deepcopy(st.session_state["datablock_baseline"])
-    food_system = Pipeline(datablock)
-
-    # Global parameters
-    food_system.datablock_write(["global_parameters", "timescale"], advs["n_scale"]["value"])
-
-    # Consumer demand
-    food_system.add_step(project_future,
-                         {"scale":proj_pop})
-    
-    food_system.add_step(item_scaling,
-                         {"scale":1-ruminant/100,
-                          "items":[2731, 2732],
-                          "source":["production", "imports"],
-                          "elasticity":[advs["elasticity"]["value"], 1-advs["elasticity"]["value"]],
-                          "scaling_nutrient":scaling_nutrient})
-    
-    food_system.add_step(item_scaling,
-                         {"scale":1-pig_poultry_eggs/100,
-                          "items":[2733, 2734, 2949],
-                          "source":["production", "imports"],
-                          "elasticity":[advs["elasticity"]["value"], 1-advs["elasticity"]["value"]],
-                          "scaling_nutrient":scaling_nutrient})
-    
-    food_system.add_step(item_scaling,
-                         {"scale":1-dairy/100,
-                          "items":[2740, 2743, 2948],
-                          "source":["production", "imports"],
-                          "elasticity":[advs["elasticity"]["value"], 1-advs["elasticity"]["value"]],
-                          "scaling_nutrient":scaling_nutrient})
-    
-    food_system.add_step(item_scaling,
-                         {"scale":1+fruit_veg/100,
-                          "item_group":["Vegetables", "Fruits - Excluding Wine"],
-                          "source":["production", "imports"],
-                          "elasticity":[advs["elasticity"]["value"], 1-advs["elasticity"]["value"]],
-                          "scaling_nutrient":scaling_nutrient})
-    
-    food_system.add_step(item_scaling,
-                         {"scale":1+cereals/100,
-                          "item_group":["Cereals - Excluding Beer"],
-                          "source":["production", "imports"],
-                          "elasticity":[advs["elasticity"]["value"], 1-advs["elasticity"]["value"]],
-                          "scaling_nutrient":scaling_nutrient})
-    
-    food_system.add_step(food_waste_model,
-                         {"waste_scale":waste,
-                          "kcal_rda":advs["rda_kcal"]["value"],
-                          "source":"imports"})
-
-    food_system.add_step(cultured_meat_model,
-                         {"cultured_scale":labmeat/100,
-                          "labmeat_co2e":advs["labmeat_co2e"]["value"],
-                          "source":"production"})
-    
-    # Land management
-    food_system.add_step(spare_alc_model,
-                         {"spare_fraction":pasture_sparing/100,
-                          "land_type":["Improved grassland", "Semi-natural grassland"],
-                          "items":"Animal Products"})
-    
-    food_system.add_step(spare_alc_model,
-                         {"spare_fraction":arable_sparing/100,
-                          "land_type":["Arable"],
-                          "items":"Vegetal Products"})
-    
-    food_system.add_step(foresting_spared_model,
-                         {"forest_fraction":foresting_spared/100,
-                          "bdleaf_conif_ratio":advs["bdleaf_conif_ratio"]["value"]/100})
-    
-    food_system.add_step(BECCS_farm_land,
-                         {"farm_percentage":land_BECCS/100})
-    
-    # Livestock farming practices        
-    food_system.add_step(agroecology_model,
-                         {"land_percentage":silvopasture/100.,
-                          "agroecology_class":"Silvopasture",
-                          "land_type":["Improved grassland", "Semi-natural grassland"],
-                          "tree_coverage":advs["agroecology_tree_coverage"]["value"],
-                          "replaced_items":[2731, 2732],
-                          "new_items":2617,
-                          "item_yield":1e2})
-    
-    food_system.add_step(scale_impact,
-                         {"items":[2731, 2732],
-                          "scale_factor":1 - advs["methane_ghg_factor"]["value"]*methane_inhibitor/100})
-    
-    food_system.add_step(scale_production,
-                         {"scale_factor":1-advs["methane_prod_factor"]["value"]*methane_inhibitor/100,
-                          "items":[2731, 2732]})
-    
-    food_system.add_step(scale_impact,
-                         {"items":[2731, 2732],
-                          "scale_factor":1 - advs["manure_ghg_factor"]["value"]*manure_management/100})
-    
-    food_system.add_step(scale_production,
-                         {"scale_factor":1-advs["manure_prod_factor"]["value"]*manure_management/100,
-                          "items":[2731, 2732]})
-    
-    food_system.add_step(scale_impact,
-                         {"items":[2731, 2732],
-                          "scale_factor":1 - advs["breeding_ghg_factor"]["value"]*animal_breeding/100})
-    
-    food_system.add_step(scale_production,
-                         {"scale_factor":1-advs["breeding_prod_factor"]["value"]*animal_breeding/100,
-                          "items":[2731, 2732]})
-
-    # Arable farming practices
-    food_system.add_step(agroecology_model,
-                         {"land_percentage":agroforestry/100.,
-                          "agroecology_class":"Agroforestry",
-                          "land_type":["Arable"],
-                          "tree_coverage":advs["agroecology_tree_coverage"]["value"],
-                          "replaced_items":2511,
-                          "new_items":2617,
-                          "item_yield":1e2})
-    
-    food_system.add_step(scale_impact,
-                         {"item_origin":"Vegetal Products",
-                          "scale_factor":1 - advs["fossil_arable_ghg_factor"]["value"]*fossil_arable/100})
-    
-    food_system.add_step(scale_production,
-                         {"scale_factor":1 - advs["fossil_arable_prod_factor"]["value"]*fossil_arable/100,
-                          "item_origin":"Vegetal Products"})
-    
-    # Technology & Innovation    
-    food_system.add_step(ccs_model,
-                         {"waste_BECCS":waste_BECCS*1e6,
-                          "overseas_BECCS":overseas_BECCS*1e6,
-                          "DACCS":DACCS*1e6})
-
-    
-    # Compute emissions and sequestration
-    food_system.add_step(forest_sequestration_model,
-                         {"seq_broadleaf_ha_yr":advs["bdleaf_seq_ha_yr"]["value"],
-                          "seq_coniferous_ha_yr":advs["conif_seq_ha_yr"]["value"]})
-
-    food_system.add_step(compute_emissions)
-
-    food_system.run()
-
-    datablock = food_system.datablock
+    sliders = {"ruminant": ruminant,
+               "dairy": dairy,
+               "pig_poultry_eggs": pig_poultry_eggs,
+               "fruit_veg": fruit_veg,
+               "cereals": cereals,
+               "waste": waste,
+               "labmeat": labmeat,
+               "pasture_sparing": pasture_sparing,
+               "arable_sparing": arable_sparing,
+               "land_beccs": land_BECCS,
+               "foresting_spared": foresting_spared,
+               "silvopasture": silvopasture,
+               "methane_inhibitor": methane_inhibitor,
+               "manure_management": manure_management,
+               "animal_breeding": animal_breeding,
+               "fossil_livestock": fossil_livestock,
+               "agroforestry": agroforestry,
+               "fossil_arable": fossil_arable,
+               "waste_BECCS": waste_BECCS,
+               "overseas_BECCS": overseas_BECCS,
+               "DACCS": DACCS}
+
+    # Summary metrics are read from the result cube when the sliders match
+    # one of its points and the advanced settings are at their defaults.
+    # Other slider combinations always run the pipeline
+    advanced = {label: params["value"] for label, params in advs.items()}
+    summary = None
+    result_cube = load_result_cube()
+    if result_cube is not None and advanced == default_advanced() \
+            and scaling_nutrient == "kCal/cap/day":
+        summary = result_cube.lookup(sliders)
+
+    # Adding ?profile to the URL profiles the steps of a single rerun
+    profile = "profile" in st.query_params
+
+    # The pipeline is only run when the selected view needs its results. It
+    # branches the baseline and reuses cached step outputs, so only the steps
+    # after the first changed slider are recomputed
+    @functools.cache
+    def run_food_system():
+        food_system = build_food_system(baseline,
+                                        population_scale=proj_pop,
+                                        sliders=sliders,
+                                        advanced=advanced,
+                                        scaling_nutrient=scaling_nutrient)
+        food_system.run(profile=profile)
+
+        if profile:
+            del st.query_params["profile"]
+            col_json, col_trace = st.columns(2)
+            with col_json:
+                st.download_button("Download step profile",
+                                   profile_to_json(food_system.profile),
+                                   file_name="pipeline_profile.json",
+                                   mime="application/json")
+            with col_trace:
+                st.download_button("Download Perfetto trace",
+                                   profile_to_chrome_trace(food_system.profile),
+                                   file_name="pipeline_trace.json",
+                                   mime="application/json")
+
+        return food_system.datablock
+
+    if profile:
+        run_food_system()
 
     # -------------------
     # Execute plots block
     # -------------------
     from plots import plots
-    metric_yr = plots(datablock)
+    metric_yr = plots(run_food_system, summary=summary)
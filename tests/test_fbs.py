@@ -0,0 +1,205 @@
+"""Regression tests of the packed food balance sheet kernels against plain
+xarray implementations of the same operations"""
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from utils.fbs import PackedFBS, Selection, item_index
+
+elements = ["production", "imports", "exports", "food", "feed"]
+items = [2511, 2513, 2617, 2731, 2732]
+years = [2019, 2020, 2021, 2022]
+
+@pytest.fixture
+def fbs():
+    rng = np.random.default_rng(0)
+    values = rng.uniform(1, 10, (len(elements), len(items), len(years)))
+    values[0, 1, 2] = np.nan
+    values[3, 4, 0] = np.nan
+    values[1, 2, :] = 0
+
+    return xr.Dataset({element: (("Item", "Year"), values[e])
+                       for e, element in enumerate(elements)},
+                      coords={"Item": items,
+                              "Year": years,
+                              "Item_name": ("Item", ["Wheat", "Barley", "Beer",
+                                                     "Bovine Meat", "Mutton"]),
+                              "Item_group": ("Item", ["Cereals", "Cereals", "Beverages",
+                                                      "Meat", "Meat"]),
+                              "Item_origin": ("Item", ["Vegetal Products"] * 3
+                                                      + ["Animal Products"] * 2)})
+
+@pytest.fixture
+def scenario_scale():
+    return xr.DataArray([[0.5, 0.8, 1.0, 1.2], [1.0, 1.0, 1.5, 2.0]],
+                        dims=("Scenario", "Year"),
+                        coords={"Scenario": ["low", "high"], "Year": years})
+
+def reference_scale_add(fbs, element_in, element_out, scale, items=None, add=True,
+                        elasticity=None):
+    # Same operation as FoodBalanceSheet.scale_add, on the xarray Dataset
+    if np.isscalar(element_out):
+        element_out = [element_out]
+    if np.isscalar(add):
+        add = [add] * len(element_out)
+    if elasticity is None:
+        elasticity = [1.0/len(element_out)] * len(element_out)
+
+    selected = fbs.Item.isin(fbs.Item.values if items is None else items)
+
+    out = fbs.copy()
+    out[element_in] = xr.where(selected, fbs[element_in] * scale, fbs[element_in])
+    dif = fbs[element_in].fillna(0) - out[element_in].fillna(0)
+    for element, add_el, elast in zip(element_out, add, elasticity):
+        out[element] = out[element] + np.where(add_el, -1, 1) * dif * elast
+
+    return out
+
+def assert_sheets_equal(packed, expected):
+    actual = packed.to_xarray()
+    for element in expected.data_vars:
+        expected_el = expected[element].broadcast_like(actual[element])
+        expected_el = expected_el.transpose(*actual[element].dims)
+        np.testing.assert_allclose(actual[element].values, expected_el.values,
+                                   rtol=1e-14, equal_nan=True)
+    for dim in actual[list(expected.data_vars)[0]].dims:
+        np.testing.assert_array_equal(actual[dim].values, expected[dim].values)
+
+def test_round_trip(fbs):
+    packed = PackedFBS.from_xarray(fbs)
+    unpacked = packed.to_xarray()
+
+    xr.testing.assert_identical(unpacked, fbs)
+    assert PackedFBS.from_xarray(unpacked) is packed
+
+    # Replacing a variable of the unpacked sheet packs it again
+    unpacked["food"] = unpacked["food"] * 2
+    repacked = PackedFBS.from_xarray(unpacked)
+    assert repacked is not packed
+    np.testing.assert_array_equal(repacked["food"], fbs["food"].values * 2)
+
+def test_round_trip_scenario(fbs, scenario_scale):
+    fbs = fbs.assign(food=fbs["food"] * scenario_scale)
+    unpacked = PackedFBS.from_xarray(fbs).to_xarray()
+
+    assert unpacked["food"].dims == fbs["food"].dims
+    xr.testing.assert_identical(unpacked["food"], fbs["food"])
+    xr.testing.assert_equal(unpacked["imports"],
+                            fbs["imports"].broadcast_like(fbs["food"]).transpose(*fbs["food"].dims))
+
+def test_values_read_only(fbs):
+    packed = PackedFBS.from_xarray(fbs)
+
+    with pytest.raises(ValueError):
+        packed.values[0, 0, 0] = 1
+    with pytest.raises(ValueError):
+        packed.to_xarray()["food"].values[0, 0] = 1
+
+@pytest.mark.parametrize("scale, kwargs", [
+    (0.5, {"element_in": "production", "element_out": "imports", "add": False}),
+    (1.5, {"element_in": "food", "element_out": ["imports", "exports"],
+           "add": [True, False], "elasticity": [0.25, 0.75]}),
+    (0.8, {"element_in": "production", "element_out": "imports",
+           "items": [2731, 2732], "add": False}),
+    (xr.DataArray([1.0, 0.9, 0.8, 0.5], dims="Year", coords={"Year": years}),
+     {"element_in": "food", "element_out": "production", "items": [2513, 2617]}),
+])
+def test_scale_add(fbs, scale, kwargs):
+    packed = PackedFBS.from_xarray(fbs).scale_add(scale=scale, **kwargs)
+    assert_sheets_equal(packed, reference_scale_add(fbs, scale=scale, **kwargs))
+
+def test_scale_add_scenario(fbs, scenario_scale):
+    packed = PackedFBS.from_xarray(fbs).scale_add("food", ["imports", "production"],
+                                                  scenario_scale, items=[2511, 2731])
+    expected = reference_scale_add(fbs, "food", ["imports", "production"],
+                                   scenario_scale, items=[2511, 2731])
+
+    assert packed.dims == ("Scenario",)
+    assert_sheets_equal(packed, expected)
+
+def test_scale_add_selection(fbs):
+    packed = PackedFBS.from_xarray(fbs)
+    selection = packed.table.select("Item_origin", "Animal Products")
+
+    np.testing.assert_array_equal(
+        packed.scale_add("production", "imports", 0.5, items=selection, add=False).values,
+        packed.scale_add("production", "imports", 0.5, items=[2731, 2732], add=False).values)
+
+def test_rescale(fbs, scenario_scale):
+    orig = PackedFBS.from_xarray(fbs)
+    out = orig.scale_add("food", "imports", scenario_scale, items=[2617, 2731])
+
+    other = fbs * 3
+    rescaled = PackedFBS.from_xarray(other).rescale(out, orig)
+
+    ratio = out.to_xarray() / fbs
+    expected = other * ratio.where(~np.isnan(ratio), 1)
+    assert_sheets_equal(rescaled, expected)
+
+def test_group_sum(fbs):
+    grouped = PackedFBS.from_xarray(fbs).group_sum("Item_origin").to_xarray()
+    expected = fbs.fillna(0).groupby("Item_origin").sum().rename(Item_origin="Item")
+
+    xr.testing.assert_allclose(grouped, expected.transpose("Item", "Year"), rtol=1e-14)
+
+def test_ssr(fbs, scenario_scale):
+    fbs = fbs.assign(imports=fbs["imports"] * scenario_scale)
+
+    ssr = PackedFBS.from_xarray(fbs).ssr()
+    domestic_use = fbs["production"] + fbs["imports"] - fbs["exports"]
+    expected = fbs["production"].sum("Item") / domestic_use.sum("Item")
+
+    xr.testing.assert_allclose(ssr, expected.transpose(*ssr.dims), rtol=1e-14)
+
+def test_project(fbs):
+    projected = PackedFBS.from_xarray(fbs).project([2023, 2024, 2025]).to_xarray()
+    expected = fbs.isel(Year=-1, drop=True).expand_dims(Year=[2023, 2024, 2025], axis=-1)
+
+    xr.testing.assert_identical(projected, expected)
+
+def test_add_item(fbs):
+    added = PackedFBS.from_xarray(fbs).add_item(5000, Item_name="Cultured meat",
+                                                Item_origin="Cultured Products")
+    unpacked = added.to_xarray()
+
+    xr.testing.assert_identical(unpacked.isel(Item=slice(None, -1)), fbs)
+    new = unpacked.sel(Item=5000)
+    assert all((new[element] == 0).all() for element in elements)
+    assert new.Item_name.item() == "Cultured meat"
+    assert new.Item_origin.item() == "Cultured Products"
+    assert new.Item_group.item() == fbs.Item_group.values[0]
+
+def test_select(fbs):
+    table = item_index(fbs)
+
+    for coordinate, labels in [("Item", [2731, 2511]),
+                               ("Item_group", "Cereals"),
+                               ("Item_origin", ["Animal Products", "Missing"])]:
+        selection = table.select(coordinate, labels)
+        mask = fbs[coordinate].isin(np.atleast_1d(labels)).values
+
+        assert isinstance(selection, Selection)
+        np.testing.assert_array_equal(selection.mask, mask)
+        np.testing.assert_array_equal(selection.positions, np.flatnonzero(mask))
+        np.testing.assert_array_equal(selection.inverse().positions, np.flatnonzero(~mask))
+
+    assert table.select("Item_group", "Cereals") is table.select("Item_group", ["Cereals"])
+    assert item_index(fbs.copy()) is table
+
+def test_item_index_cache(fbs):
+    table = item_index(fbs)
+
+    assert item_index(fbs["food"]) is table
+    assert item_index(fbs * 2) is table
+    assert PackedFBS.from_xarray(fbs, ["food"]).table is table
+
+    # Changed labels give the table of the new coordinates
+    relabelled = fbs.assign_coords(Item_group=("Item", ["Cereals"] * 5))
+    assert item_index(relabelled) is not table
+    np.testing.assert_array_equal(item_index(relabelled).select("Item_group", "Cereals").positions,
+                                  np.arange(5))
+
+    # Sheets unpacked from a packed sheet share its table
+    added = PackedFBS.from_xarray(fbs).add_item(5000)
+    assert item_index(added.to_xarray()["food"]) is added.table
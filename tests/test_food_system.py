@@ -0,0 +1,21 @@
+"""Tests of the sliders read by the food system pipeline"""
+
+import pytest
+
+pytest.importorskip("agrifoodpy")
+
+from food_system import build_food_system, default_sliders, pipeline_slider_keys, slider_keys
+
+def step_params(sliders):
+    food_system = build_food_system({}, None, sliders=sliders)
+    return [(func, params) for func, params, _, _ in food_system.steps]
+
+def test_pipeline_slider_keys():
+    defaults = default_sliders()
+    baseline = step_params(defaults)
+
+    # Only the sliders in pipeline_slider_keys change the steps
+    read = [key for key in slider_keys
+            if step_params({key: defaults[key] + 10}) != baseline]
+
+    assert read == pipeline_slider_keys
@@ -0,0 +1,112 @@
+"""Tests of the composed land transitions against their step by step
+application"""
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from utils.land import apply_transitions
+
+classes = ["Arable", "Improved grassland", "Semi-natural grassland"]
+
+@pytest.fixture
+def land():
+    values = np.array([[40., 30., 20., 50., np.nan, 10.],
+                       [30., np.nan, 50., 25., 60., 70.],
+                       [30., 70., np.nan, 25., 40., 20.]])
+
+    return xr.DataArray(values, dims=("aggregate_class", "cell"),
+                        coords={"aggregate_class": classes, "cell": np.arange(6)},
+                        name="percentage_land_use")
+
+@pytest.fixture
+def grade():
+    return xr.DataArray([1., 2., 3., np.nan, 1., 2.], dims="cell")
+
+def reference(land, grade, transitions):
+    # Applies the transitions one at a time, as the land steps did on the
+    # cells before they were composed
+    names = list(land.aggregate_class.values)
+    fractions = [np.asarray(getattr(t["fraction"], "values", t["fraction"])).reshape(-1)
+                 for t in transitions]
+    scenarios = max(len(fraction) for fraction in fractions)
+    values = np.repeat(land.values[None], scenarios, axis=0)
+
+    grades = np.nan_to_num(grade.values)
+    for transition, fraction in zip(transitions, fractions):
+        fraction = np.broadcast_to(fraction, (scenarios,))
+
+        for target in transition["targets"]:
+            if target not in names:
+                names.append(target)
+                first = values[:, :1]
+                values = np.concatenate([values, np.where(np.isfinite(first), 0., np.nan)], axis=1)
+
+        values = values.copy()
+        applies = np.ones(len(grades), dtype=bool) if transition.get("grades") is None \
+                  else np.isin(grades, transition["grades"])
+        for s in range(values.shape[0]):
+            moved = np.zeros(values.shape[-1])
+            for source in np.atleast_1d(transition["sources"]):
+                delta = np.where(applies, values[s, names.index(source)] * fraction[s], 0)
+                values[s, names.index(source)] -= delta
+                moved += np.nan_to_num(delta)
+            for target, share in transition["targets"].items():
+                values[s, names.index(target)] += share * moved
+
+    return names, values
+
+def transition(sources, targets, fraction, grades=None):
+    return {"sources": sources, "targets": targets, "fraction": fraction, "grades": grades}
+
+chains = [
+    [transition(["Arable"], {"Spared": 1}, 0.5)],
+    [transition(["Arable"], {"Spared": 1}, 0.5, grades=[1, 2]),
+     transition("Spared", {"Broadleaf woodland": 0.25, "Coniferous woodland": 0.75}, 0.4)],
+    [transition(["Improved grassland", "Semi-natural grassland"], {"Silvopasture": 1}, 0.3),
+     transition(["Arable"], {"BECCS": 1}, 0.1, grades=[3]),
+     transition(["Arable"], {"Agroforestry": 1}, 0.2)],
+    # Land moved through classes without data in some cells
+    [transition(["Arable"], {"Improved grassland": 1}, 0.5),
+     transition(["Improved grassland"], {"Semi-natural grassland": 1}, 0.5),
+     transition(["Semi-natural grassland"], {"Arable": 1}, 0.5, grades=[0, 2])],
+]
+
+@pytest.mark.parametrize("transitions", chains)
+def test_composed_matches_step_by_step(land, grade, transitions):
+    out = apply_transitions(land, grade, transitions)
+    names, expected = reference(land, grade, transitions)
+
+    assert list(out.aggregate_class.values) == names
+    np.testing.assert_allclose(out.values, expected[0], rtol=1e-12, equal_nan=True)
+
+    # Applying the transitions one at a time gives the same result
+    stepped = land
+    for step in transitions:
+        stepped = apply_transitions(stepped, grade, [step])
+    xr.testing.assert_allclose(out, stepped, rtol=1e-12)
+
+def test_scenario_fractions(land, grade):
+    fraction = xr.DataArray([0.2, 0.6], dims="Scenario", coords={"Scenario": ["a", "b"]})
+    transitions = [transition(["Arable"], {"Spared": 1}, fraction),
+                   transition(["Spared", "Improved grassland"], {"Broadleaf woodland": 1}, 0.5,
+                              grades=[2])]
+
+    out = apply_transitions(land, grade, transitions)
+    names, expected = reference(land, grade, transitions)
+
+    assert out.dims == ("Scenario", "aggregate_class", "cell")
+    np.testing.assert_allclose(out.values, expected, rtol=1e-12, equal_nan=True)
+
+def test_land_use_table(land, grade):
+    # Transitions applied to the totals by grade match the totals of the
+    # cells, if every class has data in every cell
+    land = land.fillna(5.)
+    table = land.groupby(grade.fillna(0).rename("alc_grade")).sum()
+    transitions = chains[2]
+
+    cells = apply_transitions(land, grade, transitions)
+    totals = apply_transitions(table, table.alc_grade, transitions)
+
+    expected = cells.groupby(grade.fillna(0).rename("alc_grade")).sum()
+    xr.testing.assert_allclose(totals, expected.transpose(*totals.dims))
@@ -0,0 +1,82 @@
+"""Tests of the fused consumer demand step against the chain of item_scaling
+steps it replaces"""
+
+import operator
+
+import numpy as np
+import pytest
+import xarray as xr
+
+pytest.importorskip("agrifoodpy")
+
+from model import consumer_demand_model, item_scaling
+from utils.pipeline import Datablock, Derived
+
+elements = ["production", "imports", "exports", "stock", "feed", "seed",
+            "processing", "food"]
+items = [2511, 2514, 2601, 2611, 2731, 2732, 2733, 2734, 2740, 2743, 2948, 2949]
+groups = ["Cereals - Excluding Beer"] * 2 + ["Vegetables", "Fruits - Excluding Wine"] \
+       + ["Meat"] * 4 + ["Milk - Excluding Butter"] * 3 + ["Eggs"]
+origins = ["Vegetal Products"] * 4 + ["Animal Products"] * 8
+years = np.arange(2018, 2031)
+
+@pytest.fixture
+def datablock():
+    rng = np.random.default_rng(1)
+    values = rng.uniform(1, 50, (len(elements), len(items), len(years)))
+    # Small and zero imports, which are set to zero by the reductions and
+    # increased again by later targets
+    values[1, [4, 6, 9]] = rng.uniform(0, 0.5, (3, len(years)))
+    values[1, [5, 10]] = 0
+
+    g_cap_day = xr.Dataset({element: (("Item", "Year"), values[e])
+                            for e, element in enumerate(elements)},
+                           coords={"Item": items,
+                                   "Year": years,
+                                   "Item_group": ("Item", groups),
+                                   "Item_origin": ("Item", origins)})
+    kcal_g_food = xr.DataArray(rng.uniform(0.5, 4, len(items)), dims="Item",
+                               coords={"Item": items})
+    kcal_g_food[3] = 0
+
+    return {"global_parameters": {"timescale": 5},
+            "food": {"g/cap/day": g_cap_day,
+                     "kCal/g_food": kcal_g_food,
+                     "kCal/cap/day": Derived(operator.mul, ("food", "g/cap/day"),
+                                             ("food", "kCal/g_food"))}}
+
+def targets(ruminant, pig_poultry_eggs, dairy, fruit_veg, cereals):
+    # Consumption targets of build_food_system
+    return [{"scale": 1-ruminant/100, "items": [2731, 2732]},
+            {"scale": 1-pig_poultry_eggs/100, "items": [2733, 2734, 2949]},
+            {"scale": 1-dairy/100, "items": [2740, 2743, 2948]},
+            {"scale": 1+fruit_veg/100, "item_group": ["Vegetables", "Fruits - Excluding Wine"]},
+            {"scale": 1+cereals/100, "item_group": ["Cereals - Excluding Beer"]}]
+
+scenario = xr.DataArray([0., 50.], dims="Scenario", coords={"Scenario": ["a", "b"]})
+
+@pytest.mark.parametrize("sliders", [
+    (0, 0, 0, 0, 0),
+    (50, 75, 25, 50, 25),
+    (100, 100, 100, 100, 100),
+    (100, 50, 80, 150, 0),
+    (scenario * 2, 60, scenario, 100 - scenario, 20),
+])
+def test_matches_item_scaling_chain(datablock, sliders):
+    kwargs = {"source": ["production", "imports"], "elasticity": [0.6, 0.4],
+              "scaling_nutrient": "kCal/cap/day"}
+
+    chain = Datablock(datablock)
+    for target in targets(*sliders):
+        chain = item_scaling(chain, target["scale"], items=target.get("items"),
+                             item_group=target.get("item_group"), **kwargs)
+
+    fused = consumer_demand_model(Datablock(datablock), targets(*sliders), **kwargs)
+
+    expected = chain["food"]["g/cap/day"]
+    actual = fused["food"]["g/cap/day"]
+    for element in elements:
+        expected_el = expected[element].broadcast_like(actual[element])
+        np.testing.assert_allclose(actual[element].values,
+                                   expected_el.transpose(*actual[element].dims).values,
+                                   rtol=1e-12, atol=1e-12, equal_nan=True)
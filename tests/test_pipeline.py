@@ -0,0 +1,36 @@
+"""Tests of the step output cache of the pipeline"""
+
+from utils.pipeline import Pipeline, StepCache, datablock_paths
+
+@datablock_paths(reads=[("x",)], writes=[("y",)])
+def double(datablock, offset):
+    datablock["y"] = datablock["x"] * 2 + offset
+    return datablock
+
+@datablock_paths(reads=[("y",)], writes=[("z",)])
+def square(datablock):
+    datablock["z"] = datablock["y"] ** 2
+    return datablock
+
+def run(cache, offset, capsys):
+    pipeline = Pipeline({"x": 3}, cache=cache)
+    pipeline.add_step(double, {"offset": offset})
+    pipeline.add_step(square)
+    pipeline.run(verbose=True)
+
+    assert "Cached steps" not in capsys.readouterr().out
+    return pipeline
+
+def test_cache_hits(capsys):
+    cache = StepCache()
+
+    first = run(cache, 1, capsys)
+    assert first.cache_hits == 0
+    assert first.datablock["z"] == 49
+
+    assert run(cache, 1, capsys).cache_hits == 2
+
+    # A changed step invalidates the steps downstream of it
+    changed = run(cache, 2, capsys)
+    assert changed.cache_hits == 0
+    assert changed.datablock["z"] == 64
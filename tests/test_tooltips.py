@@ -0,0 +1,64 @@
+"""Tests of the tooltip table served when the spreadsheet cannot be reached"""
+
+import time
+
+import pandas as pd
+
+from utils import tooltips
+from utils.tooltips import TooltipProvider, bundled_tooltips, read_tooltips
+
+columns = ["sidebar_consumer", "sidebar_land", "sidebar_innovation",
+           "sidebar_livestock", "sidebar_arable", "advanced_options"]
+
+def wait_for_fetch(provider, timeout=5):
+    start = time.monotonic()
+    while provider._fetched is None or provider._refreshing:
+        assert time.monotonic() - start < timeout
+        time.sleep(0.01)
+
+def test_bundled_table():
+    table = read_tooltips(bundled_tooltips)
+
+    assert list(table.columns) == columns
+    assert not pd.isna(table["sidebar_consumer"][1])
+
+def test_offline_cold_start(tmp_path, monkeypatch):
+    fetches = []
+
+    def offline(source, timeout=10):
+        if source.startswith("https://"):
+            fetches.append(source)
+            raise OSError("Network is unreachable")
+        return read_tooltips(source)
+
+    monkeypatch.setattr(tooltips, "read_tooltips", offline)
+    bundled = open(bundled_tooltips).read()
+    cache_path = str(tmp_path / "cache" / "tooltips.csv")
+    provider = TooltipProvider("https://example.com/tooltips.csv", cache_path=cache_path)
+
+    # The bundled copy is served without waiting for the spreadsheet
+    table = provider.get()
+    pd.testing.assert_frame_equal(table, read_tooltips(bundled_tooltips))
+
+    # Failed fetches are not retried on every rerun
+    wait_for_fetch(provider)
+    for _ in range(3):
+        pd.testing.assert_frame_equal(provider.get(), table)
+    assert len(fetches) == 1
+
+    assert not (tmp_path / "cache").exists()
+    assert open(bundled_tooltips).read() == bundled
+
+def test_fetch_writes_cache_only(tmp_path):
+    source = tmp_path / "sheet.csv"
+    pd.DataFrame({column: ["Fetched"] for column in columns}).to_csv(source, index=False)
+    bundled = open(bundled_tooltips).read()
+    cache_path = tmp_path / "cache" / "tooltips.csv"
+
+    provider = TooltipProvider(str(source), cache_path=str(cache_path))
+    provider.refresh()
+
+    assert provider.get()["sidebar_land"][0] == "Fetched"
+    pd.testing.assert_frame_equal(read_tooltips(str(cache_path)), provider.get())
+    assert open(bundled_tooltips).read() == bundled
+
@@ -6,27 +6,98 @@ import streamlit as st
 from glossary import *
 
 import base64
+import functools
 from io import BytesIO
 from PIL import Image
 
+from utils.pipeline import StepCache, fingerprint
+
+# Module level cache of finished charts, shared by all sessions
+chart_cache = StepCache(maxsize=64)
+
+def memoised_chart(func):
+    """Caches the charts built by func, keyed on a fingerprint of its
+    arguments, so unchanged charts are not rebuilt on reruns.
+
+    Cached charts are shared, and must not be modified in place. Altair
+    operations such as layering or configure_axis return new charts.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = fingerprint((func.__qualname__, args, kwargs))
+        chart = chart_cache.get(key)
+        if chart is None:
+            chart = func(*args, **kwargs)
+            chart_cache.put(key, chart)
+        return chart
+
+    return wrapper
+
+@functools.lru_cache(maxsize=None)
+def image_data_url(path):
+    """Returns a PNG data URL of the image at path, loaded once per process"""
+
+    output = BytesIO()
+    Image.open(path).save(output, format='PNG')
+
+    return "data:image/png;base64," + base64.b64encode(output.getvalue()).decode()
+
+def years_chart_data(food, show="Item"):
+    """Returns the long-form chart data of food summed by the values of the
+    show coordinate, for each year.
+
+    Parameters
+    ----------
+    food : xarray.DataArray
+        Data with a Year dimension. Missing values are taken as zero.
+    show : str
+        Coordinate along which entries are grouped, such as Item or one of
+        the Item_origin, Item_group or Item_name coordinates.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Frame with the Year, show and value columns, with one row per year
+        and value of show.
+    """
+
+    show_dims = food[show].dims
+    sum_dims = [dim for dim in food.dims if dim not in ("Year",) + show_dims]
+
+    # Years along the rows and entries of show along the columns
+    values = food.fillna(0).sum(dim=sum_dims).transpose("Year", *show_dims).values
+    values = values.reshape(len(food.Year), -1)
+
+    labels = food[show].values.ravel()
+    index, groups = pd.factorize(labels, sort=True, use_na_sentinel=False)
+
+    membership = np.zeros((len(labels), len(groups)))
+    membership[np.arange(len(labels)), index] = 1
+    sums = values @ membership
+
+    return pd.DataFrame({"Year": np.repeat(food.Year.values, len(groups)),
+                         show: np.tile(groups, len(food.Year)),
+                         "value": sums.ravel()})
+
+@memoised_chart
 def plot_years_altair(food, show="Item", ylabel=None, colors=None, ymin=None, ymax=None):
 
     # If no years are found in the dimensions, raise an exception
-    sum_dims = list(food.coords)
-    if "Year" not in sum_dims:
+    if "Year" not in food.dims:
         raise TypeError("'Year' dimension not found in array data")
 
+    # Create dataframe for altair, already summed by the show coordinate
+    df = years_chart_data(food, show=show)
+
     # Set yaxis limits
+    totals = df.groupby("Year", sort=False)["value"].sum()
     if ymax is None:
-        ymax = food.sum(dim="Item").max().item()
+        ymax = totals.max()
     if ymin is None:
-        ymin = food.sum(dim="Item").min().item()
+        ymin = totals.min()
         if ymin > 0: ymin = 0
 
-    # Create dataframe for altair
-    df = food.to_dataframe().reset_index().fillna(0)
-    df = df.melt(id_vars=sum_dims, value_vars=food.name)
-
 #     selection = alt.selection_multi(fields=[show])
     selection = alt.selection_point(on='mouseover')
 
@@ -39,17 +110,18 @@ def plot_years_altair(food, show="Item", ylabel=None, colors=None, ymin=None, ym
     # Create altair chart
     c = alt.Chart(df).mark_area().encode(
             x=alt.X('Year:O', axis=alt.Axis(values = np.linspace(1960, 2100, 8))),
-            y=alt.Y('sum(value):Q', axis=alt.Axis(format="~s", title=ylabel, ), scale=alt.Scale(domain=[ymin, ymax])),
+            y=alt.Y('value:Q', axis=alt.Axis(format="~s", title=ylabel, ), scale=alt.Scale(domain=[ymin, ymax])),
             # color=alt.Color(f'{show}:N', scale=alt.Scale(scheme='category20b')),
             color=alt.Color(f'{show}:N', scale=color_scale),
             # opacity=alt.condition(selection, alt.value(0.5), alt.value(0.8)),
             tooltip=[alt.Tooltip(f'{show}:N', title=show.replace("_", " ")),
                      alt.Tooltip('Year'),
-                     alt.Tooltip('sum(value)', title='Total', format=".2f")],
+                     alt.Tooltip('value:Q', title='Total', format=".2f")],
             ).add_params(selection).properties(height=550)
     
     return c
 
+@memoised_chart
 def plot_years_total(food, ylabel=None, sumdim=None, color="red"):
     years = food.Year.values
     if sumdim is not None and sumdim in food.dims:
@@ -65,34 +137,66 @@ def plot_years_total(food, ylabel=None, sumdim=None, color="red"):
 
     return c
 
-def plot_bars_altair(food, show="Item", x_axis_title='', xlimit=None):
-
-    n_origins = len(food.Item.values)
-
-    df = food.to_dataframe().reset_index().fillna(0)
-    df = df.melt(id_vars=show, value_vars=["production", "imports", "exports", "stock", "losses", "processing", "other", "feed", "seed", "food"])
-    df["value_start"] = 0.
-    df["value_end"] = 0.
-
-    for i in range(2*n_origins,10*n_origins):
-        if i % n_origins==0:
-            temp = df.iloc[i].copy()
-            df.iloc[i] = df.iloc[i+1]
-            df.iloc[i+1] = temp
-        else:
-            pass
-
-    cumul = 0
-    for i in range(2*n_origins):
-        df.loc[i, "value_start"] = cumul
-        cumul += df.loc[i, "value"]
-        df.loc[i, "value_end"] = cumul
-
-    cumul = 0
-    for i in reversed(range(2*n_origins,10*n_origins)):
-        df.loc[i, "value_start"] = cumul
-        cumul += df.loc[i, "value"]
-        df.loc[i, "value_end"] = cumul
+def waterfall_data(data, inputs, outputs, show="Item", output_order=None):
+    """Returns the long-form data of a waterfall bar chart balancing the
+    inputs of a food balance sheet against its outputs.
+
+    Parameters
+    ----------
+    data : xarray.Dataset
+        Food balance sheet with one data variable per element, along the
+        show dimension. Missing values are taken as zero.
+    inputs : list
+        Input elements, stacked from zero in the given order.
+    outputs : list
+        Output elements, stacked from zero starting from the last one, so
+        that they end at the total input if the sheet is balanced.
+    show : str
+        Dimension of the stacked segments of each element.
+    output_order : list, optional
+        Order of the show values in the outputs. Defaults to their order in
+        data.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Frame with the show, variable, value, value_start and value_end
+        columns, with one row per element and value of show, in the order
+        of the elements.
+    """
+
+    data = data.fillna(0)
+    input_items = data[show].values
+    output_items = input_items if output_order is None else np.asarray(output_order)
+
+    input_values = np.stack([data[element].values for element in inputs]).ravel()
+    output_values = np.stack([data[element].sel({show: output_items}).values
+                              for element in outputs]).ravel()
+
+    input_end = np.cumsum(input_values)
+    output_end = np.cumsum(output_values[::-1])[::-1]
+
+    return pd.DataFrame({
+        show: np.concatenate([np.tile(input_items, len(inputs)),
+                              np.tile(output_items, len(outputs))]),
+        "variable": np.concatenate([np.repeat(inputs, len(input_items)),
+                                    np.repeat(outputs, len(output_items))]),
+        "value": np.concatenate([input_values, output_values]),
+        "value_start": np.concatenate([input_end - input_values, output_end - output_values]),
+        "value_end": np.concatenate([input_end, output_end])})
+
+@memoised_chart
+def plot_bars_altair(food, show="Item", x_axis_title='', xlimit=None,
+                     inputs=("production", "imports"),
+                     outputs=("exports", "stock", "losses", "processing", "other",
+                              "feed", "seed", "food")):
+
+    # Outputs list the second value of show first
+    items = list(food[show].values)
+    output_order = items[1::-1] + items[2:]
+
+    df = waterfall_data(food, list(inputs), list(outputs), show=show,
+                        output_order=output_order)
 
     source = df
 
@@ -124,6 +228,7 @@ def plot_land_altair(land):
 
     return c
 
+@memoised_chart
 def plot_single_bar_altair(da, show="Item", axis_title=None,
                                     ax_min=None, ax_max=None, unit="",
                                     vertical=True, mark_total=False,
@@ -191,12 +296,7 @@ def plot_single_bar_altair(da, show="Item", axis_title=None,
     # Add a marker for the total
     if mark_total == True:
 
-        img_path = "images/rhomboid.png"
-        pil_image = Image.open(img_path)
-        output = BytesIO()
-        pil_image.save(output, format='PNG')
-
-        base64_img = "data:image/png;base64," + base64.b64encode(output.getvalue()).decode()
+        base64_img = image_data_url("images/rhomboid.png")
 
         total = da.sum(dim=show).item()
         source = pd.DataFrame.from_records([
@@ -234,6 +334,7 @@ def plot_single_bar_altair(da, show="Item", axis_title=None,
 
     return c
 
+@memoised_chart
 def pie_chart_altair(da, show="Item"):
     df = da.to_dataframe().reset_index().fillna(0)
     df = df.melt(id_vars=show, value_vars=da.name)
@@ -0,0 +1,501 @@
+"""Packed food balance sheets for the model steps.
+
+Model steps operate on food balance sheets with about ten elements, such as
+production, imports or food, sharing the same Item and Year coordinates and
+possibly a Scenario dimension. PackedFBS stores all the elements of a sheet
+in a single contiguous (..., Element, Item, Year) array, with the item
+coordinates kept in an ItemTable shared by all the sheets with the same
+items, and implements the operations of the steps as numpy kernels on it.
+
+The datablock keeps holding xarray Datasets, so derived values, views and
+snapshots are unchanged. Steps pack the sheets they read and unpack the ones
+they write. Unpacked Datasets are read only views of the packed array, and
+packing them again returns the sheet they come from, so a chain of steps
+only stacks the elements of a sheet once.
+
+Item tables also index the items by each of their coordinates, so the
+selections of items by name, group or origin made by steps and views are
+lookups of precomputed positions.
+"""
+
+import weakref
+import functools
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+class Selection(namedtuple("Selection", ["positions", "complement", "mask"])):
+    """Positions of a selection of the items of an ItemTable, positions of the
+    other items, and boolean mask of the selected items"""
+
+    __slots__ = ()
+
+    def inverse(self):
+        """Returns the selection of the other items"""
+        return Selection(self.complement, self.positions, ~self.mask)
+
+class ItemTable():
+    """Item coordinate of a food balance sheet, with the coordinates along it
+    such as Item_name, Item_group and Item_origin.
+
+    The positions of the items with each label of each coordinate, including
+    the Item coordinate itself, are indexed when the table is built, and
+    selections of several labels are memoised.
+    """
+
+    def __init__(self, items, coords=None) -> None:
+        self.items = np.asarray(items)
+        self.coords = {name: np.asarray(values) for name, values in (coords or {}).items()}
+        self.index = pd.Index(self.items)
+
+        self._labels = {}
+        for name, values in [("Item", self.items), *self.coords.items()]:
+            index, labels = pd.factorize(values)
+            self._labels[name] = {label: np.flatnonzero(index == i)
+                                  for i, label in enumerate(labels)}
+        self._selections = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def select(self, coordinate, labels):
+        """Returns the Selection of the items with any of the given labels of
+        coordinate, which is "Item" to select items by name. As with isin,
+        labels not in the table are ignored"""
+
+        if np.isscalar(labels):
+            labels = [labels]
+
+        key = (coordinate, tuple(np.asarray(labels).tolist()))
+        selection = self._selections.get(key)
+        if selection is None:
+            positions = self._labels[coordinate]
+            mask = np.zeros(len(self.items), dtype=bool)
+            for label in key[1]:
+                if label in positions:
+                    mask[positions[label]] = True
+
+            selection = Selection(np.flatnonzero(mask), np.flatnonzero(~mask), mask)
+            for array in selection:
+                array.setflags(write=False)
+            self._selections[key] = selection
+
+        return selection
+
+    def labels(self, coordinate):
+        """Returns the sorted labels of coordinate"""
+        return self.groups(coordinate)[0]
+
+    def positions(self, items):
+        """Returns the positions of items in the table"""
+
+        if np.isscalar(items):
+            items = [items]
+
+        positions = self.index.get_indexer(items)
+        if np.any(positions < 0):
+            raise KeyError("Items not found: {}".format(list(np.asarray(items)[positions < 0])))
+
+        return positions
+
+    def groups(self, coordinate):
+        """Returns the sorted labels of coordinate and the label index of each
+        item, which is -1 for items without a label"""
+
+        index, labels = pd.factorize(self.coords[coordinate], sort=True)
+        return labels, index
+
+    def equals(self, other):
+        return self is other or np.array_equal(self.items, other.items)
+
+    def to_coords(self):
+        """Returns the Item coordinates as a dictionary of xarray coordinates"""
+
+        coords = {"Item": self.items}
+        coords.update({name: ("Item", values) for name, values in self.coords.items()})
+        return coords
+
+def _hashable(values):
+    values = np.asarray(values)
+    return values.dtype.str, tuple(values.tolist())
+
+def _unhashable(key):
+    dtype, values = key
+    values = np.array(values, dtype=dtype)
+    values.setflags(write=False)
+    return values
+
+@functools.lru_cache(maxsize=32)
+def _shared_table(items, coords):
+    return ItemTable(_unhashable(items), {name: _unhashable(values) for name, values in coords})
+
+def item_table(items, coords=None):
+    """Returns the ItemTable of the given items and coordinates, shared with
+    any other sheet with the same items"""
+
+    coords = tuple((name, _hashable(values)) for name, values in (coords or {}).items())
+    return _shared_table(_hashable(items), coords)
+
+# Tables of the Item coordinates of xarray objects, keyed on the identity of
+# their Item index and of the arrays of the coordinates along it, which
+# xarray shares between the objects derived from the same sheet. Each entry
+# is removed when its index is garbage collected
+_coordinate_tables = {}
+
+def _item_arrays(obj):
+    return {name: var.data for name, var in obj.coords.variables.items()
+            if name != "Item" and var.dims == ("Item",)}
+
+def _register(index, arrays, table):
+    key = (id(index),) + tuple((name, id(data)) for name, data in arrays.items())
+    ref = weakref.ref(index, lambda _: _coordinate_tables.pop(key, None))
+    _coordinate_tables[key] = (ref, [weakref.ref(data) for data in arrays.values()], table)
+
+def item_index(obj):
+    """Returns the shared ItemTable of the items of a Dataset or DataArray,
+    to select its items by name or by the labels of their coordinates.
+
+    Tables are looked up on the identity of the item coordinates of obj, so
+    only the first call for a set of coordinates reads their labels.
+    """
+
+    index = obj.xindexes["Item"].index
+    arrays = _item_arrays(obj)
+
+    key = (id(index),) + tuple((name, id(data)) for name, data in arrays.items())
+    entry = _coordinate_tables.get(key)
+    if entry is not None:
+        ref, refs, table = entry
+        if ref() is index and all(r() is data for r, data in zip(refs, arrays.values())):
+            return table
+
+    table = item_table(index.values, {name: np.asarray(data) for name, data in arrays.items()})
+    _register(index, arrays, table)
+
+    return table
+
+# Sheets of the Datasets returned by PackedFBS.to_xarray, by Dataset id. Each
+# entry is removed when its Dataset is garbage collected
+_packed_sheets = {}
+
+def _remember(fbs, packed):
+    key = id(fbs)
+    ref = weakref.ref(fbs, lambda _: _packed_sheets.pop(key, None))
+    _packed_sheets[key] = (ref, dict(fbs.variables), packed)
+
+def _recall(fbs):
+    entry = _packed_sheets.get(id(fbs))
+    if entry is None:
+        return None
+
+    ref, variables, packed = entry
+    # Datasets can be modified by replacing their variables
+    if ref() is not fbs or len(variables) != len(fbs.variables) \
+       or any(fbs.variables.get(name) is not var for name, var in variables.items()):
+        return None
+
+    return packed
+
+def _fillna(values):
+    return np.where(np.isnan(values), 0, values)
+
+class PackedFBS():
+    """Food balance sheet stored as a single (..., Element, Item, Year) array.
+
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Values of the sheet, with the leading dimensions first, followed by
+        the Element, Item and Year dimensions.
+    elements : list of str
+        Names of the elements.
+    table : ItemTable
+        Items of the sheet.
+    years : array_like
+        Year coordinate.
+    order : tuple of str, optional
+        Dimensions of the unpacked elements, e.g. ("Item", "Year",
+        "Scenario"). Any dimension other than Item and Year is a leading
+        dimension of values, in the same order.
+    coords : dict, optional
+        Coordinates of the leading dimensions and scalar coordinates, as
+        xarray Variables.
+    """
+
+    def __init__(self, values, elements, table, years, order=("Item", "Year"),
+                 coords=None) -> None:
+        self.values = values
+        self.elements = list(elements)
+        self.table = table
+        self.years = np.asarray(years)
+        self.order = tuple(order)
+        self.dims = tuple(dim for dim in self.order if dim not in ("Item", "Year"))
+        self.coords = dict(coords or {})
+        self._element_index = {element: e for e, element in enumerate(self.elements)}
+
+        # Values are shared with the unpacked Datasets and the sheets derived
+        # from them, so they are never modified in place
+        self.values.setflags(write=False)
+
+    @classmethod
+    def from_xarray(cls, fbs, elements=None):
+        """Packs the elements of a food balance sheet Dataset, or all of them
+        if elements is None. Elements without some of the dimensions of the
+        sheet are broadcast along them."""
+
+        if elements is None:
+            packed = _recall(fbs)
+            if packed is not None:
+                return packed
+            elements = list(fbs.data_vars)
+
+        data = [fbs[element].variable for element in elements]
+        for dim in ("Item", "Year"):
+            if dim not in fbs.dims:
+                raise ValueError("Food balance sheets must have a {} dimension".format(dim))
+
+        # Unpacked elements keep the dimension order of the largest one
+        order = max((var.dims for var in data), key=len)
+        order += tuple(dim for var in data for dim in var.dims if dim not in order)
+        order = tuple(dict.fromkeys(order + ("Item", "Year")))
+        dims = tuple(dim for dim in order if dim not in ("Item", "Year"))
+
+        sizes = {dim: fbs.sizes[dim] for dim in order}
+        values = np.empty(tuple(sizes[dim] for dim in dims)
+                          + (len(elements), sizes["Item"], sizes["Year"]))
+        for e, var in enumerate(data):
+            values[..., e, :, :] = var.set_dims(sizes).transpose(*dims, "Item", "Year").values
+
+        table = item_index(fbs)
+        coords = {name: coord.variable for name, coord in fbs.coords.items()
+                  if "Item" not in coord.dims and name != "Year"}
+
+        return cls(values, elements, table, fbs.Year.values, order, coords)
+
+    def to_xarray(self):
+        """Returns the sheet as a Dataset, holding views of its values"""
+
+        dims = self.dims + ("Item", "Year")
+        data_vars = {element: xr.Variable(dims, self[element]).transpose(*self.order)
+                     for element in self.elements}
+
+        coords = self.table.to_coords()
+        coords["Year"] = self.years
+        coords.update(self.coords)
+
+        fbs = xr.Dataset(data_vars, coords=coords)
+        _remember(fbs, self)
+        _register(fbs.xindexes["Item"].index, _item_arrays(fbs), self.table)
+
+        return fbs
+
+    def __getitem__(self, element):
+        """Returns the (..., Item, Year) values of element"""
+        return self.values[..., self._element_index[element], :, :]
+
+    def replace(self, values=None, elements=None, table=None, years=None, order=None,
+                coords=None):
+        """Returns a sheet with the given attributes replaced"""
+
+        return PackedFBS(self.values if values is None else values,
+                         self.elements if elements is None else elements,
+                         self.table if table is None else table,
+                         self.years if years is None else years,
+                         self.order if order is None else order,
+                         self.coords if coords is None else coords)
+
+    def assign(self, arrays):
+        """Returns a sheet with the values of the elements in arrays replaced.
+        Arrays are broadcast to the (..., Item, Year) shape of the sheet"""
+
+        values = np.array(self.values)
+        for element, array in arrays.items():
+            values[..., self._element_index[element], :, :] = array
+
+        return self.replace(values=values)
+
+    def expand(self, *others):
+        """Returns the sheet broadcast along the dimensions of others it does
+        not have, such as a Scenario dimension of a parameter. Others can be
+        DataArrays or packed sheets. The result holds a read only view of
+        the values"""
+
+        order = self.order
+        coords = dict(self.coords)
+        sizes = dict(zip(self.dims, self.values.shape))
+        for other in others:
+            if not isinstance(other, (xr.DataArray, PackedFBS)):
+                continue
+            other_dims = other.order if isinstance(other, PackedFBS) else other.dims
+            other_sizes = dict(zip(other.dims, other.values.shape)) \
+                          if isinstance(other, PackedFBS) else other.sizes
+            for dim in other_dims:
+                if dim not in order:
+                    order += (dim,)
+                    sizes[dim] = other_sizes[dim]
+                    if dim in other.coords:
+                        coords[dim] = other.coords[dim] if isinstance(other, PackedFBS) \
+                                      else other.coords[dim].variable
+
+        if order == self.order:
+            return self
+
+        dims = tuple(dim for dim in order if dim not in ("Item", "Year"))
+        return self.replace(values=self._arranged(dims, sizes), order=order, coords=coords)
+
+    def broadcast_like(self, other):
+        """Returns the sheet broadcast along the leading dimensions of the
+        packed sheet other, which must include those of the sheet"""
+
+        coords = dict(self.coords)
+        coords.update({dim: other.coords[dim] for dim in other.dims if dim in other.coords})
+        sizes = dict(zip(other.dims, other.values.shape))
+
+        return self.replace(values=self._arranged(other.dims, sizes), order=other.order,
+                            coords=coords)
+
+    def _arranged(self, dims, sizes, elements=None):
+        """Returns the values with the leading dimensions in dims, broadcast
+        along those the sheet does not have, and the elements in the given
+        order"""
+
+        values = self.values
+        if elements is not None and elements != self.elements:
+            values = values[..., [self._element_index[element] for element in elements], :, :]
+
+        missing = tuple(dim for dim in dims if dim not in self.dims)
+        current = missing + self.dims
+        values = values.reshape((1,) * len(missing) + values.shape)
+        values = values.transpose([current.index(dim) for dim in dims]
+                                  + list(range(len(dims), values.ndim)))
+
+        return np.broadcast_to(values, tuple(sizes[dim] for dim in dims) + values.shape[len(dims):])
+
+    def align(self, data):
+        """Returns data as an array broadcastable to the (..., Item, Year)
+        values of an element. DataArrays are transposed and selected on the
+        coordinates of the sheet. Arrays are assumed to be arranged already"""
+
+        dims = self.dims + ("Item", "Year")
+
+        if not isinstance(data, xr.DataArray):
+            data = np.asarray(data)
+            return data.reshape((1,) * len(dims)) if data.ndim == 0 else data
+
+        extra = [dim for dim in data.dims if dim not in dims]
+        if extra:
+            raise ValueError("Dimensions {} are not in the sheet, which must be"
+                             " expanded first".format(extra))
+
+        for dim, values in [("Item", self.table.items), ("Year", self.years)] \
+                           + [(dim, self.coords[dim].values) for dim in self.dims
+                              if dim in self.coords]:
+            if dim in data.dims and not np.array_equal(data[dim].values, values):
+                data = data.sel({dim: values})
+
+        shape = tuple(data.sizes[dim] if dim in data.dims else 1 for dim in dims)
+        return data.transpose(*[dim for dim in dims if dim in data.dims]).values.reshape(shape)
+
+    def scale_add(self, element_in, element_out, scale, items=None, add=True,
+                  elasticity=None):
+        """Scales the items of element_in and adds the difference to the
+        elements in element_out, as FoodBalanceSheet.scale_add. Items can be
+        a list of items or a Selection of the item table. The sheet is
+        expanded along any dimension of scale it does not have"""
+
+        if np.isscalar(element_out):
+            element_out = [element_out]
+        if np.isscalar(add):
+            add = [add] * len(element_out)
+        if elasticity is None:
+            elasticity = [1.0/len(element_out)] * len(element_out)
+        elif np.isscalar(elasticity):
+            elasticity = [elasticity] * len(element_out)
+
+        fbs = self.expand(scale)
+        scale = fbs.align(scale)
+        if items is None:
+            rows = slice(None)
+        elif isinstance(items, Selection):
+            rows = items.positions
+        else:
+            rows = fbs.table.positions(items)
+        if scale.shape[-2] != 1:
+            scale = scale[..., rows, :]
+
+        values = np.array(fbs.values)
+        e_in = fbs._element_index[element_in]
+        values[..., e_in, rows, :] = values[..., e_in, rows, :] * scale
+        dif = _fillna(fbs[element_in]) - _fillna(values[..., e_in, :, :])
+
+        for element, add_el, elast in zip(element_out, add, elasticity):
+            e_out = fbs._element_index[element]
+            values[..., e_out, :, :] = values[..., e_out, :, :] + np.where(add_el, -1, 1)*dif*elast
+
+        return fbs.replace(values=values)
+
+    def rescale(self, out, orig):
+        """Returns the sheet scaled, element by element, by the ratio of the
+        out and orig sheets. Undefined 0 / 0 ratios are set to 1"""
+
+        if not (self.table.equals(out.table) and self.table.equals(orig.table)):
+            raise ValueError("Sheets must have the same items")
+
+        fbs = self.expand(out, orig)
+        sizes = dict(zip(fbs.dims, fbs.values.shape))
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = out._arranged(fbs.dims, sizes, fbs.elements) \
+                  / orig._arranged(fbs.dims, sizes, fbs.elements)
+            ratio = np.where(np.isnan(ratio), 1, ratio)
+            values = fbs.values * ratio
+
+        return fbs.replace(values=values)
+
+    def project(self, years):
+        """Returns a sheet over the given years, with the values of the last
+        year of the sheet"""
+
+        coords = {name: var for name, var in self.coords.items() if "Year" not in var.dims}
+        values = np.repeat(self.values[..., -1:], len(years), axis=-1)
+
+        return self.replace(values=values, years=years, coords=coords)
+
+    def add_item(self, item, **labels):
+        """Returns a sheet with a new item with zero values. The coordinates
+        of the item not given in labels are copied from the first item"""
+
+        coords = {name: np.append(values, labels.get(name, values[0]))
+                  for name, values in self.table.coords.items()}
+        table = item_table(np.append(self.table.items, item), coords)
+
+        values = np.concatenate([self.values, np.zeros_like(self.values[..., :1, :])], axis=-2)
+
+        return self.replace(values=values, table=table)
+
+    def group_sum(self, coordinate):
+        """Returns the sheet with the items summed over the groups of equal
+        labels of coordinate, which become the new items"""
+
+        labels, index = self.table.groups(coordinate)
+        labelled = np.flatnonzero(index >= 0)
+
+        membership = np.zeros((len(labels), len(self.table)))
+        membership[index[labelled], labelled] = 1
+
+        return self.replace(values=membership @ _fillna(self.values),
+                            table=item_table(labels))
+
+    def ssr(self, production="production", imports="imports", exports="exports"):
+        """Self-sufficiency ratio of the sheet, as FoodBalanceSheet.SSR"""
+
+        domestic_use = self[production] + self[imports] - self[exports]
+        ssr = np.nansum(self[production], axis=-2) / np.nansum(domestic_use, axis=-2)
+
+        coords = {"Year": self.years}
+        coords.update(self.coords)
+        ssr = xr.DataArray(ssr, dims=self.dims + ("Year",), coords=coords)
+
+        return ssr.transpose(*[dim for dim in self.order if dim != "Item"])
@@ -1,6 +1,7 @@
 # FAIR wrapper, needed for caching
 import streamlit as st
 import numpy as np
+from utils.land import land_summary
 
 # Helper Functions
 
@@ -76,10 +77,9 @@ def reset_sliders(keys=None):
 # function to return the coordinate index of the maximum value along a dimension
 def map_max(map, dim):
 
-    length_dim = len(map[dim].values)
-    map_fixed = map.assign_coords({dim:np.arange(length_dim)})
+    summary = land_summary(map, dim=dim)
 
-    return map_fixed.idxmax(dim=dim, skipna=True)
+    return summary["dominant"].where(~summary["no_data"])
 
 def item_name_code(arr):
     if np.array_equal([2949],arr):
@@ -105,7 +105,11 @@ def capitalize_first_character(s):
 
 def help_str(help, sidebar_key, row_index, heading_key=None):
     doc_str = "https://docs.google.com/document/d/1A2J4BYIuXMgrj9tuLtIon8oJTuR1puK91bbUYCI8kHY/edit#heading=h."
-    help_string = help[sidebar_key][row_index]
+    # Tooltips missing from the table are left empty
+    try:
+        help_string = help[sidebar_key][row_index]
+    except (KeyError, IndexError):
+        return None
 
     if heading_key is not None:
         help_string = f"[{help_string}]({doc_str}{heading_key})"
@@ -0,0 +1,53 @@
+"""Historical segment of the datablock.
+
+No intervention changes the years before the projection starts, so the
+pipeline only models the projected years. The historical values of its
+outputs are computed once, when the baseline is built, and kept in the read
+only "history" section of the datablock, with the same paths as the values
+they precede.
+
+The "timeseries" section holds Derived values joining both segments, which
+are only computed when a view reads them.
+"""
+
+import xarray as xr
+
+from utils.pipeline import Derived
+
+def join_history(history, projection):
+    """Returns the historical values followed by the projected ones, along
+    the Year dimension.
+
+    Items added by the pipeline, such as cultured meat, are zero in the
+    historical years, and the non-index coordinates, such as those of the
+    items, are taken from the projection. Historical values are broadcast
+    along any Scenario dimension of the projection.
+    """
+
+    history = history.reset_coords(drop=True)
+    if "Item" in projection.dims:
+        history = history.reindex(Item=projection.Item.values, fill_value=0)
+
+    coords = {name: coord for name, coord in projection.coords.items()
+              if "Year" not in coord.dims and "Scenario" not in coord.dims}
+    history = history.assign_coords(coords)
+
+    joined = xr.concat([history, projection], dim="Year")
+
+    if isinstance(projection, xr.Dataset):
+        return joined.map(lambda var: var.transpose(*projection[var.name].dims))
+
+    return joined.transpose(*projection.dims)
+
+def timeseries_section(paths):
+    """Returns the timeseries section of the baseline datablock, joining the
+    history and the projection at each of the given paths"""
+
+    section = {}
+    for path in paths:
+        node = section
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node[path[-1]] = Derived(join_history, ("history",) + tuple(path), tuple(path))
+
+    return section
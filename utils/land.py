@@ -0,0 +1,239 @@
+"""Land use engine and compact storage of the land use grid.
+
+Land data is stored with a single "cell" dimension holding only the valid
+cells of the y, x grid, i.e. those with land use data. The "cell" coordinate
+is the flat index of each cell in the grid, and the grid itself is stored as
+a boolean mask of the valid cells, from which rasters are rebuilt for maps.
+
+Land interventions only move fractions of land between classes, uniformly
+over the cells of a set of ALC grades. Their state is a small table of the
+land of each class by ALC grade, which pipeline steps update together with
+a record of the transitions applied to it. The cells are only updated when
+they are needed, by applying the recorded transitions to the baseline cells.
+"""
+
+import numpy as np
+import xarray as xr
+
+def _leading_coords(data, dims):
+    return {name: coord for name, coord in data.coords.items()
+            if set(coord.dims) <= set(dims)}
+
+def to_cells(raster, valid):
+    """Returns the values of raster at the valid cells of the grid, along a
+    cell dimension replacing the grid dimensions"""
+
+    raster = raster.transpose(..., *valid.dims)
+    dims = raster.dims[:-valid.ndim]
+    index = np.flatnonzero(valid.values)
+
+    data = raster.values.reshape(raster.shape[:len(dims)] + (-1,))[..., index]
+
+    coords = _leading_coords(raster, dims)
+    coords["cell"] = index
+
+    return xr.DataArray(data, dims=dims + ("cell",), coords=coords,
+                        name=raster.name, attrs=raster.attrs)
+
+def to_raster(cells, valid):
+    """Rebuilds the full grid of cell values, with NaN outside the valid
+    cells"""
+
+    cells = cells.transpose(..., "cell")
+    dims = cells.dims[:-1]
+
+    data = np.full(cells.shape[:-1] + (valid.size,), np.nan)
+    data[..., cells.cell.values] = cells.values
+    data = data.reshape(cells.shape[:-1] + valid.shape)
+
+    coords = _leading_coords(cells, dims)
+    coords.update(valid.coords)
+
+    return xr.DataArray(data, dims=dims + valid.dims, coords=coords,
+                        name=cells.name, attrs=cells.attrs)
+
+def land_summary(land, dim="aggregate_class"):
+    """Computes the dominant class, class totals and missing data mask of
+    land.
+
+    The mask of finite values is computed once and shared by the three
+    reductions, each of which reads land once.
+
+    Parameters
+    ----------
+    land : xarray.DataArray
+        Land of each class along dim, over the cells of the grid or a dense
+        raster. Arrays chunked with dask are computed with a single graph
+        evaluation for the three results.
+    dim : str
+        Class dimension.
+
+    Returns
+    -------
+    summary : xarray.Dataset
+        Dataset with the index of the "dominant" class of each entry, the
+        "totals" of each class, summed over all dimensions except dim and
+        Scenario, and the "no_data" mask of the entries without data in any
+        class.
+    """
+
+    finite = np.isfinite(land)
+    spatial = [d for d in land.dims if d not in (dim, "Scenario")]
+
+    summary = xr.Dataset({"dominant": land.where(finite, -np.inf).argmax(dim=dim),
+                          "totals": land.where(finite, 0).sum(dim=spatial),
+                          "no_data": ~finite.any(dim=dim)})
+
+    return summary.compute()
+
+def land_use_table(cells, grade):
+    """Returns the total land of each class by ALC grade, along an alc_grade
+    dimension. Cells without an ALC grade are given grade 0"""
+
+    grade = grade.fillna(0).rename("alc_grade")
+
+    return cells.groupby(grade).sum()
+
+def transition_matrix(transition, classes, grades):
+    """Returns the matrix of a transition between classes, for each of the
+    given ALC grades.
+
+    Parameters
+    ----------
+    transition : dict
+        Transition with the "sources" classes, the "targets" classes mapped
+        to the share of the moved land they receive, the "fraction" of the
+        source land moved, which can have a Scenario dimension, and the ALC
+        "grades" it applies to, or None for all grades.
+    classes : list
+        Land classes, including all the source and target classes.
+    grades : array_like
+        ALC grades.
+
+    Returns
+    -------
+    matrix : xarray.DataArray
+        Matrix with the "grade", "from_class" and "aggregate_class"
+        dimensions, such that the land after the transition is the product
+        of the land before it and the matrix of its grade.
+    """
+
+    index = {name: i for i, name in enumerate(classes)}
+
+    sources = np.zeros(len(classes))
+    sources[[index[name] for name in np.atleast_1d(transition["sources"])]] = 1
+    shares = np.zeros(len(classes))
+    for name, share in transition["targets"].items():
+        shares[index[name]] = share
+
+    if transition.get("grades") is not None:
+        applies = np.isin(grades, transition["grades"])
+    else:
+        applies = np.ones(len(grades), dtype=bool)
+
+    # Change in land per unit of moved fraction
+    change = np.outer(sources, shares) - np.diag(sources)
+    change = xr.DataArray(applies[:, None, None] * change,
+                          dims=("grade", "from_class", "aggregate_class"))
+    identity = xr.DataArray(np.eye(len(classes)), dims=("from_class", "aggregate_class"))
+
+    return identity + change * transition["fraction"]
+
+def compose(first, second):
+    """Returns the matrix of applying the first and then the second
+    transition matrix"""
+
+    return xr.dot(first.rename(aggregate_class="step"),
+                  second.rename(from_class="step"), dim="step")
+
+def apply_transitions(land, grade, transitions):
+    """Applies a sequence of transitions to land at once, with the composed
+    matrix of the transitions for each grade.
+
+    Parameters
+    ----------
+    land : xarray.DataArray
+        Land of each class, along the aggregate_class dimension, either for
+        the cells of the grid or for the ALC grades of a land use table.
+    grade : xarray.DataArray
+        ALC grade of the entries of land, along their dimension.
+    transitions : sequence of dict
+        Transitions, as described in transition_matrix.
+
+    Returns
+    -------
+    land : xarray.DataArray
+        Land after the transitions, with the new target classes appended in
+        the order they first appear. New classes are zero where the first
+        class has data, and NaN elsewhere. Classes without data in an entry,
+        in any scenario, neither give nor keep land, and stay NaN.
+    """
+
+    name = land.name
+    dim = grade.dims[0]
+
+    # All output classes are allocated before the transitions are applied
+    classes = list(land.aggregate_class.values)
+    for transition in transitions:
+        classes += [target for target in transition["targets"] if target not in classes]
+
+    new_classes = classes[land.sizes["aggregate_class"]:]
+    if len(new_classes) > 0:
+        first = land.isel(aggregate_class=0)
+        new_class = xr.zeros_like(first).where(np.isfinite(first))
+        land = xr.concat([land] + [new_class.assign_coords(aggregate_class=target)
+                                   for target in new_classes], dim="aggregate_class")
+
+    if len(transitions) == 0:
+        return land
+
+    grades, grade_index = np.unique(grade.fillna(0).values, return_inverse=True)
+    matrices = [transition_matrix(transition, classes, grades) for transition in transitions]
+
+    # Classes without data in an entry keep no land, so land moved to them is
+    # lost rather than passed on by later transitions, as when transitions
+    # are applied one at a time. Entries are grouped by grade and by their
+    # classes without data, and the rows of these classes are zeroed in the
+    # matrices of the group before they are composed
+    other_dims = [d for d in land.dims if d not in ("aggregate_class", dim)]
+    missing = (~np.isfinite(land)).any(dim=other_dims).transpose(dim, "aggregate_class").values
+
+    # Each group is keyed on a single integer, with one bit per class
+    bits = np.int64(1) << np.arange(len(classes), dtype=np.int64)
+    stride = bits[-1] << 1
+    keys, group = np.unique(grade_index * stride + missing @ bits, return_inverse=True)
+
+    values = land.fillna(0).rename(aggregate_class="from_class")
+    values = values.assign_coords(from_class=np.arange(len(classes)))
+
+    # Most entries have data in every class, and use the matrices composed
+    # for all grades at once
+    composed = matrices[0]
+    for step in matrices[1:]:
+        composed = compose(composed, step)
+
+    # Entries are multiplied by the composed matrix of their group, one group
+    # at a time
+    parts = []
+    order = []
+    for i, key in enumerate(keys):
+        g, pattern = divmod(key, stride)
+        if pattern == 0:
+            matrix = composed.isel(grade=g)
+        else:
+            keeps = xr.DataArray((pattern & bits == 0).astype(float), dims="from_class")
+            matrix = matrices[0].isel(grade=g) * keeps
+            for step in matrices[1:]:
+                matrix = compose(matrix, step.isel(grade=g) * keeps)
+
+        entries = np.flatnonzero(group == i)
+        parts.append(xr.dot(values.isel({dim: entries}), matrix, dim="from_class"))
+        order.append(entries)
+    out = xr.concat(parts, dim=dim).isel({dim: np.argsort(np.concatenate(order))})
+
+    out = out.assign_coords(aggregate_class=land.aggregate_class.values)
+    out = out.where(np.isfinite(land))
+
+    dims = [d for d in ["Scenario"] if d in out.dims] + [d for d in land.dims if d != "Scenario"]
+
+    return out.transpose(*dims).rename(name)
@@ -0,0 +1,91 @@
+"""Rendering of land use maps to PNG images.
+
+Maps are drawn directly from the land use cells, taking the dominant class
+of each cell and looking up its colour in a palette. Encoded images are
+cached on a fingerprint of the land state, so reruns with unchanged land
+sliders reuse the previous image.
+"""
+
+import io
+
+import numpy as np
+from PIL import Image
+from matplotlib.colors import to_rgba_array, to_hex
+
+from utils.pipeline import StepCache, fingerprint
+from utils.land import land_summary
+
+# Module level cache of encoded maps, shared by all sessions
+map_cache = StepCache(maxsize=32)
+
+def render_land_map(cells, valid, colors, pad_left=0, min_height=0):
+    """Returns a PNG image of the dominant land class of each cell.
+
+    Parameters
+    ----------
+    cells : xarray.DataArray
+        Land of each class, with the aggregate_class and cell dimensions.
+    valid : xarray.DataArray
+        Mask of the valid cells of the grid.
+    colors : dict
+        Colour of each land class.
+    pad_left : int
+        Transparent pixels added to the left of the map.
+    min_height : int
+        Minimum height of the image, reached by adding transparent pixels
+        above the map.
+
+    Returns
+    -------
+    png : bytes
+        The encoded image, with the first row of the grid at the bottom.
+    """
+
+    summary = land_summary(cells.transpose("aggregate_class", "cell"))
+    has_data = ~summary["no_data"].values
+    dominant = summary["dominant"].values
+
+    palette = to_rgba_array([colors[name] for name in cells.aggregate_class.values])
+    palette = (palette * 255).round().astype(np.uint8)
+
+    rgba = np.zeros((valid.size, 4), dtype=np.uint8)
+    rgba[cells.cell.values[has_data]] = palette[dominant[has_data]]
+    image = rgba.reshape(valid.shape + (4,))[::-1]
+
+    pad_top = max(min_height - image.shape[0], 0)
+    image = np.pad(image, ((pad_top, 0), (pad_left, 0), (0, 0)))
+
+    buffer = io.BytesIO()
+    Image.fromarray(image, "RGBA").save(buffer, format="PNG", compress_level=1)
+
+    return buffer.getvalue()
+
+def land_map_png(datablock, colors, pad_left=0, min_height=0):
+    """Returns the PNG land use map of a datablock, rendering it only if its
+    land state is not in the cache"""
+
+    land = datablock["land"]
+    key = fingerprint((land["land_use_table"], land["transitions"],
+                       colors, pad_left, min_height))
+
+    png = map_cache.get(key)
+    if png is None:
+        png = render_land_map(land["percentage_land_use"], land["valid_cells"],
+                              colors, pad_left=pad_left, min_height=min_height)
+        map_cache.put(key, png)
+
+    return png
+
+def land_legend_html(classes, colors, labels):
+    """Returns an HTML legend with one entry per label of the given classes,
+    sorted by label"""
+
+    entries = {}
+    for name in classes:
+        entries.setdefault(labels[name], colors[name])
+
+    items = ['<span style="display:inline-block;width:0.8em;height:0.8em;'
+             'margin:0 0.3em 0 0.8em;background:{};"></span>{}'.format(to_hex(color), label)
+             for label, color in sorted(entries.items())]
+
+    return '<div style="font-size:0.85em;">{}</div>'.format("".join(items))
@@ -0,0 +1,44 @@
+"""Key metrics derived from the results of a pipeline run.
+
+Metrics are stored in the "metrics" section of the baseline datablock as
+Derived values, so they are computed the first time a view reads them and
+then shared by every view of the same pipeline result, until a step writes
+one of their inputs. They cover both the historical and the projected years.
+"""
+
+import xarray as xr
+
+from utils.pipeline import Derived
+from utils.fbs import PackedFBS
+
+# Nutrient bases the self-sufficiency ratio is computed on
+ssr_bases = ["g/cap/day", "kCal/cap/day", "g_prot/cap/day", "g_fat/cap/day"]
+
+def ssr(food):
+    """Self-sufficiency ratio of a food balance sheet"""
+    return PackedFBS.from_xarray(food, ["production", "imports", "exports"]).ssr()
+
+def emissions_by_origin(emissions):
+    """Emissions of the production of each item origin, in t CO2e / year"""
+    emissions = PackedFBS.from_xarray(emissions, ["production"]).group_sum("Item_origin")
+    return emissions.to_xarray()["production"] / 1e6
+
+def net_emissions(emissions, sequestration):
+    """Emissions by item origin and negative sequestration by source, in
+    t CO2e / year, along a single Item dimension"""
+    return xr.concat([emissions, -sequestration], dim="Item")
+
+def land_totals(table):
+    """Total land of each class"""
+    return table.sum(dim="alc_grade")
+
+def metrics_section():
+    """Returns the metrics section of the baseline datablock"""
+
+    return {"SSR": {basis: Derived(ssr, ("timeseries", "food", basis)) for basis in ssr_bases},
+            "emissions_by_origin": Derived(emissions_by_origin,
+                                           ("timeseries", "impact", "g_co2e/year")),
+            "net_emissions": Derived(net_emissions,
+                                     ("metrics", "emissions_by_origin"),
+                                     ("timeseries", "impact", "co2e_sequestration")),
+            "land_totals": Derived(land_totals, ("land", "land_use_table"))}
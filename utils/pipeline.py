@@ -1,17 +1,392 @@
+import os
 import time
+import hashlib
+import pickle
+import threading
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections.abc import MutableMapping
+
+import numpy as np
+import xarray as xr
 import streamlit as st
 
+from utils.profiling import profiled_call, describe, array_sizes
+
+# Digests of the dictionaries and xarray objects set as read only by freeze,
+# keyed on their id. Each object is kept alive with its digest, so its id is
+# not reused
+_frozen = {}
+
+def fingerprint(obj, h=None):
+     """Returns a hex digest identifying the contents of obj.
+
+     Dictionaries, lists, numpy arrays and xarray objects are hashed by value.
+     Any other object is hashed through its pickled representation. Objects
+     set as read only by freeze are only hashed once, and datablock views
+     without writes are hashed as their base.
+     """
+
+     digest = h is None
+     if h is None:
+          h = hashlib.blake2b(digest_size=16)
+
+     while isinstance(obj, Datablock) and not obj.delta():
+          obj = obj._base
+
+     entry = _frozen.get(id(obj))
+     if entry is not None:
+          if entry[1] is None:
+               entry[1] = _contents_digest(obj)
+          h.update(b"frozen" + entry[1].encode())
+
+     elif isinstance(obj, (dict, Datablock)):
+          h.update(b"dict")
+          for key in sorted(obj, key=repr):
+               h.update(repr(key).encode())
+               fingerprint(obj.stored(key) if isinstance(obj, Datablock) else obj[key], h)
+
+     elif isinstance(obj, Derived):
+          h.update(b"Derived")
+          fingerprint((obj.func, obj.paths), h)
+
+     elif isinstance(obj, (list, tuple)):
+          h.update(type(obj).__name__.encode())
+          for item in obj:
+               fingerprint(item, h)
+
+     elif isinstance(obj, np.ndarray):
+          h.update(str((obj.dtype, obj.shape)).encode())
+          if obj.dtype.hasobject:
+               h.update(repr(obj.tolist()).encode())
+          else:
+               h.update(np.ascontiguousarray(obj).data)
+
+     elif isinstance(obj, xr.DataArray):
+          h.update(b"DataArray" + repr(obj.name).encode())
+          fingerprint(obj.variable, h)
+          fingerprint(dict(obj.coords.variables), h)
+
+     elif isinstance(obj, xr.Dataset):
+          h.update(b"Dataset")
+          fingerprint(dict(obj.variables), h)
+
+     elif isinstance(obj, xr.Variable):
+          h.update(repr(obj.dims).encode())
+          fingerprint(obj.values, h)
+
+     elif callable(obj) and hasattr(obj, "__qualname__"):
+          h.update("{}.{}".format(obj.__module__, obj.__qualname__).encode())
+
+     else:
+          h.update(pickle.dumps(obj))
+
+     if digest:
+          return h.hexdigest()
+
+def _contents_digest(obj):
+     # Hashes a frozen object by value, bypassing its own memoised digest
+     h = hashlib.blake2b(digest_size=16)
+     if isinstance(obj, dict):
+          fingerprint(dict(obj), h)
+     else:
+          fingerprint(obj.copy(deep=False), h)
+     return h.hexdigest()
+
+def freeze(obj):
+     """Sets the numpy arrays of a nested datablock dictionary as read only,
+     so modifying a shared value in place raises an error. Index coordinates
+     are left to pandas. Returns obj
+
+     The fingerprint of frozen dictionaries and xarray objects is computed
+     once, so they must not be modified after being frozen.
+     """
+
+     if isinstance(obj, (dict, xr.DataArray, xr.Dataset)):
+          _frozen.setdefault(id(obj), [obj, None])
+
+     if isinstance(obj, dict):
+          for value in obj.values():
+               freeze(value)
+
+     elif isinstance(obj, (list, tuple)):
+          for item in obj:
+               freeze(item)
+
+     elif isinstance(obj, xr.DataArray):
+          freeze(obj.variable)
+          for coord in obj.coords.values():
+               freeze(coord.variable)
+
+     elif isinstance(obj, xr.Dataset):
+          for variable in obj.variables.values():
+               freeze(variable)
+
+     elif isinstance(obj, xr.Variable) and not isinstance(obj, xr.IndexVariable):
+          freeze(obj.data)
+
+     elif isinstance(obj, np.ndarray):
+          obj.setflags(write=False)
+
+     return obj
+
+class Datablock(MutableMapping):
+     """Copy-on-write view of a nested datablock dictionary.
+
+     Reads are served from the base mapping without copying, so the arrays of
+     the baseline and of cached step outputs are shared. Writes are stored in
+     the view itself, and nested dictionaries are only wrapped in a new view
+     when they are first accessed, so only the paths written by a step are
+     materialized.
+
+     Steps must replace values rather than modifying them in place, e.g.
+     ``datablock["food"][key] = datablock["food"][key] * ratio``.
+
+     Derived values are evaluated against the root view they are read from,
+     so they always reflect the values written to it.
+     """
+
+     _deleted = object()
+
+     def __init__(self, base=None, root=None) -> None:
+          self._base = base if base is not None else {}
+          self._root = root if root is not None else self
+          self._own = {}
+          self._wrapped = set()
+
+     def __getitem__(self, key):
+          value = self.stored(key)
+          if isinstance(value, Derived):
+               value = value.evaluate(self._root)
+          return value
+
+     def stored(self, key):
+          """Returns the value stored at key, without evaluating it if it is
+          a Derived value"""
+          if key in self._own:
+               value = self._own[key]
+               if value is self._deleted:
+                    raise KeyError(key)
+               return value
+
+          if isinstance(self._base, Datablock):
+               value = self._base.stored(key)
+          else:
+               value = self._base[key]
+          if isinstance(value, (dict, Datablock)):
+               value = Datablock(value, root=self._root)
+               self._own[key] = value
+               self._wrapped.add(key)
+          return value
+
+     def __setitem__(self, key, value):
+          self._own[key] = value
+          self._wrapped.discard(key)
+
+     def __delitem__(self, key):
+          if key not in self:
+               raise KeyError(key)
+          self._own[key] = self._deleted
+          self._wrapped.discard(key)
+
+     def __contains__(self, key):
+          if key in self._own:
+               return self._own[key] is not self._deleted
+          return key in self._base
+
+     def __iter__(self):
+          for key in self._base:
+               if key not in self._own:
+                    yield key
+          for key, value in self._own.items():
+               if value is not self._deleted:
+                    yield key
+
+     def __len__(self):
+          return sum(1 for _ in self)
+
+     def __repr__(self):
+          return "Datablock({})".format(list(self))
+
+     def delta(self):
+          """Returns the values written to this view as a nested dictionary.
+          Partial writes to nested dictionaries are returned as Delta objects
+          """
+          out = Delta()
+          for key, value in self._own.items():
+               if key in self._wrapped:
+                    sub = value.delta()
+                    if sub:
+                         out[key] = sub
+               else:
+                    out[key] = value
+          return out
+
+     def merge(self, delta):
+          """Returns a new view with the values in delta written on top of
+          this one"""
+          layer = Datablock(self)
+          layer._write(delta)
+          return layer
+
+     def _write(self, delta):
+          for key, value in delta.items():
+               if value is self._deleted:
+                    del self[key]
+               elif isinstance(value, Delta):
+                    self[key]._write(value)
+               elif isinstance(value, dict):
+                    # Delta values can be shared, so they are never written to
+                    self._own[key] = Datablock(value, root=self._root)
+                    self._wrapped.add(key)
+               else:
+                    self[key] = value
+
+     def to_dict(self):
+          """Returns a plain nested dictionary with the current contents"""
+          return {key: value.to_dict() if isinstance(value, Datablock)
+                  else value for key, value in self.items()}
+
+class Delta(dict):
+     """Nested dictionary of the values written to a Datablock"""
+
+class Derived():
+     """Datablock value computed on access by applying func to the values
+     at the given paths, e.g.
+
+     ``Derived(operator.mul, ("food", "g/cap/day"), ("food", "kCal/g_food"))``
+
+     Paths are taken from the root of the datablock the value is read from.
+     Results are memoised on the identity of the inputs, which steps replace
+     rather than modify, so a derived value is only recomputed after one of
+     its inputs has been written. Writing to the path of a Derived value
+     replaces it with a stored one.
+     """
+
+     def __init__(self, func, *paths, maxsize=8) -> None:
+          self.func = func
+          self.paths = [tuple(path) for path in paths]
+          self.maxsize = maxsize
+          self._memo = OrderedDict()
+          self._lock = threading.Lock()
+
+     def evaluate(self, root):
+          """Returns the value derived from the inputs in root"""
+
+          inputs = []
+          for path in self.paths:
+               value = root
+               for key in path:
+                    value = value[key]
+               inputs.append(value)
+
+          # The memo keeps a reference to the inputs, so their ids are not
+          # reused while their entry is alive
+          key = tuple(id(value) for value in inputs)
+          with self._lock:
+               if key in self._memo:
+                    self._memo.move_to_end(key)
+                    return self._memo[key][1]
+
+          value = self.func(*inputs)
+
+          with self._lock:
+               self._memo[key] = (inputs, value)
+               while len(self._memo) > self.maxsize:
+                    self._memo.popitem(last=False)
+
+          return value
+
+     def __getstate__(self):
+          return {"func": self.func, "paths": self.paths, "maxsize": self.maxsize}
+
+     def __setstate__(self, state):
+          self.__init__(state["func"], *state["paths"], maxsize=state["maxsize"])
+
+     def __repr__(self):
+          return "Derived({}, {})".format(self.func.__name__, self.paths)
+
+def datablock_paths(reads=None, writes=None):
+     """Decorator declaring the datablock paths a step reads and writes.
+
+     Paths are tuples of keys, e.g. ("food", "g/cap/day"), and a path also
+     covers every path nested under it, so ("land",) covers all land data.
+     Steps without declarations are run after all previous steps and before
+     all the following ones.
+     """
+
+     def decorator(func):
+          func.reads = [tuple(path) for path in reads]
+          func.writes = [tuple(path) for path in writes]
+          return func
+
+     return decorator
+
+def paths_overlap(paths_a, paths_b):
+     """Checks if any path in paths_a is equal to, or nested under, any path
+     in paths_b, or viceversa"""
+     for a in paths_a:
+          for b in paths_b:
+               n = min(len(a), len(b))
+               if a[:n] == b[:n]:
+                    return True
+     return False
+
+class StepCache():
+     """Thread safe, bounded LRU store of the values written by pipeline
+     steps, keyed on the step function, its parameters and the keys of the
+     steps it depends on.
+     """
+
+     def __init__(self, maxsize=64) -> None:
+          self.maxsize = maxsize
+          self._store = OrderedDict()
+          self._lock = threading.Lock()
+
+     def get(self, key):
+          with self._lock:
+               if key not in self._store:
+                    return None
+               self._store.move_to_end(key)
+               return self._store[key]
+
+     def put(self, key, delta):
+          with self._lock:
+               self._store[key] = delta
+               self._store.move_to_end(key)
+               while len(self._store) > self.maxsize:
+                    self._store.popitem(last=False)
+
+     def clear(self):
+          with self._lock:
+               self._store.clear()
+
+     def __len__(self):
+          return len(self._store)
+
+# Module level cache, shared by all the sessions served by this process
+step_cache = StepCache()
+
 class Pipeline():
 
-     def __init__(self, dict=None) -> None:
+     def __init__(self, dict=None, cache=step_cache, max_workers=None) -> None:
           self.steps = []
-          if dict is not None:
-               self.datablock = dict
-          else:
-               self.datablock = {}
+          self.cache = cache
+          self.max_workers = max_workers if max_workers is not None else os.cpu_count()
+          self.datablock = Datablock(dict)
+          self.profile = []
+          # Number of steps read from the cache in the last run
+          self.cache_hits = 0
 
-     def add_step(self, func, params={}):
-          self.steps.append((func, params))
+     def add_step(self, func, params={}, reads=None, writes=None):
+          """Adds a step to the pipeline. The datablock paths read and written
+          by the step default to those declared with datablock_paths"""
+          if reads is None:
+               reads = getattr(func, "reads", None)
+          if writes is None:
+               writes = getattr(func, "writes", None)
+          self.steps.append((func, params, reads, writes))
 
      def datablock_write(self, path, value):
 
@@ -21,16 +396,118 @@ class Pipeline():
                current = current.setdefault(key, {})
           current[path[-1]] = value
 
-     def run(self, verbose=False):
+     def dependencies(self):
+          """Returns the indices of the previous steps each step depends on"""
+
+          deps = []
+          for j, (_, _, reads_j, writes_j) in enumerate(self.steps):
+               deps_j = []
+               for i, (_, _, reads_i, writes_i) in enumerate(self.steps[:j]):
+                    if None in (reads_i, writes_i, reads_j, writes_j) \
+                    or paths_overlap(writes_i, reads_j) \
+                    or paths_overlap(writes_i, writes_j) \
+                    or paths_overlap(reads_i, writes_j):
+                         deps_j.append(i)
+               deps.append(deps_j)
+
+          return deps
+
+     def run(self, verbose=False, profile=False):
+          """Runs the pipeline steps.
+
+          If profile is True, the cache is bypassed and steps are run one at a
+          time, recording in self.profile the wall and CPU time, peak traced
+          memory and size of the arrays written by each step.
+          """
           if verbose:
                print("Running pipeline")
 
-          start = time.time()
-          
-          for func, params in self.steps:
-               self.datablock = func(self.datablock, **params)
-          end = time.time()
-          
+          start = time.perf_counter()
+
+          deps = self.dependencies()
+
+          # Each step is keyed on its identity, parameters and the keys of the
+          # steps it depends on, so a changed step only invalidates the steps
+          # downstream of it
+          keys = []
+          base_key = fingerprint(self.datablock)
+          for j, (func, params, _, _) in enumerate(self.steps):
+               keys.append(fingerprint((base_key, func, params,
+                                        [keys[i] for i in deps[j]])))
+
+          cache = self.cache if not profile else None
+          max_workers = self.max_workers if not profile else 1
+          records = {}
+
+          started_tracing = profile and not tracemalloc.is_tracing()
+          if started_tracing:
+               tracemalloc.start()
+
+          # Steps run on a copy-on-write layer over the current state and only
+          # the values they write are merged back, in the main thread. Steps
+          # running concurrently write disjoint paths, so the result does not
+          # depend on the order in which they finish
+          state = self.datablock
+          pending = list(range(len(self.steps)))
+          running = {}
+          done = set()
+          hits = 0
+
+          try:
+               with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                    while pending or running:
+                         for j in list(pending):
+                              if not all(i in done for i in deps[j]):
+                                   continue
+                              pending.remove(j)
+
+                              delta = cache.get(keys[j]) if cache is not None else None
+                              if delta is not None:
+                                   state = state.merge(delta)
+                                   done.add(j)
+                                   hits += 1
+                              else:
+                                   func, params, _, _ = self.steps[j]
+                                   future = executor.submit(profiled_call, func,
+                                                            Datablock(state), params)
+                                   running[future] = j
+
+                         if not running:
+                              continue
+
+                         finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                         for future in finished:
+                              j = running.pop(future)
+                              out, records[j] = future.result()
+                              delta = out.delta()
+                              records[j]["created_bytes"] = array_sizes(delta)
+                              if cache is not None:
+                                   cache.put(keys[j], delta)
+                              state = state.merge(delta)
+                              done.add(j)
+          finally:
+               if started_tracing:
+                    tracemalloc.stop()
+
+          self.datablock = state
+
+          end = time.perf_counter()
+
+          if profile:
+               self.profile = []
+               for j, (func, params, _, _) in enumerate(self.steps):
+                    rec = records[j]
+                    self.profile.append({"step": j,
+                                         "name": func.__name__,
+                                         "params": describe(params),
+                                         "start_ms": (rec["start"] - start) * 1000,
+                                         "wall_ms": rec["wall_ms"],
+                                         "cpu_ms": rec["cpu_ms"],
+                                         "peak_memory_bytes": rec["peak_memory_bytes"],
+                                         "created_bytes": rec["created_bytes"],
+                                         "thread": rec["thread"]})
+
+          self.cache_hits = hits
+
           if verbose:
                print("Total time: {} ms".format(round((end - start) * 1000)))
-          
\ No newline at end of file
@@ -0,0 +1,89 @@
+import time
+import json
+import threading
+import tracemalloc
+
+import numpy as np
+import xarray as xr
+
+def profiled_call(func, datablock, params):
+     """Calls a pipeline step and returns its output together with a record
+     of its wall time, CPU time and peak memory allocated while it ran.
+
+     Peak memory is only collected if tracemalloc is tracing.
+     """
+
+     tracing = tracemalloc.is_tracing()
+     if tracing:
+          tracemalloc.reset_peak()
+          mem_start = tracemalloc.get_traced_memory()[0]
+
+     start = time.perf_counter()
+     cpu_start = time.thread_time()
+
+     out = func(datablock, **params)
+
+     cpu_end = time.thread_time()
+     end = time.perf_counter()
+
+     record = {"start": start,
+               "wall_ms": (end - start) * 1000,
+               "cpu_ms": (cpu_end - cpu_start) * 1000,
+               "peak_memory_bytes": tracemalloc.get_traced_memory()[1] - mem_start if tracing else None,
+               "thread": threading.get_ident()}
+
+     return out, record
+
+def describe(value):
+     """Returns a JSON serializable summary of a step parameter"""
+
+     if isinstance(value, (xr.DataArray, xr.Dataset, np.ndarray)):
+          shape = dict(value.sizes) if hasattr(value, "sizes") else value.shape
+          return "{}({})".format(type(value).__name__, shape)
+     elif isinstance(value, dict):
+          return {str(key): describe(val) for key, val in value.items()}
+     elif isinstance(value, (list, tuple)):
+          return [describe(val) for val in value]
+     elif isinstance(value, np.generic):
+          return value.item()
+     elif value is None or isinstance(value, (bool, int, float, str)):
+          return value
+     else:
+          return repr(value)
+
+def array_sizes(delta, prefix=()):
+     """Returns the size in bytes of each array written to the datablock, as
+     a dictionary keyed on the "/" joined datablock path"""
+
+     sizes = {}
+     for key, value in delta.items():
+          path = prefix + (str(key),)
+          if isinstance(value, dict):
+               sizes.update(array_sizes(value, path))
+          elif isinstance(value, (xr.DataArray, xr.Dataset, np.ndarray)):
+               sizes["/".join(path)] = int(value.nbytes)
+     return sizes
+
+def profile_to_json(records, indent=2):
+     """Serializes the step records of a profiled pipeline run to JSON"""
+     return json.dumps(records, indent=indent)
+
+def profile_to_chrome_trace(records):
+     """Converts the step records of a profiled pipeline run to the Chrome
+     trace event format, which can be loaded in Perfetto or chrome://tracing
+     """
+
+     events = []
+     for rec in records:
+          args = {"params": rec["params"],
+                  "cpu_ms": rec["cpu_ms"],
+                  "peak_memory_bytes": rec["peak_memory_bytes"],
+                  "created_bytes": rec["created_bytes"]}
+
+          events.append({"name": rec["name"], "cat": "step", "ph": "X",
+                         "ts": rec["start_ms"] * 1e3,
+                         "dur": rec["wall_ms"] * 1e3,
+                         "pid": 0, "tid": rec["thread"],
+                         "args": args})
+
+     return json.dumps({"traceEvents": events, "displayTimeUnit": "ms"})
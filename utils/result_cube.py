@@ -0,0 +1,201 @@
+"""Precomputed Summary metrics over a lattice of slider values.
+
+The cube is stored as a memory-mapped float32 .npy array with one row per
+slider combination, so a lookup reads a single contiguous chunk, and a JSON
+manifest describing the slider combinations and the layout of each row. The
+PNG land use map of each combination is stored alongside, so the Summary view
+is drawn without running the pipeline.
+
+Build it offline with
+
+    python -m utils.result_cube -o result_cube [--grid key=v1,v2,...]
+
+By default the cube holds the preset scenarios and every slider at each of
+its levels with all other sliders at their default value. Grids given on the
+command line add the cartesian product of their values.
+
+Only the advanced settings at their default values are covered. Any other
+slider combination, or any change to the advanced settings, is computed by
+the live pipeline. Sliders no pipeline step reads are left out of the cube,
+and the cube is ignored once the code computing the metrics or the data
+packages change.
+"""
+
+import os
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xarray as xr
+
+# Years of the Summary view, the reference year and both metric years
+cube_years = [2020, 2050, 2100]
+
+slider_levels = {"land_beccs": [5, 10, 15, 20],
+                 "DACCS": [5, 10, 15, 20]}
+
+# Layout of the land use map of the Summary view
+summary_map = {"pad_left": 100, "min_height": 1000}
+
+def cube_version():
+    """Returns a hash of the code computing the Summary metrics and of the
+    data packages, as snapshot_version does for the baseline"""
+
+    from utils.snapshot import snapshot_version
+
+    return snapshot_version(modules=("datablock_build", "utils.snapshot",
+                                     "utils.result_cube"))
+
+def summary_metrics(datablock):
+    """Computes the metrics shown in the Summary view"""
+
+    metrics = datablock["metrics"]
+
+    emissions = metrics["emissions_by_origin"].sel(Year=cube_years)
+    sequestration = datablock["timeseries"]["impact"]["co2e_sequestration"].sel(Year=cube_years)
+
+    return {"emissions": emissions.transpose("Item", "Year"),
+            "sequestration": sequestration.transpose("Item", "Year"),
+            "SSR": metrics["SSR"]["g/cap/day"].sel(Year=cube_years),
+            "land": metrics["land_totals"]}
+
+def default_points():
+    """Returns the preset scenarios and every slider read by the pipeline at
+    each of its non zero levels with the others at their default value"""
+
+    from scenarios import scenarios_dict
+    from food_system import pipeline_slider_keys
+
+    points = [dict(sliders) for sliders in scenarios_dict.values()]
+    for key in pipeline_slider_keys:
+        for level in slider_levels.get(key, [25, 50, 75, 100]):
+            points.append({key: level})
+
+    return points
+
+def _evaluate(sliders):
+    from datablock_setup import datablock, proj_pop
+    from food_system import build_food_system
+    from glossary import land_color_dict
+    from utils.land_map import land_map_png
+
+    food_system = build_food_system(datablock, proj_pop, sliders=sliders)
+    food_system.run()
+    metrics = summary_metrics(food_system.datablock)
+    land_map = land_map_png(food_system.datablock, land_color_dict, **summary_map)
+
+    return {name: (da.dims, {dim: da[dim].values.tolist() for dim in da.dims}, da.values)
+            for name, da in metrics.items()}, land_map
+
+def build_cube(path, points, workers=None):
+    """Evaluates the Summary metrics for each slider combination in points and
+    writes them to a result cube at path"""
+
+    from food_system import pipeline_slider_keys, default_sliders
+
+    defaults = default_sliders()
+    points = [{**defaults, **sliders} for sliders in points]
+
+    # Remove repeated slider combinations, keeping the first occurrence.
+    # Sliders the pipeline does not read are left at their default value
+    keys = list(dict.fromkeys(tuple(float(p[key]) for key in pipeline_slider_keys)
+                              for p in points))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results, land_maps = zip(*executor.map(_evaluate,
+                                               [dict(zip(pipeline_slider_keys, key))
+                                                for key in keys]))
+
+    layout = {}
+    offset = 0
+    for name, (dims, coords, values) in results[0].items():
+        if any(result[name][1] != coords for result in results):
+            raise ValueError(f"Coordinates of '{name}' differ between slider combinations")
+        layout[name] = {"dims": list(dims), "coords": coords,
+                        "offset": offset, "shape": list(values.shape)}
+        offset += values.size
+
+    os.makedirs(path, exist_ok=True)
+    cube = np.lib.format.open_memmap(os.path.join(path, "cube.npy"), mode="w+",
+                                     dtype=np.float32, shape=(len(keys), offset))
+    for row, result in zip(cube, results):
+        for name, (_, _, values) in result.items():
+            block = layout[name]
+            row[block["offset"]:block["offset"] + values.size] = values.ravel()
+    cube.flush()
+
+    # Land use maps are concatenated in row order, with their offsets and
+    # sizes in the manifest
+    maps = []
+    offset = 0
+    with open(os.path.join(path, "maps.bin"), "wb") as f:
+        for png in land_maps:
+            f.write(png)
+            maps.append([offset, len(png)])
+            offset += len(png)
+
+    manifest = {"version": cube_version(), "sliders": pipeline_slider_keys,
+                "points": keys, "layout": layout, "maps": maps}
+    with open(os.path.join(path, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+
+class ResultCube():
+    """Read only, memory-mapped result cube"""
+
+    def __init__(self, path) -> None:
+        with open(os.path.join(path, "manifest.json")) as f:
+            manifest = json.load(f)
+
+        # Cubes built before the version was stored match no version
+        self.version = manifest.get("version")
+        self.sliders = manifest["sliders"]
+        self.layout = manifest["layout"]
+        self.index = {tuple(point): row for row, point in enumerate(manifest["points"])}
+        self.cube = np.load(os.path.join(path, "cube.npy"), mmap_mode="r")
+
+        # Cubes built before the land maps were stored do not have them
+        self.maps = manifest.get("maps")
+        if self.maps is not None:
+            self.map_data = np.memmap(os.path.join(path, "maps.bin"), dtype=np.uint8, mode="r")
+
+    def lookup(self, sliders):
+        """Returns the Summary metrics for the given slider values as a
+        dictionary of DataArrays, with the PNG land use map under "land_map"
+        if the cube has it, or None if they are not in the cube"""
+
+        key = tuple(float(sliders[slider]) for slider in self.sliders)
+        row = self.index.get(key)
+        if row is None:
+            return None
+
+        values = self.cube[row]
+        metrics = {}
+        for name, block in self.layout.items():
+            size = int(np.prod(block["shape"]))
+            data = values[block["offset"]:block["offset"] + size].reshape(block["shape"])
+            metrics[name] = xr.DataArray(data, dims=block["dims"], coords=block["coords"], name=name)
+
+        if self.maps is not None:
+            offset, size = self.maps[row]
+            metrics["land_map"] = self.map_data[offset:offset + size].tobytes()
+
+        return metrics
+
+def main(args=None):
+    from batch_run import parse_grid
+
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--grid", action="append", default=[],
+                        help="Slider grid as key=v1,v2,... Can be repeated")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of worker processes")
+    parser.add_argument("-o", "--output", default="result_cube",
+                        help="Output directory")
+    args = parser.parse_args(args)
+
+    build_cube(args.output, default_points() + parse_grid(args.grid), workers=args.workers)
+
+if __name__ == "__main__":
+    main()
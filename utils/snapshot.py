@@ -0,0 +1,238 @@
+"""On disk snapshot of the baseline datablock.
+
+Building the baseline loads and aligns all the agrifoodpy_data datasets,
+which makes cold starts slow. The snapshot stores the finished datablock as
+one .npy file per array, plus a JSON manifest describing the datablock
+structure and the coordinates of each array. Arrays are memory-mapped when
+the snapshot is loaded, so startup does not read them, and server
+processes share their pages.
+
+Snapshots are versioned on the code that builds the baseline and on the
+installed data packages. An out of date snapshot is ignored. Build one with
+
+    python -m utils.snapshot -o baseline_snapshot
+"""
+
+import os
+import ast
+import json
+import hashlib
+import argparse
+import importlib
+import importlib.util
+import importlib.metadata
+
+import numpy as np
+import xarray as xr
+
+from utils.pipeline import Derived
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Data packages the contents of the baseline depend on
+data_packages = ["agrifoodpy_data", "agrifoodpy"]
+
+def source_files(modules=("datablock_build", "utils.snapshot")):
+    """Returns the files of the given modules and of the local modules they
+    import, directly or not, relative to the repository root.
+
+    The snapshot stores the output of these modules, including the layout of
+    the Derived values of the metrics and timeseries sections, so a change to
+    any of them must invalidate it.
+    """
+
+    files = []
+    pending = list(modules)
+    while pending:
+        filename = os.path.join(*pending.pop().split(".")) + ".py"
+        if filename in files or not os.path.exists(os.path.join(root_dir, filename)):
+            continue
+        files.append(filename)
+
+        with open(os.path.join(root_dir, filename)) as f:
+            tree = ast.parse(f.read(), filename)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                pending.extend(alias.name for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                pending.append(node.module)
+
+    return sorted(files)
+
+def snapshot_version(modules=("datablock_build", "utils.snapshot")):
+    """Returns a hash of the code of the given modules, by default those
+    building the baseline, and of the version and files of the data
+    packages. The package files are identified by their size and
+    modification time, so their contents are not read"""
+
+    h = hashlib.blake2b(digest_size=16)
+
+    for filename in source_files(modules):
+        with open(os.path.join(root_dir, filename), "rb") as f:
+            h.update(f.read())
+
+    for package in data_packages:
+        try:
+            h.update(importlib.metadata.version(package).encode())
+        except importlib.metadata.PackageNotFoundError:
+            pass
+
+        spec = importlib.util.find_spec(package)
+        if spec is None:
+            continue
+        for location in spec.submodule_search_locations or [spec.origin]:
+            for dirpath, dirnames, filenames in os.walk(location):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    stat = os.stat(os.path.join(dirpath, filename))
+                    relpath = os.path.relpath(os.path.join(dirpath, filename), location)
+                    h.update("{} {} {}".format(relpath, stat.st_size, stat.st_mtime_ns).encode())
+
+    return h.hexdigest()
+
+class _Writer():
+
+    def __init__(self, path) -> None:
+        self.path = path
+        self.count = 0
+        os.makedirs(os.path.join(path, "arrays"), exist_ok=True)
+
+    def array(self, variable):
+        values = variable.values
+        dtype = values.dtype.str
+        if values.dtype.hasobject:
+            values = values.astype(str)
+
+        filename = os.path.join("arrays", "{:04d}.npy".format(self.count))
+        self.count += 1
+        np.save(os.path.join(self.path, filename), values, allow_pickle=False)
+
+        return {"dims": list(variable.dims), "file": filename, "dtype": dtype}
+
+    def coords(self, data):
+        return {name: self.array(coord.variable) for name, coord in data.coords.items()}
+
+    def encode(self, value):
+        if isinstance(value, dict):
+            return {"type": "dict",
+                    "items": {key: self.encode(item) for key, item in value.items()}}
+
+        elif isinstance(value, xr.DataArray):
+            return {"type": "DataArray",
+                    "name": value.name,
+                    "attrs": _attrs(value.attrs),
+                    "data": self.array(value.variable),
+                    "coords": self.coords(value)}
+
+        elif isinstance(value, xr.Dataset):
+            return {"type": "Dataset",
+                    "attrs": _attrs(value.attrs),
+                    "data_vars": {name: {"attrs": _attrs(var.attrs),
+                                         "data": self.array(var.variable)}
+                                  for name, var in value.data_vars.items()},
+                    "coords": self.coords(value)}
+
+        elif isinstance(value, Derived):
+            return {"type": "Derived",
+                    "func": "{}:{}".format(value.func.__module__, value.func.__qualname__),
+                    "paths": [list(path) for path in value.paths]}
+
+        elif isinstance(value, tuple):
+            return {"type": "tuple", "items": [self.encode(item) for item in value]}
+
+        else:
+            return {"type": "value", "value": value}
+
+def _attrs(attrs):
+    # Attributes are kept if they can be written to JSON
+    return json.loads(json.dumps(attrs, default=lambda value: None))
+
+def write_snapshot(path, values, version=None):
+    """Writes a dictionary of baseline values, such as the datablock, to a
+    snapshot at path"""
+
+    writer = _Writer(path)
+    manifest = {"version": version if version is not None else snapshot_version(),
+                "values": {key: writer.encode(value) for key, value in values.items()}}
+
+    with open(os.path.join(path, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+
+class _Reader():
+
+    def __init__(self, path) -> None:
+        self.path = path
+
+    def array(self, entry, mmap_mode=None):
+        values = np.load(os.path.join(self.path, entry["file"]), mmap_mode=mmap_mode)
+        if np.dtype(entry["dtype"]).hasobject:
+            values = values.astype(object)
+        return xr.Variable(entry["dims"], values)
+
+    def coords(self, entry):
+        return {name: self.array(coord) for name, coord in entry["coords"].items()}
+
+    def decode(self, entry):
+        kind = entry["type"]
+
+        if kind == "dict":
+            return {key: self.decode(item) for key, item in entry["items"].items()}
+
+        elif kind == "DataArray":
+            variable = self.array(entry["data"], mmap_mode="r")
+            return xr.DataArray(variable, coords=self.coords(entry),
+                                name=entry["name"], attrs=entry["attrs"])
+
+        elif kind == "Dataset":
+            data_vars = {}
+            for name, var in entry["data_vars"].items():
+                variable = self.array(var["data"], mmap_mode="r")
+                variable.attrs = var["attrs"]
+                data_vars[name] = variable
+            return xr.Dataset(data_vars, coords=self.coords(entry), attrs=entry["attrs"])
+
+        elif kind == "Derived":
+            module, qualname = entry["func"].split(":")
+            func = importlib.import_module(module)
+            for attr in qualname.split("."):
+                func = getattr(func, attr)
+            return Derived(func, *entry["paths"])
+
+        elif kind == "tuple":
+            return tuple(self.decode(item) for item in entry["items"])
+
+        else:
+            return entry["value"]
+
+def load_snapshot(path, version=None):
+    """Loads the values of the snapshot at path, with memory-mapped arrays.
+
+    Returns None if there is no snapshot at path, or if it was built for a
+    different version of the baseline code and data than the current one.
+    """
+
+    if not os.path.exists(os.path.join(path, "manifest.json")):
+        return None
+
+    with open(os.path.join(path, "manifest.json")) as f:
+        manifest = json.load(f)
+
+    if manifest["version"] != (version if version is not None else snapshot_version()):
+        return None
+
+    reader = _Reader(path)
+    return {key: reader.decode(entry) for key, entry in manifest["values"].items()}
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", default=os.path.join(root_dir, "baseline_snapshot"),
+                        help="Output directory")
+    args = parser.parse_args(args)
+
+    from datablock_build import datablock, proj_pop
+
+    write_snapshot(args.output, {"datablock": datablock, "proj_pop": proj_pop})
+
+if __name__ == "__main__":
+    main()
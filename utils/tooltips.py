@@ -0,0 +1,125 @@
+"""Tooltip table of the sidebar widgets.
+
+The table is kept in a spreadsheet published as CSV. TooltipProvider serves
+it from memory, refreshing it in a background thread once it is older than
+its time to live, so reruns never wait on the network.
+
+Each fetched table is written to a cache directory, set with the
+TOOLTIPS_CACHE environment variable, and the cached copy is used at startup
+and whenever the spreadsheet cannot be reached. Without a cached copy, the
+read only copy bundled at utils/tooltips.csv is used instead. The
+source tree is never written to.
+"""
+
+import io
+import os
+import time
+import functools
+import threading
+import urllib.request
+
+import pandas as pd
+
+bundled_tooltips = os.path.join(os.path.dirname(os.path.abspath(__file__)), "tooltips.csv")
+
+cache_dir = os.environ.get("TOOLTIPS_CACHE",
+                           os.path.join(os.path.expanduser("~"), ".cache", "agrifood_calculator"))
+cached_tooltips = os.path.join(cache_dir, "tooltips.csv")
+
+def read_tooltips(source, timeout=10):
+    """Reads the tooltip table from a URL or a local path"""
+
+    if source.startswith(("http://", "https://")):
+        with urllib.request.urlopen(source, timeout=timeout) as response:
+            source = io.BytesIO(response.read())
+
+    return pd.read_csv(source, dtype="string")
+
+class TooltipProvider():
+    """Serves the tooltip table fetched from url, refreshed in the background
+    every ttl seconds. Fetched tables are saved to cache_path, and the cached
+    or else the bundled copy is served until a fetch succeeds"""
+
+    def __init__(self, url, cache_path=cached_tooltips, bundled_path=bundled_tooltips,
+                 ttl=3600) -> None:
+        self.url = url
+        self.cache_path = cache_path
+        self.bundled_path = bundled_path
+        self.ttl = ttl
+        self._table = None
+        self._fetched = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+        self._first_fetch = threading.Lock()
+
+    def get(self):
+        """Returns the tooltip table, or an empty table if neither the
+        spreadsheet nor a local copy are available"""
+
+        with self._lock:
+            if self._table is None:
+                for path in (self.cache_path, self.bundled_path):
+                    if os.path.exists(path):
+                        self._table = read_tooltips(path)
+                        break
+
+            table = self._table
+            fetched = self._fetched
+            stale = fetched is None or time.monotonic() - fetched > self.ttl
+
+        if table is None and fetched is None:
+            # Nothing to serve yet, so the first fetch is waited for. Sessions
+            # arriving meanwhile wait for the same fetch, and once it has
+            # been tried, even if it failed, later fetches are made in the
+            # background after the time to live
+            with self._first_fetch:
+                with self._lock:
+                    first = self._fetched is None
+                if first:
+                    self.refresh()
+        elif stale:
+            self.refresh_in_background()
+
+        with self._lock:
+            return self._table if self._table is not None else pd.DataFrame(dtype="string")
+
+    def refresh(self):
+        """Fetches the tooltip table and updates the cached copy. Failures
+        keep the current table"""
+
+        try:
+            table = read_tooltips(self.url)
+        except Exception:
+            table = None
+
+        with self._lock:
+            # Failed fetches are retried after the time to live
+            self._fetched = time.monotonic()
+            self._refreshing = False
+            if table is not None:
+                self._table = table
+
+        if table is not None:
+            temp_path = self.cache_path + ".tmp"
+            try:
+                os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+                table.to_csv(temp_path, index=False)
+                os.replace(temp_path, self.cache_path)
+            except OSError:
+                pass
+
+    def refresh_in_background(self):
+        """Starts a refresh in a background thread, unless one is running"""
+
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        threading.Thread(target=self.refresh, daemon=True).start()
+
+@functools.lru_cache(maxsize=4)
+def tooltip_provider(url):
+    """Returns the provider of url, shared by all the sessions served by this
+    process"""
+    return TooltipProvider(url)